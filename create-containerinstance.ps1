@@ -36,6 +36,33 @@
 .PARAMETER Location
     The Azure region where resources will be created. Defaults to 'East US'.
 
+.PARAMETER ProxyMode
+    MQTT proxy mode: 'terminate' (default) or 'passthrough' (routed on the SNI, never decrypted).
+
+.PARAMETER IothubHostnames
+    Optional IoT Hub hostnames (comma separated) to shard the devices across, instead of IothubHostname.
+
+.PARAMETER IothubShardBy
+    'sni' (default) or 'port': hub N of IothubHostnames listens on IothubShardBasePort + N, all these ports are exposed.
+
+.PARAMETER IothubShardBasePort
+    First MQTT port when sharding by port. Defaults to 8883.
+
+.PARAMETER StreamMetricsLog
+    Optional file the MQTT sessions are also logged to, for the metrics exporter.
+
+.PARAMETER CertPollInterval
+    Seconds between two checks of the certificate version in Key Vault, 0 disables the hot reload. Defaults to 300.
+
+.PARAMETER CertCache
+    Creates a 'cert-cache' file share mounted on /cert-cache (CERT_CACHE_DIR): restarts start from the cached certificate.
+
+.PARAMETER KvTicketKeySecretUrl
+    Optional Key Vault secret URL of the TLS session ticket key.
+
+.PARAMETER NginxSettings
+    Optional NGINX_* sizing values forced instead of the ones derived from the container limits, e.g. @{ NGINX_WORKER_PROCESSES = 2 }.
+
 .EXAMPLE
     .\create-containerinstance.ps1 -ResourceGroup "myRG" -StorageAccountName "mystorageacct" -UmiName "myumi" -DnsLabel "mydns" -KeyVaultSecretUrl "https://mykv.vault.azure.net/secrets/mycert" -IothubHostname "myiothub.azure-devices.net" -LogAnalyticsWorkspace "mylogworkspace" -ContainerInstanceName "mycontainer"
 #>
@@ -69,12 +96,47 @@ param(
     [string]$IothubHostname,
     
     [Parameter(Mandatory = $false)]
-    [string]$Location = "ItalyNorth"
+    [string]$Location = "ItalyNorth",
+
+    [Parameter(Mandatory = $false)]
+    [ValidateSet("terminate", "passthrough")]
+    [string]$ProxyMode = "terminate",
+
+    [Parameter(Mandatory = $false)]
+    [string]$IothubHostnames = "",
+
+    [Parameter(Mandatory = $false)]
+    [ValidateSet("sni", "port")]
+    [string]$IothubShardBy = "sni",
+
+    [Parameter(Mandatory = $false)]
+    [int]$IothubShardBasePort = 8883,
+
+    [Parameter(Mandatory = $false)]
+    [string]$StreamMetricsLog = "",
+
+    [Parameter(Mandatory = $false)]
+    [int]$CertPollInterval = 300,
+
+    [Parameter(Mandatory = $false)]
+    [switch]$CertCache,
+
+    [Parameter(Mandatory = $false)]
+    [string]$KvTicketKeySecretUrl = "",
+
+    [Parameter(Mandatory = $false)]
+    [hashtable]$NginxSettings = @{}
 )
 
 # Error handling
 $ErrorActionPreference = "Stop"
 
+foreach ($name in $NginxSettings.Keys) {
+    if ($name -notlike "NGINX_*") {
+        throw "NginxSettings only accepts NGINX_* variables, got '$name'"
+    }
+}
+
 try {
     Write-Host "Starting Azure resource creation..." -ForegroundColor Green
     
@@ -128,6 +190,13 @@ try {
         --account-name $StorageAccountName `
         --account-key $storageKey
     
+    if ($CertCache -and $LASTEXITCODE -eq 0) {
+        az storage share create `
+            --name "cert-cache" `
+            --account-name $StorageAccountName `
+            --account-key $storageKey
+    }
+    
     if ($LASTEXITCODE -ne 0) {
         throw "Failed to create file shares"
     }
@@ -155,6 +224,27 @@ try {
         Write-Warning "Script file not found at: $scriptPath"
     }
     
+    # Upload the config generation scripts to scripts share
+    foreach ($scriptName in @("02-stream-routing.sh", "03-render-nginx-conf.sh")) {
+        $generatorPath = Join-Path $PSScriptRoot "scripts\$scriptName"
+        if (Test-Path $generatorPath) {
+            az storage file upload `
+                --account-name $StorageAccountName `
+                --account-key $storageKey `
+                --share-name "scripts" `
+                --source $generatorPath `
+                --path $scriptName
+
+            if ($LASTEXITCODE -eq 0) {
+                Write-Host "  ✅ $scriptName uploaded to scripts share" -ForegroundColor Green
+            } else {
+                Write-Warning "Failed to upload $scriptName"
+            }
+        } else {
+            Write-Warning "Script file not found at: $generatorPath"
+        }
+    }
+    
     # Upload nginx.conf.template to config share
     $templatePath = Join-Path $PSScriptRoot "templates\nginx.conf.template"
     if (Test-Path $templatePath) {
@@ -236,6 +326,48 @@ try {
     
     # Create Container Instance
     Write-Host "Creating container instance '$ContainerInstanceName'..." -ForegroundColor Yellow
+
+    # Environment of the container, read by the scripts of the scripts share (see ACI.md)
+    $environmentVariables = [ordered]@{
+        KV_SECRET_URL = $KeyVaultSecretUrl
+        NGINX_ENVSUBST_OUTPUT_DIR = "/etc/nginx"
+        IOTHUB_HOSTNAME = $IothubHostname
+        UMI_CLIENT_ID = $umiClientId
+        PROXY_MODE = $ProxyMode
+        IOTHUB_SHARD_BY = $IothubShardBy
+        IOTHUB_SHARD_BASE_PORT = $IothubShardBasePort
+        CERT_POLL_INTERVAL = $CertPollInterval
+    }
+    if ($IothubHostnames) { $environmentVariables["IOTHUB_HOSTNAMES"] = $IothubHostnames }
+    if ($StreamMetricsLog) { $environmentVariables["STREAM_METRICS_LOG"] = $StreamMetricsLog }
+    if ($CertCache) { $environmentVariables["CERT_CACHE_DIR"] = "/cert-cache" }
+    if ($KvTicketKeySecretUrl) { $environmentVariables["KV_TICKET_KEY_SECRET_URL"] = $KvTicketKeySecretUrl }
+    foreach ($name in $NginxSettings.Keys) {
+        $environmentVariables[$name] = $NginxSettings[$name]
+    }
+    # Values quoted: ACI only accepts strings
+    $environmentYaml = ($environmentVariables.GetEnumerator() | ForEach-Object {
+        "          - name: $($_.Key)`n            value: '$("$($_.Value)".Replace("'", "''"))'"
+    }) -join "`n"
+
+    # MQTT ports: one per hub when sharding by port, 8883 otherwise
+    $hubs = @($IothubHostnames -split "[,\s]+" | Where-Object { $_ })
+    if ($IothubShardBy -eq "port") {
+        $mqttPorts = @(0..([Math]::Max($hubs.Count, 1) - 1) | ForEach-Object { $IothubShardBasePort + $_ })
+    } else {
+        $mqttPorts = @(8883)
+    }
+    $ports = @(443) + $mqttPorts
+    $containerPortsYaml = ($ports | ForEach-Object { "          - port: $_" }) -join "`n"
+    $ipAddressPortsYaml = ($ports | ForEach-Object { "    - protocol: tcp`n      port: $_" }) -join "`n"
+
+    $certCacheMountYaml = ""
+    $certCacheVolumeYaml = ""
+    if ($CertCache) {
+        $certCacheMountYaml = "`n          - name: cert-cache-volume`n            mountPath: /cert-cache"
+        $certCacheVolumeYaml = "`n    - name: cert-cache-volume`n      azureFile:`n        shareName: cert-cache`n        storageAccountName: $StorageAccountName`n        storageAccountKey: $storageKey"
+    }
+
     # azure-containerinstance.yaml
 
     $yaml = @"
@@ -261,32 +393,21 @@ properties:
             cpu: 1.0
             memoryInGb: 1.5
         ports:
-          - port: 443
-          - port: 8883
+$containerPortsYaml
         environmentVariables:
-          - name: KV_SECRET_URL
-            value: $KeyVaultSecretUrl
-          - name: NGINX_ENVSUBST_OUTPUT_DIR
-            value: /etc/nginx
-          - name: IOTHUB_HOSTNAME
-            value: $IothubHostname
-          - name: UMI_CLIENT_ID
-            value: $umiClientId
+$environmentYaml
         volumeMounts:
           - name: scripts-volume
             mountPath: /docker-entrypoint.d/init-scripts
           - name: config-volume
-            mountPath: /etc/nginx/templates
+            mountPath: /etc/nginx/templates$certCacheMountYaml
   osType: Linux
   restartPolicy: Always
   ipAddress:
     type: Public
     dnsNameLabel: $DnsLabel
     ports:
-    - protocol: tcp
-      port: 443
-    - protocol: tcp
-      port: 8883
+$ipAddressPortsYaml
   volumes:
     - name: scripts-volume
       azureFile:
@@ -297,7 +418,7 @@ properties:
       azureFile:
         shareName: config
         storageAccountName: $StorageAccountName
-        storageAccountKey: $storageKey
+        storageAccountKey: $storageKey$certCacheVolumeYaml
   diagnostics:
     logAnalytics:
       workspaceId: $workspaceId
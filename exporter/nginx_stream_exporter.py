@@ -0,0 +1,377 @@
+import argparse
+import bisect
+import collections
+import ctypes
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Buckets (upper bounds) of the histograms
+SESSION_DURATION_BUCKETS = (1, 5, 30, 60, 300, 900, 3600, 4 * 3600, 12 * 3600, 24 * 3600)
+UPSTREAM_CONNECT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+# Distinct listen ports (label values) tracked, the others are counted under "other"
+MAX_PORTS = 32
+# Status of a stream session whose upstream connection failed
+STATUS_UPSTREAM_FAILED = 502
+# fallocate() modes freeing a range of the file without changing its size (Linux)
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+STUB_STATUS_PATTERN = re.compile(
+    rb"Active connections:\s*(\d+).*?(\d+)\s+(\d+)\s+(\d+)\s*Reading:\s*(\d+)\s*Writing:\s*(\d+)\s*Waiting:\s*(\d+)", re.S)
+
+
+class Histogram:
+    """Cumulative fixed-bucket histogram: constant memory whatever the number of observations."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str, lines: list):
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.3f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+
+
+class RollingWindow:
+    """
+    Sessions, bytes and session durations of the last `window` seconds, in a ring of `slots` slots:
+    the oldest slot is dropped as a new one starts, so the memory is bounded.
+    """
+
+    def __init__(self, window: float = 60, slots: int = 6):
+        self.slot_seconds = window / slots
+        self.slots = collections.deque(maxlen=slots)
+
+    def _slot(self, now: float) -> list:
+        start = now - now % self.slot_seconds
+        if not self.slots or self.slots[-1][0] != start:
+            # start, sessions, bytes sent, bytes received, duration bucket counts
+            self.slots.append([start, 0, 0, 0, [0] * (len(SESSION_DURATION_BUCKETS) + 1)])
+        return self.slots[-1]
+
+    def record(self, now: float, bytes_sent: int, bytes_received: int, duration: float):
+        slot = self._slot(now)
+        slot[1] += 1
+        slot[2] += bytes_sent
+        slot[3] += bytes_received
+        slot[4][bisect.bisect_left(SESSION_DURATION_BUCKETS, duration)] += 1
+
+    def summary(self, now: float) -> dict:
+        self._slot(now)
+        oldest = now - self.slot_seconds * self.slots.maxlen
+        slots = [slot for slot in self.slots if slot[0] >= oldest]
+        elapsed = max(now - slots[0][0], self.slot_seconds)
+        counts = [sum(column) for column in zip(*(slot[4] for slot in slots))]
+        return {
+            "sessions_per_second": sum(slot[1] for slot in slots) / elapsed,
+            "bytes_sent_per_second": sum(slot[2] for slot in slots) / elapsed,
+            "bytes_received_per_second": sum(slot[3] for slot in slots) / elapsed,
+            "duration_quantiles": {q: _bucket_quantile(counts, q) for q in (0.5, 0.9, 0.99)},
+        }
+
+
+def _bucket_quantile(counts: list, q: float) -> float:
+    """Upper bound of the bucket holding the quantile (the last bound for the overflow bucket)."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= rank:
+            return SESSION_DURATION_BUCKETS[min(index, len(SESSION_DURATION_BUCKETS) - 1)]
+    return SESSION_DURATION_BUCKETS[-1]
+
+
+class StreamMetrics:
+    """
+    Counters and histograms of the stream sessions, fed with the lines of the `metrics` log format:
+    $msec $server_port $status $bytes_sent $bytes_received $session_time $upstream_connect_time
+    """
+
+    def __init__(self, window: float = 60):
+        self.sessions = collections.Counter()  # (port, status) -> sessions
+        self.bytes_sent = collections.Counter()  # port -> bytes
+        self.bytes_received = collections.Counter()
+        self.durations = {}  # port -> Histogram
+        self.upstream_connect = {}
+        self.window = RollingWindow(window)
+        self.parse_errors = 0
+        self.lock = threading.Lock()
+
+    def _port(self, port: bytes) -> str:
+        port = port.decode()
+        if port in self.durations or len(self.durations) < MAX_PORTS:
+            return port
+        return "other"
+
+    def record_line(self, line: bytes):
+        # The upstream connect time comes last: retries are listed as "0.001, 0.002"
+        fields = line.split(b" ", 6)
+        try:
+            port = self._port(fields[1])
+            status = int(fields[2])
+            bytes_sent = int(fields[3])
+            bytes_received = int(fields[4])
+            duration = float(fields[5])
+            connect_times = fields[6].strip()
+        except (IndexError, ValueError):
+            self.parse_errors += 1
+            return
+
+        self.sessions[(port, status)] += 1
+        self.bytes_sent[port] += bytes_sent
+        self.bytes_received[port] += bytes_received
+        durations = self.durations.get(port)
+        if durations is None:
+            durations = self.durations[port] = Histogram(SESSION_DURATION_BUCKETS)
+            self.upstream_connect[port] = Histogram(UPSTREAM_CONNECT_BUCKETS)
+        durations.observe(duration)
+        if connect_times != b"-":
+            # Time of the connection that was used (the last one)
+            try:
+                self.upstream_connect[port].observe(float(connect_times.rsplit(b" ", 1)[-1]))
+            except ValueError:
+                pass
+        self.window.record(time.time(), bytes_sent, bytes_received, duration)
+
+    def render(self, lines: list):
+        lines.append("# HELP nginx_stream_sessions_total Closed stream sessions by listen port and status.")
+        lines.append("# TYPE nginx_stream_sessions_total counter")
+        for (port, status), count in sorted(self.sessions.items()):
+            lines.append(f'nginx_stream_sessions_total{{port="{port}",status="{status}"}} {count}')
+        lines.append("# HELP nginx_stream_upstream_connect_failures_total Sessions closed because the upstream connection failed.")
+        lines.append("# TYPE nginx_stream_upstream_connect_failures_total counter")
+        for port in sorted(self.durations):
+            lines.append(f'nginx_stream_upstream_connect_failures_total{{port="{port}"}} '
+                         f'{self.sessions.get((port, STATUS_UPSTREAM_FAILED), 0)}')
+        for name, counter in (("nginx_stream_bytes_sent_total", self.bytes_sent),
+                              ("nginx_stream_bytes_received_total", self.bytes_received)):
+            lines.append(f"# TYPE {name} counter")
+            for port, value in sorted(counter.items()):
+                lines.append(f'{name}{{port="{port}"}} {value}')
+        for name, histograms in (("nginx_stream_session_duration_seconds", self.durations),
+                                 ("nginx_stream_upstream_connect_seconds", self.upstream_connect)):
+            lines.append(f"# TYPE {name} histogram")
+            for port, histogram in sorted(histograms.items()):
+                histogram.render(name, f'port="{port}"', lines)
+
+        window = self.window.summary(time.time())
+        lines.append(f"# HELP nginx_stream_window_sessions_per_second Sessions closed per second over the last "
+                     f"{self.window.slot_seconds * self.window.slots.maxlen:g}s.")
+        lines.append("# TYPE nginx_stream_window_sessions_per_second gauge")
+        lines.append(f"nginx_stream_window_sessions_per_second {window['sessions_per_second']:.3f}")
+        lines.append("# TYPE nginx_stream_window_bytes_per_second gauge")
+        lines.append(f'nginx_stream_window_bytes_per_second{{direction="sent"}} {window["bytes_sent_per_second"]:.1f}')
+        lines.append(f'nginx_stream_window_bytes_per_second{{direction="received"}} {window["bytes_received_per_second"]:.1f}')
+        lines.append("# TYPE nginx_stream_window_session_duration_seconds gauge")
+        for q, value in window["duration_quantiles"].items():
+            lines.append(f'nginx_stream_window_session_duration_seconds{{quantile="{q}"}} {value}')
+        lines.append("# TYPE nginx_stream_log_parse_errors_total counter")
+        lines.append(f"nginx_stream_log_parse_errors_total {self.parse_errors}")
+
+
+def _libc_fallocate():
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    return fallocate
+
+
+class LogTailer:
+    """
+    Reads what was appended to the log since the last call, in large chunks. Follows a rotated or
+    truncated file, and frees what it has read once that exceeds `truncate_bytes`: the read range
+    becomes a hole, so the offsets do not move and a line nginx appends meanwhile cannot be lost.
+    Where holes are not supported the file is truncated instead (nginx appends with O_APPEND, so its
+    next lines land at the start of the emptied file), and the lines appended between the last read
+    and the truncation are lost.
+    """
+
+    def __init__(self, path: str, truncate_bytes: int = 64 * 2 ** 20, chunk_size: int = 256 * 1024):
+        self.path = path
+        self.truncate_bytes = truncate_bytes
+        self.chunk_size = chunk_size
+        self._file = None
+        self._inode = None
+        self._remainder = b""
+        # Start of the range read but not freed yet
+        self._released = 0
+        self._fallocate = _libc_fallocate()
+
+    def _reopen(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self._file is None or stat.st_ino != self._inode or stat.st_size < self._file.tell():
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, "rb")
+            self._inode = stat.st_ino
+            self._remainder = b""
+            self._released = 0
+        return True
+
+    def read_lines(self, handle_line):
+        if not self._reopen():
+            return 0
+        lines = 0
+        while True:
+            chunk = self._file.read(self.chunk_size)
+            if not chunk:
+                break
+            chunk = self._remainder + chunk
+            end = chunk.rfind(b"\n")
+            if end < 0:
+                self._remainder = chunk
+                continue
+            self._remainder = chunk[end + 1:]
+            for line in chunk[:end].split(b"\n"):
+                if line:
+                    handle_line(line)
+                    lines += 1
+        if self._file.tell() - self._released >= self.truncate_bytes:
+            self._release()
+        return lines
+
+    def _release(self):
+        end = self._file.tell() - len(self._remainder)
+        if self._fallocate is not None:
+            fd = os.open(self.path, os.O_WRONLY)
+            try:
+                if os.fstat(fd).st_ino != self._inode:
+                    return
+                if self._fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, self._released,
+                                   end - self._released) == 0:
+                    self._released = end
+                    return
+                logging.warning(f"⚠️ Cannot free the read part of {self.path} "
+                                f"({os.strerror(ctypes.get_errno())}), truncating it instead")
+                self._fallocate = None
+            finally:
+                os.close(fd)
+        if not self._remainder:
+            os.truncate(self.path, 0)
+            self._file.seek(0)
+            self._released = 0
+
+
+def read_stub_status(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=2) as response:
+        match = STUB_STATUS_PATTERN.search(response.read())
+    if not match:
+        raise ValueError("Unexpected stub_status response")
+    active, accepts, handled, requests, reading, writing, waiting = (int(value) for value in match.groups())
+    return {"active": active, "accepts": accepts, "handled": handled, "requests": requests,
+            "reading": reading, "writing": writing, "waiting": waiting}
+
+
+def render_stub_status(url: str, lines: list):
+    lines.append("# HELP nginx_up Whether nginx answered the stub_status request.")
+    lines.append("# TYPE nginx_up gauge")
+    try:
+        status = read_stub_status(url)
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️ stub_status unavailable: {e}")
+        lines.append("nginx_up 0")
+        return
+    lines.append("nginx_up 1")
+    lines.append("# HELP nginx_connections_active Open client connections, MQTT sessions included.")
+    lines.append("# TYPE nginx_connections_active gauge")
+    lines.append(f"nginx_connections_active {status['active']}")
+    lines.append("# TYPE nginx_connections_state gauge")
+    for state in ("reading", "writing", "waiting"):
+        lines.append(f'nginx_connections_state{{state="{state}"}} {status[state]}')
+    lines.append("# TYPE nginx_connections_accepted_total counter")
+    lines.append(f"nginx_connections_accepted_total {status['accepts']}")
+    lines.append("# TYPE nginx_connections_handled_total counter")
+    lines.append(f"nginx_connections_handled_total {status['handled']}")
+    lines.append("# TYPE nginx_http_requests_total counter")
+    lines.append(f"nginx_http_requests_total {status['requests']}")
+
+
+class Exporter:
+    def __init__(self, log_path: str, stub_status_url: str, window: float, truncate_bytes: int):
+        self.metrics = StreamMetrics(window)
+        self.tailer = LogTailer(log_path, truncate_bytes)
+        self.stub_status_url = stub_status_url
+
+    def tail_forever(self, interval: float):
+        while True:
+            with self.metrics.lock:
+                try:
+                    self.tailer.read_lines(self.metrics.record_line)
+                except OSError as e:
+                    logging.warning(f"⚠️ Failed to read {self.tailer.path}: {e}")
+            time.sleep(interval)
+
+    def render(self) -> bytes:
+        lines = []
+        with self.metrics.lock:
+            self.metrics.render(lines)
+        if self.stub_status_url:
+            render_stub_status(self.stub_status_url, lines)
+        lines.append("")
+        return "\n".join(lines).encode()
+
+
+def serve(exporter: Exporter, port: int):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = exporter.render()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    logging.info(f"📈 Serving the proxy metrics on :{port}/metrics")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prometheus exporter of the nginx stream sessions and connections.")
+    parser.add_argument("--log", default=os.environ.get("STREAM_METRICS_LOG", "/var/log/nginx-metrics/stream.log"),
+                        help="Stream log written in the metrics format")
+    parser.add_argument("--stub-status-url", default=os.environ.get("STUB_STATUS_URL", "http://127.0.0.1/nginx_status"),
+                        help="stub_status location of nginx, empty to disable")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("EXPORTER_PORT", "9113")))
+    parser.add_argument("--window", type=float, default=float(os.environ.get("EXPORTER_WINDOW", "60")),
+                        help="Seconds covered by the rolling window gauges")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between two reads of the log")
+    parser.add_argument("--truncate-mb", type=int, default=64, help="Log read after which it is freed")
+    args = parser.parse_args()
+
+    exporter = Exporter(args.log, args.stub_status_url, args.window, args.truncate_mb * 2 ** 20)
+    threading.Thread(target=exporter.tail_forever, args=(args.interval,), daemon=True).start()
+    serve(exporter, args.port)
@@ -6,6 +6,8 @@ $webPort = 8089
 $cpuCores = [System.Environment]::ProcessorCount - 2
 # List of Locust processes
 $locustProcesses = @()
+# Same run id for the master and the workers (run results saved to Azure Tables)
+if (-not $env:RUN_ID) { $env:RUN_ID = Get-Date -Format "yyyyMMdd-HHmmss" }
 
 try {
     Write-Host "🔹 Run Locust master on port $webPort"
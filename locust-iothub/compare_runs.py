@@ -0,0 +1,43 @@
+import argparse
+import logging
+from utils import config
+from services.keyvault_service import KeyVaultService
+from services.run_results import load_run_summary
+from services.storage_service import StorageService
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
+
+COLUMNS = ("Requests", "Failures", "AvgMs", "P50Ms", "P95Ms", "P99Ms", "MaxMs", "Rps")
+
+
+def main(run_ids: list, params_from_key_vault: bool):
+    if params_from_key_vault:
+        # Read secrets from Key Vault
+        kv_service = KeyVaultService(config.KEY_VAULT_NAME)
+        storage_connection_string = kv_service.get_secret(config.STORAGE_CONNECTION_STRING_SECRET_NAME)
+    else:
+        # Read secret from config file
+        storage_connection_string = config.STORAGE_CONNECTION_STRING_SECRET_VALUE
+
+    storage = StorageService(storage_connection_string)
+    runs = {run_id: load_run_summary(storage, config.RUN_RESULTS_SUMMARY_TABLE, run_id) for run_id in run_ids}
+    rows = sorted({row for summary in runs.values() for row in summary})
+
+    # One block per statistics row, one line per run
+    for row in rows:
+        print(f"\n{row}")
+        print(f"  {'run':<20}" + "".join(f"{column:>12}" for column in COLUMNS))
+        for run_id, summary in runs.items():
+            entity = summary.get(row)
+            if entity is None:
+                print(f"  {run_id:<20}" + "".join(f"{'-':>12}" for _ in COLUMNS))
+            else:
+                print(f"  {run_id:<20}" + "".join(f"{entity.get(column, '-'):>12}" for column in COLUMNS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the statistics of load test runs saved with RUN_RESULTS_ENABLED")
+    parser.add_argument("run_ids", nargs="+")
+    args = parser.parse_args()
+    main(args.run_ids, config.PARAMS_SOURCE == "keyvault")
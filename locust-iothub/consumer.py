@@ -1,12 +1,18 @@
 import asyncio
+import json
 import logging
+import multiprocessing
+import time
 from utils import config
+from utils.checkpoint_store import FileCheckpointStore
+from utils.message_profiles import parse_stamp
+from utils.stream_stats import FleetStreamStats
 from azure.eventhub.aio import EventHubConsumerClient
 from services.keyvault_service import KeyVaultService
 
 logging.basicConfig(level=logging.INFO)
 
-# Monitoring device list
+# Devices whose events are logged one by one (debug level)
 TARGET_DEVICE_IDS = [
     "00-00-00-00-00-00-00-00-00-00-00-01",
     "00-00-00-00-00-00-00-00-00-00-00-02",
@@ -17,36 +23,148 @@ TARGET_DEVICE_IDS = [
 ]
 
 
-async def on_event(partition_context, event):
-    body = event.body_as_str()
+fleet_stats = FleetStreamStats()
+
+
+class PartitionProgress:
+    """Events received and checkpointed on one partition, and how far behind the hub it is."""
+
+    def __init__(self, store: FileCheckpointStore, partition_id: str):
+        self.store = store
+        self.partition_id = partition_id
+        self.events = 0
+        self.interval_events = 0
+        self.uncheckpointed = 0
+        self.last_checkpoint = time.monotonic()
+        self.last_event = None
+        self.lag_events = None
+        self.lag_seconds = None
+
+    def processed(self, partition_context, event, count: int = 1):
+        self.events += count
+        self.interval_events += count
+        self.uncheckpointed += count
+        self.last_event = event
+        if event.enqueued_time:
+            self.lag_seconds = max(0.0, time.time() - event.enqueued_time.timestamp())
+        last_enqueued = partition_context.last_enqueued_event_properties
+        if last_enqueued and last_enqueued.get("sequence_number") is not None:
+            self.lag_events = last_enqueued["sequence_number"] - event.sequence_number
+
+    def checkpoint_due(self) -> bool:
+        return self.uncheckpointed and (self.uncheckpointed >= config.CHECKPOINT_EVERY_EVENTS
+                                        or time.monotonic() - self.last_checkpoint >= config.CHECKPOINT_INTERVAL)
+
+    def checkpoint(self):
+        if self.store and self.last_event is not None:
+            self.store.save(self.partition_id, self.last_event.sequence_number, self.last_event.offset)
+        self.uncheckpointed = 0
+        self.last_checkpoint = time.monotonic()
+
+
+partitions = {}
+
+
+def process_event(event, received_ms: float):
+    body = event.body if isinstance(event.body, bytes) else b"".join(event.body)
     system_props = event.system_properties
 
     device_id = event.system_properties[b"iothub-connection-device-id"].decode()
 
+    # Payloads stamped by the devices with the send time (epoch ms) and a per-device sequence number,
+    # JSON fields or binary header depending on the message profile
+    stamp = parse_stamp(body)
+    if stamp is None:
+        fleet_stats.record_unstamped()
+    else:
+        seq, sent_ms = stamp
+        enqueued_ms = event.enqueued_time.timestamp() * 1000 if event.enqueued_time else None
+        fleet_stats.record(device_id, seq, sent_ms, enqueued_ms, received_ms)
+
     if device_id in TARGET_DEVICE_IDS:
-        logging.info(
+        logging.debug(
             f"📥 Device {device_id} | "
             f"Seq: {event.sequence_number} | "
             f"Offset: {event.offset} | "
             f"Enqueued: {system_props.get('x-opt-enqueued-time')} | "
-            f"Body: {body}"
+            f"Body: {body[:200].decode('utf-8', errors='replace')}"
         )
 
-    # checkpoint
-    await partition_context.update_checkpoint(event)
 
+async def on_event(partition_context, event):
+    if event is None:
+        return
+    process_event(event, time.time() * 1000)
 
-async def main(params_from_key_vault: bool):
-    if params_from_key_vault:
-        # Read secrets from Key Vault
-        kv_service = KeyVaultService(config.KEY_VAULT_NAME)
-        eventhub_connection_string = kv_service.get_secret(config.EVENTHUB_CONNECTION_STRING_SECRET_NAME)
-        eventhub_name = kv_service.get_secret(config.EVENTHUB_NAME_SECRET_NAME)
+    # checkpoint every CHECKPOINT_EVERY_EVENTS events or CHECKPOINT_INTERVAL seconds, not on every event
+    progress = partitions[partition_context.partition_id]
+    progress.processed(partition_context, event)
+    if progress.checkpoint_due():
+        progress.checkpoint()
+
+
+async def on_event_batch(partition_context, events):
+    if not events:
+        return
+    received_ms = time.time() * 1000
+    for event in events:
+        process_event(event, received_ms)
+
+    progress = partitions[partition_context.partition_id]
+    progress.processed(partition_context, events[-1], len(events))
+    if progress.checkpoint_due():
+        progress.checkpoint()
+
+
+async def report_summaries(interval: float, name: str):
+    """Logs the fleet latency, loss, duplicates and reordering every interval instead of every event."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            summary = fleet_stats.summary(interval)
+            summary["events_per_second"] = round(sum(p.interval_events for p in partitions.values()) / interval, 1)
+            summary["partitions"] = {
+                partition_id: {"events": p.events, "lag_events": p.lag_events,
+                               "lag_seconds": round(p.lag_seconds, 1) if p.lag_seconds is not None else None}
+                for partition_id, p in partitions.items()
+            }
+            for p in partitions.values():
+                p.interval_events = 0
+            logging.info(f"📊 [{name}] {json.dumps(summary)}")
+    finally:
+        for p in partitions.values():
+            p.checkpoint()
+        logging.info(f"📊 [{name}] Totals: {json.dumps(fleet_stats.totals())}")
+
+
+async def receive_partition(client: EventHubConsumerClient, partition_id: str):
+    # Resume after the last local checkpoint of the partition, otherwise from the latest event
+    store = partitions[partition_id].store
+    checkpoint = store.load(partition_id) if store else None
+    starting_position = checkpoint["sequence_number"] if checkpoint else "@latest"
+    if config.CONSUMER_MODE == "batch":
+        await client.receive_batch(
+            on_event_batch=on_event_batch,
+            partition_id=partition_id,
+            max_batch_size=config.CONSUMER_BATCH_SIZE,
+            max_wait_time=config.CONSUMER_BATCH_MAX_WAIT,
+            prefetch=config.CONSUMER_BATCH_SIZE * 2,
+            starting_position=starting_position,
+            starting_position_inclusive=False,
+            track_last_enqueued_event_properties=True,
+        )
     else:
-        # Read secret from config file
-        eventhub_connection_string = config.EVENTHUB_CONNECTION_STRING_SECRET_VALUE
-        eventhub_name = config.EVENTHUB_NAME_SECRET_VALUE
+        await client.receive(
+            on_event=on_event,
+            partition_id=partition_id,
+            starting_position=starting_position,
+            starting_position_inclusive=False,
+            track_last_enqueued_event_properties=True,
+        )
+
 
+async def consume(eventhub_connection_string: str, eventhub_name: str, process_index: int, process_count: int):
+    """Receives the partitions assigned to this process (every process_count-th one)."""
     eventhub_consumer_group = config.EVENTHUB_CONSUMER_GROUP
 
     client = EventHubConsumerClient.from_connection_string(
@@ -55,13 +173,60 @@ async def main(params_from_key_vault: bool):
         eventhub_name=eventhub_name,
     )
 
+    store = FileCheckpointStore(config.CHECKPOINT_DIR, eventhub_name, eventhub_consumer_group) if config.CHECKPOINT_DIR else None
+    name = f"consumer {process_index + 1}/{process_count}"
     async with client:
-        await client.receive(
-            on_event=on_event,
-            starting_position="@latest",
-        )
+        partition_ids = (await client.get_partition_ids())[process_index::process_count]
+        for partition_id in partition_ids:
+            partitions[partition_id] = PartitionProgress(store, partition_id)
+        logging.info(f"📥 [{name}] Receiving partitions {partition_ids} ({config.CONSUMER_MODE} mode)")
+
+        reporter = asyncio.create_task(report_summaries(config.CONSUMER_SUMMARY_INTERVAL, name))
+        try:
+            await asyncio.gather(*(receive_partition(client, partition_id) for partition_id in partition_ids))
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+
+
+def run_consumer(eventhub_connection_string: str, eventhub_name: str, process_index: int, process_count: int):
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(consume(eventhub_connection_string, eventhub_name, process_index, process_count))
+    except KeyboardInterrupt:
+        pass
+
+
+def main(params_from_key_vault: bool):
+    if params_from_key_vault:
+        # Read secrets from Key Vault
+        kv_service = KeyVaultService(config.KEY_VAULT_NAME)
+        eventhub_connection_string = kv_service.get_secret(config.EVENTHUB_CONNECTION_STRING_SECRET_NAME)
+        eventhub_name = kv_service.get_secret(config.EVENTHUB_NAME_SECRET_NAME)
+    else:
+        # Read secret from config file
+        eventhub_connection_string = config.EVENTHUB_CONNECTION_STRING_SECRET_VALUE
+        eventhub_name = config.EVENTHUB_NAME_SECRET_VALUE
+
+    process_count = max(1, config.CONSUMER_PROCESSES)
+    if process_count == 1:
+        run_consumer(eventhub_connection_string, eventhub_name, 0, 1)
+        return
+
+    # Partition fan-out: every process receives its own share of the partitions
+    processes = [multiprocessing.Process(target=run_consumer,
+                                         args=(eventhub_connection_string, eventhub_name, index, process_count))
+                 for index in range(process_count)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
 
 
 if __name__ == "__main__":
     params_from_key_vault = config.PARAMS_SOURCE == "keyvault"
-    asyncio.run(main(params_from_key_vault))
\ No newline at end of file
+    main(params_from_key_vault)
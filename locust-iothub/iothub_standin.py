@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import ssl
+import tempfile
+import time
+import urllib.parse
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from mqtt import mqtt_packets
+from services.sastoken_service import SasTokenService, parse_sas_token, verify_sas_token
+from utils import device_key_store
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# CONNACK return codes
+CONNACK_ACCEPTED = 0
+CONNACK_BAD_CLIENT_ID = 2
+CONNACK_SERVER_UNAVAILABLE = 3
+CONNACK_BAD_CREDENTIALS = 4
+CONNACK_NOT_AUTHORIZED = 5
+
+
+def create_self_signed_certificate(hostname: str):
+    """Writes a self-signed certificate and key for the stand-in to a temporary directory."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(hostname)]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    directory = tempfile.mkdtemp(prefix="iothub-standin-")
+    certfile = os.path.join(directory, "standin.crt")
+    keyfile = os.path.join(directory, "standin.key")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+class DeviceConnection:
+    """State of one device connected to the stand-in."""
+
+    def __init__(self, device_id: str, writer: asyncio.StreamWriter, publish_rate: float):
+        self.device_id = device_id
+        self.writer = writer
+        self.telemetry_topic = f"devices/{device_id}/messages/events"
+        self.subscribed = False
+        self.reported_version = 1
+        self.publish_rate = publish_rate
+        self._tokens = publish_rate
+        self._last = time.monotonic()
+        self._packet_id = 0
+
+    def throttle_delay(self) -> float:
+        """Token bucket per device: seconds the next publish has to wait, 0 when within the rate."""
+        if not self.publish_rate:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.publish_rate, self._tokens + (now - self._last) * self.publish_rate)
+        self._last = now
+        self._tokens -= 1
+        return -self._tokens / self.publish_rate if self._tokens < 0 else 0.0
+
+    def send(self, data: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def next_packet_id(self) -> int:
+        self._packet_id = self._packet_id % 65535 + 1
+        return self._packet_id
+
+
+class IoTHubStandIn:
+    """
+    Emulates the MQTT device endpoint of IoT Hub, enough to load test the proxy offline:
+    CONNECT with SAS token validation, telemetry PUBLISH with PUBACK, SUBSCRIBE, PINGREQ,
+    twin GET and reported PATCH requests and direct method answers.
+    Latency, throttling and disconnects can be injected, and downstream bursts (C2D message,
+    desired properties patch and direct method call to every subscribed device) sent periodically.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 8883, certfile: str = None, keyfile: str = None,
+                 hostname: str = "localhost", device_keys: dict = None, group_key: str = None,
+                 authenticate: bool = True, latency_ms: float = 0, latency_jitter_ms: float = 0,
+                 max_publish_rate: float = 0, throttle_mode: str = "delay", max_connect_rate: float = 0,
+                 disconnect_rate: float = 0, backlog: int = 65535, downstream_interval: float = 0,
+                 downstream_bytes: int = 0):
+        self.host = host
+        self.port = port
+        self.hostname = hostname
+        self.device_keys = device_keys or {}
+        self.group_key = group_key
+        self.authenticate = authenticate
+        self.latency = latency_ms / 1000
+        self.latency_jitter = latency_jitter_ms / 1000
+        self.max_publish_rate = max_publish_rate
+        self.throttle_mode = throttle_mode
+        self.max_connect_rate = max_connect_rate
+        self.disconnect_rate = disconnect_rate
+        self.backlog = backlog
+        self.downstream_interval = downstream_interval
+        self.downstream_bytes = downstream_bytes
+        self.connections = {}
+        self.stats = {"connects": 0, "refused": 0, "publishes": 0, "throttled": 0, "disconnects": 0,
+                      "twin_requests": 0, "downstream": 0, "method_answers": 0}
+        self.desired = {"$version": 1}
+
+        if not certfile:
+            certfile, keyfile = create_self_signed_certificate(hostname)
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certfile, keyfile)
+
+        self._server = None
+        self._connect_tokens = max_connect_rate
+        self._connect_last = time.monotonic()
+        self._sequence = itertools.count(1)
+        self._method_rids = itertools.count(1)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, ssl=self.ssl_context,
+                                                  backlog=self.backlog)
+        asyncio.get_running_loop().create_task(self._chaos())
+        if self.downstream_interval:
+            asyncio.get_running_loop().create_task(self._downstream())
+        logging.info(f"🛰️ IoT Hub stand-in listening on {self.host}:{self.port}")
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        asyncio.get_running_loop().create_task(self._report())
+        await self._server.serve_forever()
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+        for connection in list(self.connections.values()):
+            connection.writer.close()
+
+    def _device_key(self, device_id: str) -> str:
+        if self.group_key:
+            return SasTokenService.derive_device_key(self.group_key, device_id)
+        return self.device_keys.get(device_id)
+
+    def _accept_connect_rate(self) -> bool:
+        if not self.max_connect_rate:
+            return True
+        now = time.monotonic()
+        self._connect_tokens = min(self.max_connect_rate,
+                                   self._connect_tokens + (now - self._connect_last) * self.max_connect_rate)
+        self._connect_last = now
+        if self._connect_tokens < 1:
+            return False
+        self._connect_tokens -= 1
+        return True
+
+    def _authorize(self, client_id: str, username: str, password: str) -> int:
+        # IoT Hub username: {hostname}/{device_id}/?api-version=...
+        device_id = (username or "").split("/")[1] if username and username.count("/") >= 2 else None
+        if device_id != client_id:
+            return CONNACK_BAD_CLIENT_ID
+        if not self._accept_connect_rate():
+            return CONNACK_SERVER_UNAVAILABLE
+        if not self.authenticate:
+            return CONNACK_ACCEPTED
+        try:
+            fields = parse_sas_token(password)
+        except ValueError:
+            return CONNACK_BAD_CREDENTIALS
+        if not urllib.parse.unquote_plus(fields["sr"]).endswith(f"/devices/{device_id}"):
+            return CONNACK_NOT_AUTHORIZED
+        device_key = self._device_key(device_id)
+        if not device_key or not verify_sas_token(password, device_key):
+            return CONNACK_NOT_AUTHORIZED
+        return CONNACK_ACCEPTED
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = None
+        try:
+            packet_type, _, body = await asyncio.wait_for(mqtt_packets.read_packet(reader), 30)
+            if packet_type != mqtt_packets.CONNECT:
+                return
+            client_id, username, password, _ = mqtt_packets.decode_connect(body)
+            rc = self._authorize(client_id, username, password)
+            writer.write(mqtt_packets.encode_connack(rc))
+            if rc != CONNACK_ACCEPTED:
+                self.stats["refused"] += 1
+                await writer.drain()
+                return
+            self.stats["connects"] += 1
+            # A new connection for the same device drops the previous one, as IoT Hub does
+            previous = self.connections.get(client_id)
+            if previous:
+                previous.writer.close()
+            connection = DeviceConnection(client_id, writer, self.max_publish_rate)
+            self.connections[client_id] = connection
+            await self._session(reader, connection)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, ValueError):
+            pass
+        finally:
+            if connection and self.connections.get(connection.device_id) is connection:
+                del self.connections[connection.device_id]
+            writer.close()
+
+    async def _session(self, reader: asyncio.StreamReader, connection: DeviceConnection):
+        loop = asyncio.get_running_loop()
+        while True:
+            packet_type, flags, body = await mqtt_packets.read_packet(reader)
+            if packet_type == mqtt_packets.PUBLISH:
+                topic, packet_id, payload = mqtt_packets.decode_publish(flags, body)
+                if topic.startswith("$iothub/"):
+                    if not self._device_request(connection, topic):
+                        return
+                    if packet_id:
+                        connection.send(mqtt_packets.encode_puback(packet_id))
+                    continue
+                if not topic.startswith(connection.telemetry_topic):
+                    # Publishing on another device's topic closes the connection
+                    return
+                self.stats["publishes"] += 1
+                delay = connection.throttle_delay()
+                if delay:
+                    self.stats["throttled"] += 1
+                    if self.throttle_mode == "disconnect":
+                        return
+                delay += self.latency + random.uniform(0, self.latency_jitter)
+                if packet_id:
+                    if delay:
+                        loop.call_later(delay, connection.send, mqtt_packets.encode_puback(packet_id))
+                    else:
+                        connection.send(mqtt_packets.encode_puback(packet_id))
+            elif packet_type == mqtt_packets.SUBSCRIBE:
+                packet_id, topic_filters = mqtt_packets.decode_subscribe(body)
+                connection.send(mqtt_packets.encode_suback(packet_id, [min(qos, 1) for _, qos in topic_filters]))
+                connection.subscribed = True
+            elif packet_type == mqtt_packets.PINGREQ:
+                connection.send(mqtt_packets.PINGRESP_PACKET)
+            elif packet_type == mqtt_packets.DISCONNECT:
+                return
+
+    def _device_request(self, connection: DeviceConnection, topic: str) -> bool:
+        """Answers a twin request or takes a method answer; False for a topic IoT Hub would refuse."""
+        rid = urllib.parse.parse_qs(topic.partition("?")[2]).get("$rid", [""])[0]
+        if topic.startswith("$iothub/twin/GET/"):
+            self.stats["twin_requests"] += 1
+            twin = {"desired": self.desired, "reported": {"$version": connection.reported_version}}
+            connection.send(mqtt_packets.encode_publish(f"$iothub/twin/res/200/?$rid={rid}",
+                                                        json.dumps(twin).encode("utf-8"), qos=0))
+        elif topic.startswith("$iothub/twin/PATCH/properties/reported/"):
+            self.stats["twin_requests"] += 1
+            connection.reported_version += 1
+            connection.send(mqtt_packets.encode_publish(
+                f"$iothub/twin/res/204/?$rid={rid}&$version={connection.reported_version}", b"", qos=0))
+        elif topic.startswith("$iothub/methods/res/"):
+            self.stats["method_answers"] += 1
+        else:
+            return False
+        return True
+
+    def _stamped(self, extra: dict = None) -> bytes:
+        body = {"ts": int(time.time() * 1000), "seq": next(self._sequence), **(extra or {})}
+        if self.downstream_bytes:
+            body["pad"] = "x" * self.downstream_bytes
+        return json.dumps(body).encode("utf-8")
+
+    async def _downstream(self):
+        """Config push burst: a C2D message, a desired patch and a method call to every subscribed device."""
+        while True:
+            await asyncio.sleep(self.downstream_interval)
+            self.desired = {"$version": self.desired["$version"] + 1,
+                            "lastConfigurationChanged": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+            for connection in list(self.connections.values()):
+                if not connection.subscribed:
+                    continue
+                connection.send(mqtt_packets.encode_publish(
+                    f"devices/{connection.device_id}/messages/devicebound/type=config", self._stamped(),
+                    connection.next_packet_id()))
+                connection.send(mqtt_packets.encode_publish(
+                    f"$iothub/twin/PATCH/properties/desired/?$version={self.desired['$version']}",
+                    self._stamped(self.desired), qos=0))
+                connection.send(mqtt_packets.encode_publish(
+                    f"$iothub/methods/POST/configure/?$rid={next(self._method_rids):x}", self._stamped(), qos=0))
+                self.stats["downstream"] += 3
+
+    async def _chaos(self):
+        """Drops each connection with probability disconnect_rate every second."""
+        while True:
+            await asyncio.sleep(1)
+            if not self.disconnect_rate:
+                continue
+            for connection in list(self.connections.values()):
+                if random.random() < self.disconnect_rate:
+                    self.stats["disconnects"] += 1
+                    connection.writer.close()
+
+    async def _report(self, interval: int = 10):
+        previous = 0
+        while True:
+            await asyncio.sleep(interval)
+            publishes = self.stats["publishes"]
+            logging.info(
+                f"📊 {len(self.connections)} sessions | "
+                f"{(publishes - previous) / interval:.0f} msg/s | "
+                f"connects {self.stats['connects']} | refused {self.stats['refused']} | "
+                f"throttled {self.stats['throttled']} | injected disconnects {self.stats['disconnects']} | "
+                f"twin requests {self.stats['twin_requests']} | downstream {self.stats['downstream']} | "
+                f"method answers {self.stats['method_answers']}"
+            )
+            previous = publishes
+
+
+def _raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local MQTT-over-TLS stand-in for the IoT Hub device endpoint.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8883)
+    parser.add_argument("--hostname", default="localhost", help="Hostname of the self-signed certificate")
+    parser.add_argument("--certfile", help="Server certificate (PEM), self-signed if omitted")
+    parser.add_argument("--keyfile", help="Server private key (PEM)")
+    parser.add_argument("--key-store", help="Device key store exported by test_init.py")
+    parser.add_argument("--group-key", help="Group key the device keys are derived from")
+    parser.add_argument("--no-auth", action="store_true", help="Accept any SAS token")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Injected PUBACK latency")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0, help="Random extra PUBACK latency")
+    parser.add_argument("--max-publish-rate", type=float, default=0, help="Messages/s per device before throttling")
+    parser.add_argument("--throttle-mode", choices=["delay", "disconnect"], default="delay")
+    parser.add_argument("--max-connect-rate", type=float, default=0, help="Connects/s before refusing with rc=3")
+    parser.add_argument("--disconnect-rate", type=float, default=0, help="Probability per second to drop a session")
+    parser.add_argument("--downstream-interval", type=float, default=0,
+                        help="Seconds between two C2D/desired/method bursts to every subscribed device, 0: none")
+    parser.add_argument("--downstream-bytes", type=int, default=0, help="Padding of the downstream bodies")
+    args = parser.parse_args()
+
+    _raise_open_files_limit()
+    standin = IoTHubStandIn(host=args.host, port=args.port, certfile=args.certfile, keyfile=args.keyfile,
+                            hostname=args.hostname,
+                            device_keys=device_key_store.load(args.key_store) if args.key_store else None,
+                            group_key=args.group_key, authenticate=not args.no_auth,
+                            latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+                            max_publish_rate=args.max_publish_rate, throttle_mode=args.throttle_mode,
+                            max_connect_rate=args.max_connect_rate, disconnect_rate=args.disconnect_rate,
+                            downstream_interval=args.downstream_interval, downstream_bytes=args.downstream_bytes)
+    asyncio.run(standin.serve_forever())
@@ -1,50 +1,51 @@
-import datetime
-import json
-import random
 import logging
+import os
 from azure.iot.hub.protocol.models import Twin, TwinProperties
-from locust import User, task, between
-from services.keyvault_service import KeyVaultService
-from services.queue_service import QueueService
+from locust import User, task, between, constant, events
+from locust.runners import MasterRunner, WorkerRunner
+from services.keyvault_service import KeyVaultService, certificate_file_stats
+from services.device_lease_pool import get_lease_pool, close_lease_pools
 from services.iothub_service import IoTHubService
-from services.sastoken_service import SasTokenService
-from mqtt.mqtt_client import MqttClient
-from utils import config
+from services.run_results import RunResultsRecorder, get_run_id
+from services.storage_service import StorageService
+from services.sastoken_service import SasTokenService, SasTokenManager
+from mqtt.mqtt_client import MqttClient, publish_backlog
+from mqtt.async_mqtt_engine import AsyncMqttEngine, DeviceSession
+from mqtt.reconnect_policy import create_reconnect_policy
+from mqtt.traffic_trace import TraceRecorder
+from utils import config, device_key_store, device_twin
+from utils.message_profiles import get_pool
+from utils.resource_sampler import ResourceSampler, ResourceTimeseries
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
 
 
 def acquire_device_id(storage_connection_string: str, queue_name: str):
-    """Gets a free device from the Azure Queue"""
-    queue_service = QueueService(storage_connection_string, queue_name)
-    device_id = queue_service.receive_message().content
-    try:
-        queue_service.delete_message()
-    except Exception:
-        pass
-    return device_id
+    """Gets a free device from the process-local lease pool, filled in batches from the Azure Queue"""
+    return get_lease_pool(storage_connection_string, queue_name).acquire()
 
 
 def provision_device(iothub_connection_string: str, device_id: str):
     """Provisions a device on the Azure IoT Hub."""
+    if config.PROVISIONING_MODE == "bulk":
+        # Device created by test_init.py, the key is derived from the group key or read from the local key store
+        group_key = get_device_group_key()
+        if group_key:
+            return SasTokenService.derive_device_key(group_key, device_id)
+        device_key = device_key_store.get(config.DEVICE_KEY_STORE, device_id)
+        if device_key:
+            return device_key
+        logging.warning(f"Device {device_id} not found in {config.DEVICE_KEY_STORE}, provisioning it")
+
     iothub_service = IoTHubService(iothub_connection_string)
     device_key = iothub_service.provision_device(device_id)
 
     # Update twin device
     twin_patch = Twin(
-        tags={"deviceType": "mydevicetype"},
+        tags=device_twin.DEVICE_TAGS,
         properties=TwinProperties(
-            desired={
-                "env": "",
-                "eventhub": {
-                    "name": "myeventhub",
-                    "namespace": "myeventhubnamespace",
-                    "policy": "device"
-                },
-                "lastConfigurationChanged": datetime.datetime.now().isoformat() + "Z",
-                "ring": ""
-            }
+            desired=device_twin.desired_properties()
         )
     )
     iothub_service.update_twin(device_id, twin_patch)
@@ -55,19 +56,230 @@ def provision_device(iothub_connection_string: str, device_id: str):
 def release_device(storage_connection_string: str, queue_name: str, iothub_connection_string: str, device_id: str):
     """Releases the device by deprovisioning it and adding it to the queue."""
     try:
-        # Delete device from iothub
-        iothub_service = IoTHubService(iothub_connection_string)
-        iothub_service.delete_device(device_id)
-        # Release device
-        queue_service = QueueService(storage_connection_string, queue_name)
-        queue_service.send_message(device_id)
+        # Delete device from iothub (bulk provisioned devices are deleted by test_init.py --teardown)
+        if config.PROVISIONING_MODE != "bulk":
+            iothub_service = IoTHubService(iothub_connection_string)
+            iothub_service.delete_device(device_id)
+        # Release device to the lease pool, it returns to the queue in bulk at the end of the test
+        get_lease_pool(storage_connection_string, queue_name).release(device_id)
         logging.info(f"🔄 Released device {device_id}")
     except Exception:
         logging.error(f"Error releasing device {device_id}")
 
 
+def read_parameters(params_from_key_vault: bool):
+    """Reads connection parameters from Key Vault or from the config file."""
+    if params_from_key_vault:
+        # Read secrets from Key Vault
+        kv_service = KeyVaultService(config.KEY_VAULT_NAME)
+        storage_connection_string = kv_service.get_secret(config.STORAGE_CONNECTION_STRING_SECRET_NAME)
+        iothub_connection_string = kv_service.get_secret(config.IOTHUB_CONNECTION_STRING_SECRET_NAME)
+        iothub_hostname = kv_service.get_secret(config.IOTHUB_HOSTNAME_SECRET_NAME)
+        iothub_proxy = kv_service.get_secret(config.IOTHUB_PROXYNAME_SECRET_NAME)
+        certificate = kv_service.get_certificate_path(config.PROXY_CERTIFICATE_SECRET_NAME)
+    else:
+        # Read secret from config file
+        storage_connection_string = config.STORAGE_CONNECTION_STRING_SECRET_VALUE
+        iothub_connection_string = config.IOTHUB_CONNECTION_STRING_SECRET_VALUE
+        iothub_hostname = config.IOTHUB_HOSTNAME_SECRET_VALUE
+        iothub_proxy = config.IOTHUB_PROXYNAME_SECRET_VALUE
+        certificate = config.PROXY_CERTIFICATE_SECRET_VALUE
+    return storage_connection_string, iothub_connection_string, iothub_hostname, iothub_proxy, certificate
+
+
+_device_group_key = None
+
+
+def get_device_group_key() -> str:
+    """Reads the group key the device keys are derived from, once per process. Empty if not used."""
+    global _device_group_key
+    if _device_group_key is None:
+        if config.PARAMS_SOURCE == "keyvault" and config.DEVICE_GROUP_KEY_SECRET_NAME:
+            _device_group_key = KeyVaultService(config.KEY_VAULT_NAME).get_secret(config.DEVICE_GROUP_KEY_SECRET_NAME)
+        else:
+            _device_group_key = config.DEVICE_GROUP_KEY_SECRET_VALUE
+    return _device_group_key
+
+
+def mqtt_username(iothub_hostname: str, device_id: str) -> str:
+    return f"{iothub_hostname}/{device_id}/?api-version=2021-04-12"
+
+
+def new_reconnect_policy():
+    """Returns the reconnect policy of a device, from config.py."""
+    return create_reconnect_policy(config.RECONNECT_POLICY, config.RECONNECT_BASE_DELAY, config.RECONNECT_MAX_DELAY)
+
+
+_trace_recorder = None
+
+
+def get_trace_recorder():
+    """Returns the process-wide recorder of the traffic trace, None unless TRACE_RECORD_FILE is set."""
+    global _trace_recorder
+    if _trace_recorder is None and config.TRACE_RECORD_FILE:
+        # One file per process: the workers of a run are merged in time order by the replay
+        _trace_recorder = TraceRecorder(config.TRACE_RECORD_FILE.format(pid=os.getpid()))
+        logging.info(f"⏺️ Recording the traffic trace to {_trace_recorder.path}")
+    return _trace_recorder
+
+
+_fleet_engine = None
+
+
+def get_fleet_engine(iothub_proxy: str, certificate: str, request_event=None) -> AsyncMqttEngine:
+    """Returns the process-wide MQTT engine shared by every IoTDeviceFleetUser."""
+    global _fleet_engine
+    if _fleet_engine is None:
+        _fleet_engine = AsyncMqttEngine(mqtt_server=iothub_proxy,
+                                        ca_certs=certificate,
+                                        keepalive=config.MQTT_KEEPALIVE,
+                                        max_concurrent_connects=config.MAX_CONCURRENT_CONNECTS,
+                                        request_event=request_event,
+                                        publish_timeout=config.PUBLISH_TIMEOUT,
+                                        reconnect_policy=new_reconnect_policy,
+                                        payload_factory=get_pool(config.MESSAGE_PROFILE).payload_factory,
+                                        device_bound=config.DEVICE_BOUND_ENABLED,
+                                        trace=get_trace_recorder())
+        _fleet_engine.start()
+    return _fleet_engine
+
+
+_token_manager = None
+_token_handlers = {}
+
+
+def _apply_renewed_token(device_id: str, token: str):
+    handler = _token_handlers.get(device_id)
+    if handler:
+        handler(token)
+
+
+def get_token_manager(iothub_hostname: str) -> SasTokenManager:
+    """Returns the process-wide SAS token cache, renewing the tokens ahead of their expiry."""
+    global _token_manager
+    if _token_manager is None:
+        _token_manager = SasTokenManager(iothub_hostname,
+                                         expiry_hours=config.SAS_TOKEN_EXPIRY_HOURS,
+                                         renew_before=config.SAS_TOKEN_RENEW_BEFORE,
+                                         jitter=config.SAS_TOKEN_RENEW_JITTER,
+                                         on_renewed=_apply_renewed_token)
+    return _token_manager
+
+
+def register_device_token(iothub_hostname: str, device_keys: dict, on_renewed) -> dict:
+    """Returns the SAS tokens of the devices; on_renewed(device_id, token) is called on every renewal."""
+    for device_id in device_keys:
+        _token_handlers[device_id] = lambda token, device_id=device_id: on_renewed(device_id, token)
+    return get_token_manager(iothub_hostname).add_devices(device_keys)
+
+
+def unregister_device_token(device_id: str):
+    _token_handlers.pop(device_id, None)
+    if _token_manager:
+        _token_manager.remove_device(device_id)
+
+
+_run_recorder = None
+# Users running when the test was asked to stop: test_stop comes after every user has stopped
+_stopping_user_count = 0
+_resource_sampler = None
+_resource_timeseries = None
+# Samples of a worker waiting for the next report to the master
+_pending_samples = []
+
+
+def start_resource_sampler(environment) -> ResourceSampler:
+    """Samples the resources of this process; on a worker the samples go to the master with the statistics."""
+    def on_sample(sample):
+        logging.info(f"🩺 Generator: {sample}")
+        if isinstance(environment.runner, WorkerRunner):
+            _pending_samples.append(sample)
+        elif _resource_timeseries:
+            _resource_timeseries.write("local", sample)
+
+    sampler = ResourceSampler(config.RESOURCE_SAMPLE_INTERVAL, environment.events.request, on_sample,
+                              config.RESOURCE_CPU_THRESHOLD, config.RESOURCE_LAG_THRESHOLD_MS)
+    sampler.add_gauge("users", lambda: environment.runner.user_count)
+    sampler.add_gauge("certificate", certificate_file_stats)
+    if config.MQTT_ENGINE == "asyncio":
+        sampler.add_gauge("backlog", lambda: _fleet_engine.publish_backlog() if _fleet_engine
+                          else {"in_flight": 0, "overdue": 0, "write_buffer_bytes": 0})
+        sampler.add_lag_source("asyncio loop lag", lambda: _fleet_engine.take_loop_lag() if _fleet_engine else None)
+    else:
+        sampler.add_gauge("backlog", publish_backlog)
+    environment.events.request.add_listener(sampler.on_request)
+    sampler.start()
+    return sampler
+
+
+def on_report_to_master(client_id, data, **kwargs):
+    data["resource_samples"] = _pending_samples[:]
+    _pending_samples.clear()
+
+
+def on_worker_report(client_id, data, **kwargs):
+    for sample in data.get("resource_samples", []):
+        _resource_timeseries.write(client_id, sample)
+
+
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    """Collects the per-device results of the run when RUN_RESULTS_ENABLED and samples the generator resources."""
+    global _run_recorder, _resource_sampler, _resource_timeseries
+    if config.RUN_RESULTS_ENABLED:
+        _run_recorder = RunResultsRecorder(get_run_id(config.RUN_ID),
+                                           config.RUN_RESULTS_DEVICE_TABLE,
+                                           config.RUN_RESULTS_SUMMARY_TABLE)
+        if not isinstance(environment.runner, MasterRunner):
+            environment.events.request.add_listener(_run_recorder.on_request)
+    if config.RESOURCE_SAMPLE_INTERVAL:
+        if not isinstance(environment.runner, WorkerRunner) and config.RESOURCE_SAMPLES_FILE:
+            _resource_timeseries = ResourceTimeseries(config.RESOURCE_SAMPLES_FILE)
+            if isinstance(environment.runner, MasterRunner):
+                environment.events.worker_report.add_listener(on_worker_report)
+        if not isinstance(environment.runner, MasterRunner):
+            _resource_sampler = start_resource_sampler(environment)
+            if isinstance(environment.runner, WorkerRunner):
+                environment.events.report_to_master.add_listener(on_report_to_master)
+
+
+@events.quitting.add_listener
+def on_quitting(environment, **kwargs):
+    if _resource_sampler:
+        _resource_sampler.stop()
+    if _resource_timeseries:
+        _resource_timeseries.close()
+    if _trace_recorder:
+        _trace_recorder.close()
+
+
+@events.test_stopping.add_listener
+def on_test_stopping(environment, **kwargs):
+    global _stopping_user_count
+    _stopping_user_count = environment.runner.user_count
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    """Returns the device ids leased by this process to the queue and saves the run results."""
+    close_lease_pools()
+    if _run_recorder is None:
+        return
+    try:
+        storage_connection_string = read_parameters(config.PARAMS_SOURCE == "keyvault")[0]
+        storage = StorageService(storage_connection_string)
+        # Workers save their devices, the master (or the single process) the aggregated statistics
+        if not isinstance(environment.runner, MasterRunner):
+            _run_recorder.save_devices(storage)
+        if not isinstance(environment.runner, WorkerRunner):
+            _run_recorder.save_summary(storage, environment.stats, _stopping_user_count)
+    except Exception as e:
+        logging.error(f"Error saving the run results: {e}")
+
+
 # ------------------ Locust IoTDeviceUser ------------------ #
 class IoTDeviceUser(User):
+    abstract = config.MQTT_ENGINE != "paho"
     wait_time = between(5, 10)
 
     def __init__(self, environment):
@@ -78,25 +290,15 @@ class IoTDeviceUser(User):
         self.device_id = None
         self.device_key = None
         self.device_client = None
+        self.message_pool = get_pool(config.MESSAGE_PROFILE)
+        self.topic = None
+        self.sequence = 0
         self.params_from_key_vault = config.PARAMS_SOURCE == "keyvault"
 
     def on_start(self):
         """At the start of the test, each worker acquires a unique device."""
-        if self.params_from_key_vault:
-            # Read secrets from Key Vault
-            kv_service = KeyVaultService(config.KEY_VAULT_NAME)
-            self.storage_connection_string = kv_service.get_secret(config.STORAGE_CONNECTION_STRING_SECRET_NAME)
-            self.iothub_connection_string = kv_service.get_secret(config.IOTHUB_CONNECTION_STRING_SECRET_NAME)
-            iothub_hostname = kv_service.get_secret(config.IOTHUB_HOSTNAME_SECRET_NAME)
-            iothub_proxy = kv_service.get_secret(config.IOTHUB_PROXYNAME_SECRET_NAME)
-            certificate = kv_service.get_certificate_path(config.PROXY_CERTIFICATE_SECRET_NAME)
-        else:
-            # Read secret from config file
-            self.storage_connection_string = config.STORAGE_CONNECTION_STRING_SECRET_VALUE
-            self.iothub_connection_string = config.IOTHUB_CONNECTION_STRING_SECRET_VALUE
-            iothub_hostname = config.IOTHUB_HOSTNAME_SECRET_VALUE
-            iothub_proxy = config.IOTHUB_PROXYNAME_SECRET_VALUE
-            certificate = config.PROXY_CERTIFICATE_SECRET_VALUE
+        (self.storage_connection_string, self.iothub_connection_string,
+         iothub_hostname, iothub_proxy, certificate) = read_parameters(self.params_from_key_vault)
 
         self.storage_queue_name = config.STORAGE_QUEUE_NAME
 
@@ -105,17 +307,24 @@ class IoTDeviceUser(User):
 
         # Provision device
         self.device_key = provision_device(self.iothub_connection_string, self.device_id)
+        self.topic = self.message_pool.topic(self.device_id)
 
-        # Generate SAS Token
-        sas_token = SasTokenService().generate_sas_token(iothub_hostname, self.device_id, self.device_key)
+        # Generate SAS Token, renewed in the background before it expires
+        sas_token = register_device_token(iothub_hostname, {self.device_id: self.device_key},
+                                          lambda device_id, token: self.device_client.update_password(token))[self.device_id]
 
         # Connect to MQTT Sever
-        username = f"{iothub_hostname}/{self.device_id}/?api-version=2021-04-12"
+        username = mqtt_username(iothub_hostname, self.device_id)
         self.device_client = MqttClient(client_id=self.device_id,
                                         mqtt_server=iothub_proxy,
                                         username=username,
                                         password=sas_token,
-                                        ca_certs=certificate)
+                                        ca_certs=certificate,
+                                        request_event=self.environment.events.request,
+                                        publish_timeout=config.PUBLISH_TIMEOUT,
+                                        reconnect_policy=new_reconnect_policy(),
+                                        device_bound=config.DEVICE_BOUND_ENABLED,
+                                        trace=get_trace_recorder())
         self.device_client.connect()
 
     def on_stop(self):
@@ -127,6 +336,7 @@ class IoTDeviceUser(User):
                 pass
 
         if getattr(self, "device_id", None):
+            unregister_device_token(self.device_id)
             try:
                 release_device(self.storage_connection_string, self.storage_queue_name, self.iothub_connection_string, self.device_id)
             except Exception:
@@ -136,11 +346,63 @@ class IoTDeviceUser(User):
     def send_message(self):
         if self.device_client:
             try:
-                promoted_properties = ""
-                payload = {"Temperature": round(random.uniform(20, 25), 1)}
-                if promoted_properties:
-                    self.device_client.publish(f"devices/{self.device_id}/messages/events/{promoted_properties}", json.dumps(payload))
-                else:
-                    self.device_client.publish(f"devices/{self.device_id}/messages/events", json.dumps(payload))
+                # Pre-encoded body of the message profile, stamped with the send time (epoch ms)
+                # and the per-device sequence number for the latency and loss analytics of consumer.py
+                self.sequence += 1
+                self.device_client.publish(self.topic, self.message_pool.payload(self.sequence))
             except Exception as e:
-                logging.error(f"Error sending message: {e}")
\ No newline at end of file
+                logging.error(f"Error sending message: {e}")
+
+
+# ------------------ Locust IoTDeviceFleetUser ------------------ #
+class IoTDeviceFleetUser(User):
+    """Owns DEVICES_PER_USER devices, all driven by the process-wide asyncio MQTT engine."""
+    abstract = config.MQTT_ENGINE != "asyncio"
+    wait_time = constant(30)
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        self.storage_connection_string = None
+        self.iothub_connection_string = None
+        self.storage_queue_name = None
+        self.device_ids = []
+        self.engine = None
+        self.params_from_key_vault = config.PARAMS_SOURCE == "keyvault"
+
+    def on_start(self):
+        """At the start of the test, each user acquires DEVICES_PER_USER unique devices."""
+        (self.storage_connection_string, self.iothub_connection_string,
+         iothub_hostname, iothub_proxy, certificate) = read_parameters(self.params_from_key_vault)
+        self.storage_queue_name = config.STORAGE_QUEUE_NAME
+        self.engine = get_fleet_engine(iothub_proxy, certificate, self.environment.events.request)
+
+        device_keys = {}
+        for _ in range(config.DEVICES_PER_USER):
+            device_id = acquire_device_id(self.storage_connection_string, self.storage_queue_name)
+            device_keys[device_id] = provision_device(self.iothub_connection_string, device_id)
+            self.device_ids.append(device_id)
+
+        # Sign all the SAS tokens in one batch, renewed in the background before they expire
+        sas_tokens = register_device_token(iothub_hostname, device_keys, self.engine.update_password)
+        for device_id, sas_token in sas_tokens.items():
+            self.engine.add_device(DeviceSession(client_id=device_id,
+                                                 username=mqtt_username(iothub_hostname, device_id),
+                                                 password=sas_token))
+
+    def on_stop(self):
+        """At the end, close the device sessions and release the devices."""
+        for device_id in self.device_ids:
+            unregister_device_token(device_id)
+            if self.engine:
+                self.engine.remove_device(device_id)
+            try:
+                release_device(self.storage_connection_string, self.storage_queue_name, self.iothub_connection_string, device_id)
+            except Exception:
+                pass
+        self.device_ids = []
+
+    @task
+    def report_sessions(self):
+        """Publishing is scheduled by the engine; the user only reports the fleet state."""
+        if self.engine:
+            logging.info(f"📶 {self.engine.connected_count()} of {len(self.engine.sessions)} devices connected")
@@ -0,0 +1,105 @@
+import logging
+import subprocess
+import time
+
+import gevent
+from locust import LoadTestShape, events
+from locust.runners import MasterRunner
+
+import locustfile
+from mqtt.request_stats import RequestReporter, RECONNECT, RECOVERY_NAME
+from utils import config
+
+OUTAGE_MESSAGE = "proxy_outage"
+
+# MqttClient of every ProxyOutageUser of this process
+_clients = set()
+
+
+class ProxyOutageError(Exception):
+    """The devices did not get back to full connectivity within OUTAGE_RECOVERY_TIMEOUT."""
+
+
+def _all_connected() -> bool:
+    return all(client.is_connected() for client in list(_clients))
+
+
+def _measure_recovery(environment, started: float):
+    """Waits for the devices to drop, then reports the time until all of them are connected again."""
+    reporter = RequestReporter(environment.events.request)
+    deadline = time.monotonic() + config.OUTAGE_RECOVERY_TIMEOUT
+    while _all_connected():
+        if time.monotonic() > deadline:
+            logging.warning("⚡ Proxy outage: no device was disconnected")
+            return
+        gevent.sleep(0.1)
+    while not _all_connected():
+        if time.monotonic() > deadline:
+            connected = sum(1 for client in list(_clients) if client.is_connected())
+            reporter.failure(RECONNECT, RECOVERY_NAME, (time.perf_counter() - started) * 1000,
+                             ProxyOutageError(f"{connected} of {len(_clients)} connected"), len(_clients))
+            return
+        gevent.sleep(0.1)
+    recovery_time = (time.perf_counter() - started) * 1000
+    reporter.success(RECONNECT, RECOVERY_NAME, recovery_time, len(_clients))
+    logging.info(f"⚡ Proxy outage: {len(_clients)} devices connected again after {recovery_time / 1000:.1f}s")
+
+
+def on_proxy_outage(environment, msg, **kwargs):
+    """Runs on every worker (or the local runner) when the shape triggers an outage."""
+    started = time.perf_counter()
+    if not msg.data["command"]:
+        # No real outage: every device loses its connection at once, like on a proxy restart
+        for client in list(_clients):
+            client.drop_connection()
+    gevent.spawn(_measure_recovery, environment, started)
+
+
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    if not isinstance(environment.runner, MasterRunner):
+        environment.runner.register_message(OUTAGE_MESSAGE, on_proxy_outage)
+
+
+# ------------------ Locust ProxyOutageUser ------------------ #
+class ProxyOutageUser(locustfile.IoTDeviceUser):
+    """IoTDeviceUser (paho client, reconnect policy from config.py) tracked for the outage recovery."""
+    abstract = False
+
+    def on_start(self):
+        super().on_start()
+        _clients.add(self.device_client)
+
+    def on_stop(self):
+        _clients.discard(self.device_client)
+        super().on_stop()
+
+
+class ProxyOutageShape(LoadTestShape):
+    """
+    Ramps up to OUTAGE_USERS, then triggers OUTAGE_COUNT proxy outages OUTAGE_INTERVAL seconds apart.
+    An outage runs OUTAGE_COMMAND on the master or, without it, makes every device drop its connection.
+    The statistics show the reconnect attempts per second (RECONNECT attempt), the downtime per device
+    and the time until every device of a worker is connected again (RECONNECT full recovery).
+    """
+
+    def __init__(self):
+        super().__init__()
+        ramp_up = config.OUTAGE_USERS / config.OUTAGE_SPAWN_RATE
+        self.outage_times = [ramp_up + config.OUTAGE_INTERVAL * (i + 1) for i in range(config.OUTAGE_COUNT)]
+        self.end_time = ramp_up + config.OUTAGE_INTERVAL * (config.OUTAGE_COUNT + 1)
+
+    def tick(self):
+        run_time = self.get_run_time()
+        if run_time >= self.end_time:
+            return None
+        if self.outage_times and run_time >= self.outage_times[0]:
+            self.outage_times.pop(0)
+            self._trigger_outage()
+        return config.OUTAGE_USERS, config.OUTAGE_SPAWN_RATE
+
+    def _trigger_outage(self):
+        logging.info(f"⚡ Proxy outage: {config.OUTAGE_COMMAND or 'dropping every device connection'}")
+        if config.OUTAGE_COMMAND:
+            subprocess.Popen(config.OUTAGE_COMMAND, shell=True)
+        self.runner.send_message(OUTAGE_MESSAGE, {"command": bool(config.OUTAGE_COMMAND)})
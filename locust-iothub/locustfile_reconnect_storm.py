@@ -0,0 +1,94 @@
+import logging
+import time
+
+import gevent
+from locust import events
+
+import locustfile
+from utils import config
+
+# Request type and name of the storm recovery time in the Locust statistics
+STORM = "STORM"
+RECOVERY_NAME = "full connectivity"
+
+
+class ReconnectStormError(Exception):
+    """The devices did not get back to full connectivity within STORM_RECOVERY_TIMEOUT."""
+
+
+_storm_greenlet = None
+
+
+def _wait_for_recovery(engine, expected: int, handshakes_before: int, timeout: float) -> bool:
+    """Waits until every device has done a new handshake and is connected again."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        full, resumed = engine.handshake_counts()
+        if full + resumed - handshakes_before >= expected and engine.connected_count() >= expected:
+            return True
+        gevent.sleep(0.1)
+    return False
+
+
+def run_storm(engine, request_event) -> dict:
+    """Drops every connection of the engine at once and measures how the fleet comes back."""
+    expected = engine.connected_count()
+    full_before, resumed_before = engine.handshake_counts()
+    start = time.perf_counter()
+    engine.reconnect_all()
+    recovered = _wait_for_recovery(engine, expected, full_before + resumed_before, config.STORM_RECOVERY_TIMEOUT)
+    recovery_time = (time.perf_counter() - start) * 1000
+
+    full, resumed = engine.handshake_counts()
+    full -= full_before
+    resumed -= resumed_before
+    request_event.fire(request_type=STORM, name=RECOVERY_NAME, response_time=recovery_time, response_length=expected,
+                       exception=None if recovered else ReconnectStormError(f"{engine.connected_count()} of {expected} connected"),
+                       context={})
+    result = {
+        "devices": expected,
+        "recovered": recovered,
+        "recovery_seconds": round(recovery_time / 1000, 2),
+        "full_handshakes": full,
+        "resumed_handshakes": resumed,
+        "resumed_ratio": round(resumed / (full + resumed), 3) if full + resumed else 0.0,
+    }
+    logging.info(f"🌩️ Reconnect storm: {result}")
+    return result
+
+
+def _storm_loop(user):
+    engine = user.engine
+    while True:
+        gevent.sleep(config.STORM_INTERVAL)
+        # Storm only a settled fleet, so the recovery time is not mixed with the ramp-up
+        if not engine.sessions or engine.connected_count() < len(engine.sessions):
+            logging.info("🌩️ Reconnect storm postponed, the fleet is not fully connected")
+            continue
+        run_storm(engine, user.environment.events.request)
+
+
+# ------------------ Locust ReconnectStormUser ------------------ #
+class ReconnectStormUser(locustfile.IoTDeviceFleetUser):
+    """
+    Fleet of devices on the asyncio engine that, every STORM_INTERVAL seconds, drops all its
+    connections at once like a proxy restart does. Each storm reports the time back to full
+    connectivity (STORM "full connectivity") and the resumed vs full handshakes
+    (TLS "handshake (resumed)" vs TLS "handshake").
+    """
+    abstract = False
+
+    def on_start(self):
+        global _storm_greenlet
+        super().on_start()
+        # One storm controller per Locust process, all its users share the same engine
+        if _storm_greenlet is None:
+            _storm_greenlet = gevent.spawn(_storm_loop, self)
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    global _storm_greenlet
+    if _storm_greenlet is not None:
+        _storm_greenlet.kill(block=False)
+        _storm_greenlet = None
@@ -0,0 +1,147 @@
+import logging
+import os
+
+import gevent
+from locust import User, task, constant, events
+
+import locustfile
+from mqtt.async_mqtt_engine import AsyncMqttEngine, DeviceSession
+from mqtt.traffic_trace import open_traces, merge_events
+from utils import config
+from utils.latency_histogram import LatencyHistogram
+
+# Request type and name of the replay timing in the Locust statistics
+REPLAY = "REPLAY"
+DRIFT_NAME = "drift"
+# Seconds between two drift reports (p99 of the interval)
+DRIFT_INTERVAL = 1
+
+
+class TraceReplay:
+    """
+    Replays the traces recorded with TRACE_RECORD_FILE on a dedicated asyncio engine: the devices connect,
+    publish payloads of the recorded sizes and disconnect at the recorded times, REPLAY_SPEED times faster.
+    The devices of the traces are split across the workers (WORKER_INDEX of WORKER_COUNT, set by
+    run_locust_workers.py), so every run sends exactly the same traffic.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.readers = open_traces(config.REPLAY_TRACE_FILES)
+        device_ids = sorted({device_id for reader in self.readers for device_id in reader.device_ids})
+        index = int(os.environ.get("WORKER_INDEX", 0))
+        count = int(os.environ.get("WORKER_COUNT", 1))
+        self.devices = set(device_ids[index::count])
+        self.drift = LatencyHistogram()
+        self.future = None
+        self._reporter = None
+        self._tokens = {}
+        self._usernames = {}
+
+        (_, iothub_connection_string, iothub_hostname, iothub_proxy,
+         certificate) = locustfile.read_parameters(config.PARAMS_SOURCE == "keyvault")
+        # No publish schedule and no reconnect policy: the traces decide when devices publish and reconnect
+        self.engine = AsyncMqttEngine(mqtt_server=iothub_proxy,
+                                      ca_certs=certificate,
+                                      keepalive=config.MQTT_KEEPALIVE,
+                                      publish_interval=None,
+                                      max_concurrent_connects=config.MAX_CONCURRENT_CONNECTS,
+                                      request_event=environment.events.request,
+                                      publish_timeout=config.PUBLISH_TIMEOUT,
+                                      device_bound=config.DEVICE_BOUND_ENABLED)
+        self.engine.start()
+
+        # Keys and tokens of all the devices up front: a connect event must not wait for them
+        device_keys = {device_id: locustfile.provision_device(iothub_connection_string, device_id)
+                       for device_id in self.devices}
+        self._tokens.update(locustfile.register_device_token(iothub_hostname, device_keys, self._token_renewed))
+        self._usernames = {device_id: locustfile.mqtt_username(iothub_hostname, device_id) for device_id in self.devices}
+
+        records = sum(len(reader) for reader in self.readers)
+        duration = max(reader.duration() for reader in self.readers)
+        logging.info(f"⏯️ Replaying {len(self.readers)} trace(s), {records} events over {duration / 60:.1f} min, "
+                     f"{len(self.devices)} of {len(device_ids)} devices in this process, speed x{config.REPLAY_SPEED}")
+
+    def _token_renewed(self, device_id: str, token: str):
+        self._tokens[device_id] = token
+        self.engine.update_password(device_id, token)
+
+    def _make_session(self, device_id: str) -> DeviceSession:
+        return DeviceSession(client_id=device_id, username=self._usernames[device_id], password=self._tokens[device_id])
+
+    def start(self):
+        events_ = merge_events(self.readers, self.devices)
+        self.future = self.engine.replay(events_, self._make_session, config.REPLAY_SPEED)
+        self._reporter = gevent.spawn(self._report_drift)
+
+    def _report_drift(self):
+        while True:
+            gevent.sleep(DRIFT_INTERVAL)
+            histogram = self.engine.take_replay_drift()
+            if histogram.total:
+                self.drift.merge(histogram)
+                self.environment.events.request.fire(request_type=REPLAY, name=DRIFT_NAME,
+                                                     response_time=histogram.percentile(99),
+                                                     response_length=histogram.total, exception=None, context={})
+            if self.future.done():
+                return
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def stop(self):
+        if self.future and not self.future.done():
+            self.future.cancel()
+        if self._reporter:
+            self._reporter.kill(block=False)
+        self.engine.stop()
+        for reader in self.readers:
+            reader.close()
+
+
+_replay = None
+# Set before the replay is built: the construction yields to gevent (Key Vault, provisioning), the users
+# starting meanwhile must not build a second replay
+_replay_starting = False
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    global _replay, _replay_starting
+    if _replay is not None:
+        _replay.stop()
+        _replay = None
+    _replay_starting = False
+
+
+# ------------------ Locust TraceReplayUser ------------------ #
+class TraceReplayUser(User):
+    """
+    Starts the replay of the recorded traces, once per Locust process whatever the number of users,
+    and reports its progress. The statistics show the replay drift (REPLAY drift, p99 of each second):
+    a drift growing over the run means the generator cannot keep the recorded pace.
+    """
+    wait_time = constant(10)
+
+    def on_start(self):
+        global _replay, _replay_starting
+        if _replay_starting:
+            return
+        _replay_starting = True
+        try:
+            replay = TraceReplay(self.environment)
+        except Exception:
+            _replay_starting = False
+            raise
+        replay.start()
+        _replay = replay
+
+    @task
+    def report_replay(self):
+        if _replay is None:
+            return
+        if _replay.done():
+            if not _replay.future.cancelled():
+                logging.info(f"⏹️ Replay finished: {_replay.future.result()} events, drift ms {_replay.drift.summary()}")
+            return
+        logging.info(f"⏯️ {_replay.engine.connected_count()} devices connected, drift ms {_replay.drift.summary()}")
@@ -0,0 +1,449 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import random
+import struct
+import threading
+import time
+
+from mqtt import mqtt_packets, traffic_trace
+from mqtt.device_bound import DeviceBoundHandler, subscriptions
+from mqtt.request_stats import (RequestReporter, PublishTracker, ConnectError,
+                                TLS_HANDSHAKE, CONNECT, RECONNECT, HANDSHAKE_NAME, RESUMED_HANDSHAKE_NAME,
+                                CONNACK_NAME, RECONNECT_ATTEMPT_NAME, DOWNTIME_NAME)
+from mqtt.tls_session import get_client_context
+from utils.latency_histogram import LatencyHistogram
+
+# Period of the loop lag probe: the lag is how late the probe wakes up
+LAG_PROBE_INTERVAL = 0.1
+# Malformed packets (bad remaining length, truncated or non UTF-8 topic) received from the proxy
+PROTOCOL_ERRORS = (ValueError, struct.error)
+# Disconnect code of a protocol error, as paho's MQTT_ERR_PROTOCOL
+RC_PROTOCOL_ERROR = 2
+
+
+class DeviceSession:
+    """State of a single simulated device driven by the AsyncMqttEngine."""
+
+    def __init__(self, client_id: str, username: str, password: str, topic: str = None):
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.topic = topic or f"devices/{client_id}/messages/events"
+        self.context = {"device_id": client_id}     # passed to the Locust request listeners
+        self.connected = False
+        self.closed = False
+        self.reconnect_requested = False
+        self.reader = None
+        self.writer = None
+        self.last_sent = 0.0
+        self.sequence = 0
+        # Bumped on every connect: publish entries of a previous connection are dropped when they pop
+        self.schedule_generation = 0
+        self._packet_id = 0
+
+    def next_packet_id(self) -> int:
+        self._packet_id = self._packet_id % 65535 + 1
+        return self._packet_id
+
+    def send(self, data: bytes):
+        self.writer.write(data)
+        self.last_sent = time.monotonic()
+
+
+def temperature_payload(session: DeviceSession):
+    """Default payload factory, same body as IoTDeviceUser.send_message."""
+    session.sequence += 1
+    payload = {"Temperature": round(random.uniform(20, 25), 1), "ts": int(time.time() * 1000), "seq": session.sequence}
+    return session.topic, json.dumps(payload).encode("utf-8")
+
+
+class AsyncMqttEngine:
+    """
+    Drives many MQTT device sessions from a single asyncio event loop.
+
+    Every device owns a non-blocking TLS connection, while keepalive and publish
+    schedules are handled by two shared timers instead of one thread per device.
+    Without publish_interval the devices only publish what replay() tells them.
+    The loop runs in a background thread (a greenlet when gevent has patched
+    threading, as in Locust), and the public methods are safe to call from it.
+    """
+
+    def __init__(self, mqtt_server: str, ca_certs: str = None, port: int = 8883, keepalive: int = 60,
+                 publish_interval: tuple = (5, 10), payload_factory=temperature_payload,
+                 connect_timeout: float = 30, max_concurrent_connects: int = 200,
+                 request_event=None, publish_timeout: float = 30, reconnect_policy=None,
+                 device_bound: bool = False, trace: traffic_trace.TraceRecorder = None):
+        self.mqtt_server = mqtt_server
+        self.port = port
+        self.keepalive = keepalive
+        self.publish_interval = publish_interval
+        self.payload_factory = payload_factory
+        self.connect_timeout = connect_timeout
+        self.max_concurrent_connects = max_concurrent_connects
+        # Callable returning a new ReconnectPolicy per device; without it dropped devices are not reconnected
+        self.reconnect_policy = reconnect_policy
+        self.sessions = {}
+        self.reporter = RequestReporter(request_event)
+        self.publish_tracker = PublishTracker(self.reporter, timeout=publish_timeout)
+        # C2D messages, twin and direct methods; without it only telemetry flows
+        self.device_bound = DeviceBoundHandler(self.reporter, publish_timeout) if device_bound else None
+        # Connect, publish and disconnect events recorded for a later replay
+        self.trace = trace
+
+        self._ssl_context = get_client_context(ca_certs)
+        self._publish_heap = []
+        self._counter = itertools.count()
+        self._loop = None
+        self._thread = None
+        self._connect_limit = None
+        self._timers = []
+        self._loop_lag = LatencyHistogram()
+        self._replay_drift = LatencyHistogram()
+
+    def start(self):
+        if self._thread:
+            return
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="mqtt-engine", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._shutdown)
+
+    def add_device(self, session: DeviceSession):
+        self._loop.call_soon_threadsafe(self._add_device, session)
+
+    def remove_device(self, client_id: str):
+        self._loop.call_soon_threadsafe(self._remove_device, client_id)
+
+    def update_password(self, client_id: str, password: str):
+        """Applies a renewed SAS token, reconnecting the device with it."""
+        self._loop.call_soon_threadsafe(self._update_password, client_id, password)
+
+    def reconnect_all(self):
+        """Drops every connection at once and reconnects the devices, like after a proxy restart."""
+        self._loop.call_soon_threadsafe(self._reconnect_all)
+
+    def handshake_counts(self) -> tuple:
+        """Returns (full, resumed) TLS handshakes of the process."""
+        return self._ssl_context.handshake_counts()
+
+    def connected_count(self) -> int:
+        return sum(1 for session in list(self.sessions.values()) if session.connected)
+
+    def take_loop_lag(self) -> LatencyHistogram:
+        """Returns the event loop lag recorded since the previous call."""
+        histogram, self._loop_lag = self._loop_lag, LatencyHistogram()
+        return histogram
+
+    def replay(self, events, make_session, speed: float = 1.0):
+        """
+        Replays (time, event, device_id, size) events of a traffic trace from the event loop, speed times
+        faster than recorded; make_session(device_id) returns the DeviceSession of a connect event.
+        Returns a concurrent.futures.Future of the number of events replayed.
+        """
+        return asyncio.run_coroutine_threadsafe(self._replay(events, make_session, speed), self._loop)
+
+    def take_replay_drift(self) -> LatencyHistogram:
+        """Returns how late the replayed events were run, since the previous call."""
+        histogram, self._replay_drift = self._replay_drift, LatencyHistogram()
+        return histogram
+
+    def publish_backlog(self) -> dict:
+        """Publishes waiting for their PUBACK, publishes past their due time and bytes not yet written to the sockets."""
+        now = time.monotonic()
+        sessions = list(self.sessions.values())
+        return {
+            "in_flight": len(self.publish_tracker),
+            "overdue": sum(1 for due, _, _, _ in list(self._publish_heap) if due < now - 1),
+            "write_buffer_bytes": sum(session.writer.transport.get_write_buffer_size()
+                                      for session in sessions if session.connected and session.writer),
+        }
+
+    # Event loop side
+    def _run(self, ready: threading.Event):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._connect_limit = asyncio.Semaphore(self.max_concurrent_connects)
+        self._timers = [self._loop.create_task(self._publish_scheduler()),
+                        self._loop.create_task(self._keepalive_ticker()),
+                        self._loop.create_task(self._lag_probe())]
+        ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def _shutdown(self):
+        for client_id in list(self.sessions):
+            self._remove_device(client_id)
+        for timer in self._timers:
+            timer.cancel()
+        self._loop.call_later(1, self._loop.stop)
+
+    def _add_device(self, session: DeviceSession):
+        self.sessions[session.client_id] = session
+        self._loop.create_task(self._run_session(session))
+
+    def _remove_device(self, client_id: str):
+        session = self.sessions.pop(client_id, None)
+        if session is None:
+            return
+        session.closed = True
+        if session.writer:
+            if session.connected:
+                session.send(mqtt_packets.DISCONNECT_PACKET)
+            session.writer.close()
+
+    def _update_password(self, client_id: str, password: str):
+        session = self.sessions.get(client_id)
+        if session is None:
+            return
+        session.password = password
+        if session.connected:
+            self._request_reconnect(session)
+
+    def _reconnect_all(self):
+        for session in list(self.sessions.values()):
+            if session.connected:
+                self._request_reconnect(session)
+
+    @staticmethod
+    def _request_reconnect(session: DeviceSession):
+        session.reconnect_requested = True
+        session.send(mqtt_packets.DISCONNECT_PACKET)
+        session.writer.close()
+
+    async def _run_session(self, session: DeviceSession):
+        policy = self.reconnect_policy() if self.reconnect_policy else None
+        disconnected_at = None
+        delay = 0.0
+        while True:
+            try:
+                if self.trace:
+                    self.trace.record(traffic_trace.CONNECT, session.client_id)
+                connected = await self._connect(session)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, *PROTOCOL_ERRORS) as e:
+                logging.error(f"[{session.client_id}] Error connecting: {e}")
+                connected = False
+            if not connected and self.trace:
+                self.trace.record(traffic_trace.DISCONNECT, session.client_id)
+            if disconnected_at is not None:
+                if connected:
+                    self.reporter.success(RECONNECT, RECONNECT_ATTEMPT_NAME, delay * 1000, context=session.context)
+                    self.reporter.success(RECONNECT, DOWNTIME_NAME, (time.perf_counter() - disconnected_at) * 1000,
+                                          context=session.context)
+                    disconnected_at = None
+                else:
+                    self.reporter.failure(RECONNECT, RECONNECT_ATTEMPT_NAME, delay * 1000,
+                                          ConnectError("connection failed"), context=session.context)
+            if connected:
+                if policy:
+                    policy.reset()
+                await self._read_loop(session)
+                if session.closed:
+                    return
+                if session.reconnect_requested:
+                    session.reconnect_requested = False
+                    continue
+            elif session.writer:
+                session.writer.close()
+            if policy is None or session.closed:
+                # A replayed connect may already have replaced the session of this device
+                if not connected and self.sessions.get(session.client_id) is session:
+                    del self.sessions[session.client_id]
+                return
+            if disconnected_at is None:
+                disconnected_at = time.perf_counter()
+            delay = policy.next_delay()
+            await asyncio.sleep(delay)
+            if session.closed:
+                return
+
+    async def _connect(self, session: DeviceSession) -> bool:
+        async with self._connect_limit:
+            start = time.perf_counter()
+            try:
+                session.reader, session.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.mqtt_server, self.port, ssl=self._ssl_context,
+                                            server_hostname=self.mqtt_server),
+                    self.connect_timeout
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                self.reporter.failure(TLS_HANDSHAKE, HANDSHAKE_NAME, (time.perf_counter() - start) * 1000, e,
+                                      context=session.context)
+                raise
+            connect_started = time.perf_counter()
+            ssl_object = session.writer.get_extra_info("ssl_object")
+            self.reporter.success(TLS_HANDSHAKE, RESUMED_HANDSHAKE_NAME if ssl_object.session_reused else HANDSHAKE_NAME,
+                                  (connect_started - start) * 1000, context=session.context)
+
+            session.send(mqtt_packets.encode_connect(session.client_id, session.username, session.password,
+                                                     self.keepalive))
+            try:
+                packet_type, _, body = await asyncio.wait_for(mqtt_packets.read_packet(session.reader),
+                                                              self.connect_timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, *PROTOCOL_ERRORS) as e:
+                self.reporter.failure(CONNECT, CONNACK_NAME, (time.perf_counter() - connect_started) * 1000, e,
+                                      context=session.context)
+                raise
+        # The TLS 1.3 session ticket has arrived along with the CONNACK
+        self._ssl_context.record(ssl_object)
+        rc = body[1] if packet_type == mqtt_packets.CONNACK else -1
+        response_time = (time.perf_counter() - connect_started) * 1000
+        if rc == 0:
+            self.reporter.success(CONNECT, CONNACK_NAME, response_time, context=session.context)
+        else:
+            self.reporter.failure(CONNECT, CONNACK_NAME, response_time, ConnectError(f"rc={rc}"),
+                                  context=session.context)
+        self._on_connect(session, rc)
+        if rc != 0 or session.closed:
+            return False
+        if self.device_bound:
+            session.send(mqtt_packets.encode_subscribe(session.next_packet_id(), subscriptions(session.client_id)))
+            self._send_answer(session, self.device_bound.get_twin(session.context))
+        session.schedule_generation += 1
+        self._schedule_publish(session, time.monotonic())
+        return True
+
+    async def _read_loop(self, session: DeviceSession):
+        rc = 0
+        try:
+            while True:
+                packet_type, flags, body = await mqtt_packets.read_packet(session.reader)
+                if packet_type == mqtt_packets.PUBACK:
+                    self._on_publish(session, mqtt_packets.decode_packet_id(body))
+                elif packet_type == mqtt_packets.PUBLISH:
+                    topic, packet_id, payload = mqtt_packets.decode_publish(flags, body)
+                    if packet_id:
+                        session.send(mqtt_packets.encode_puback(packet_id))
+                    if self.device_bound:
+                        for answer in self.device_bound.handle(topic, payload, session.context):
+                            self._send_answer(session, answer)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            if not session.closed and not session.reconnect_requested:
+                rc = getattr(e, "errno", None) or 1
+        except PROTOCOL_ERRORS as e:
+            logging.error(f"[{session.client_id}] Protocol error: {e!r}")
+            rc = RC_PROTOCOL_ERROR
+        finally:
+            session.connected = False
+            if session.writer:
+                session.writer.close()
+            if self.trace:
+                self.trace.record(traffic_trace.DISCONNECT, session.client_id)
+            self._on_disconnect(session, rc)
+
+    def _schedule_publish(self, session: DeviceSession, now: float):
+        if self.publish_interval is None:
+            return
+        due = now + random.uniform(*self.publish_interval)
+        heapq.heappush(self._publish_heap, (due, next(self._counter), session.schedule_generation, session))
+
+    async def _publish_scheduler(self):
+        """Shared publish timer: a single heap ordered by next due time for every session."""
+        last_expire = 0.0
+        while True:
+            now = time.monotonic()
+            if now - last_expire >= 1.0:
+                self.publish_tracker.expire()
+                if self.device_bound:
+                    self.device_bound.expire()
+                last_expire = now
+            while self._publish_heap and self._publish_heap[0][0] <= now:
+                _, _, generation, session = heapq.heappop(self._publish_heap)
+                if not session.connected or session.closed or generation != session.schedule_generation:
+                    continue
+                try:
+                    self._publish(session)
+                except Exception as e:
+                    logging.error(f"[{session.client_id}] Error sending message: {e}")
+                self._schedule_publish(session, now)
+            delay = self._publish_heap[0][0] - now if self._publish_heap else 1.0
+            await asyncio.sleep(min(max(delay, 0), 1.0))
+
+    async def _keepalive_ticker(self):
+        """Shared keepalive timer: pings only the sessions that have been idle on the wire."""
+        interval = max(self.keepalive / 4, 1)
+        while True:
+            await asyncio.sleep(interval)
+            idle_since = time.monotonic() - self.keepalive * 0.75
+            for session in list(self.sessions.values()):
+                if session.connected and session.last_sent < idle_since:
+                    session.send(mqtt_packets.PINGREQ_PACKET)
+
+    async def _lag_probe(self):
+        """Records how late the loop runs a sleeping task: callbacks and TLS work holding it up."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            self._loop_lag.record((time.perf_counter() - start - LAG_PROBE_INTERVAL) * 1000)
+
+    @staticmethod
+    def _send_answer(session: DeviceSession, answer: tuple):
+        """Twin requests and method responses go at QoS 0: the twin response is the acknowledgement."""
+        topic, payload = answer
+        session.send(mqtt_packets.encode_publish(topic, payload, qos=0))
+
+    def _publish(self, session: DeviceSession):
+        topic, payload = self.payload_factory(session)
+        self._send_publish(session, topic, payload)
+
+    def _send_publish(self, session: DeviceSession, topic: str, payload: bytes):
+        packet_id = session.next_packet_id()
+        session.send(mqtt_packets.encode_publish(topic, payload, packet_id))
+        self.publish_tracker.sent((session.client_id, packet_id), len(payload), session.context)
+        if self.trace:
+            self.trace.record(traffic_trace.PUBLISH, session.client_id, len(payload))
+
+    async def _replay(self, events, make_session, speed: float) -> int:
+        started = time.monotonic()
+        first = None
+        replayed = 0
+        for timestamp, event, device_id, size in events:
+            if first is None:
+                first = timestamp
+            due = started + (timestamp - first) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif replayed % 256 == 0:
+                # Behind schedule: still let the connections and the other timers run
+                await asyncio.sleep(0)
+            self._replay_drift.record((time.monotonic() - due) * 1000)
+            replayed += 1
+            if event == traffic_trace.CONNECT:
+                if device_id in self.sessions:
+                    self._remove_device(device_id)
+                self._add_device(make_session(device_id))
+            elif event == traffic_trace.DISCONNECT:
+                self._remove_device(device_id)
+            elif event == traffic_trace.PUBLISH:
+                session = self.sessions.get(device_id)
+                if session is None or not session.connected:
+                    # Still connecting, or its connection failed: counted like a publish of a disconnected client
+                    self.publish_tracker.dropped(size, context={"device_id": device_id})
+                    continue
+                session.sequence += 1
+                self._send_publish(session, session.topic, traffic_trace.sized_payload(session.sequence, size))
+        return replayed
+
+    # Callbacks
+    def _on_connect(self, session: DeviceSession, rc: int):
+        session.connected = (rc == 0)
+        if rc == 0:
+            logging.info(f"[{session.client_id}] ➡️ Connected, rc={rc}")
+        else:
+            logging.error(f"[{session.client_id}] ❌ Connection failed, rc={rc}")
+
+    def _on_disconnect(self, session: DeviceSession, rc: int):
+        logging.info(f"[{session.client_id}] 🔌 Disconnected rc={rc}")
+
+    def _on_publish(self, session: DeviceSession, mid: int):
+        self.publish_tracker.acked((session.client_id, mid))
+        logging.debug(f"[{session.client_id}] 📤 Message {mid} published")
@@ -0,0 +1,111 @@
+import itertools
+import json
+import time
+import urllib.parse
+
+from mqtt.request_stats import (RequestReporter, PublishTracker, RequestRejectedError, TWIN, DOWNSTREAM,
+                                TWIN_GET_NAME, TWIN_PATCH_NAME, C2D_NAME, DESIRED_NAME, METHOD_NAME)
+from utils.message_profiles import parse_stamp
+
+# IoT Hub MQTT topics of the cloud-to-device traffic
+TWIN_RESPONSE_PREFIX = "$iothub/twin/res/"
+DESIRED_PATCH_PREFIX = "$iothub/twin/PATCH/properties/desired/"
+METHOD_PREFIX = "$iothub/methods/POST/"
+
+
+def subscriptions(device_id: str) -> list:
+    """Topic filters a device subscribes to after the CONNACK, as the device SDKs do."""
+    return [f"devices/{device_id}/messages/devicebound/#",
+            f"{TWIN_RESPONSE_PREFIX}#",
+            f"{DESIRED_PATCH_PREFIX}#",
+            f"{METHOD_PREFIX}#"]
+
+
+def _topic_parameters(topic: str) -> dict:
+    """Parameters after the "?" of a twin or method topic, e.g. {"$rid": "1", "$version": "4"}."""
+    query = topic.partition("?")[2]
+    return dict(urllib.parse.parse_qsl(query))
+
+
+class DeviceBoundHandler:
+    """
+    Device side of the cloud-to-device traffic: C2D messages, desired property patches and direct
+    methods, plus the twin GET and reported PATCH requests of the device. Shared by all the devices
+    of an MQTT engine (or owned by one MqttClient); the devices are told apart by their context.
+
+    The service stamps what it sends with its send time (ts, epoch ms, as the telemetry bodies), so
+    the downstream delivery latency is reported to Locust as DOWNSTREAM, next to the PUBLISH latency.
+    Twin requests are reported as TWIN, from the publish to the response of the hub.
+    """
+
+    def __init__(self, reporter: RequestReporter, timeout: float = 30):
+        self.reporter = reporter
+        self.twin_get = PublishTracker(reporter, timeout, TWIN_GET_NAME, TWIN)
+        self.twin_patch = PublishTracker(reporter, timeout, TWIN_PATCH_NAME, TWIN)
+        self._request_ids = itertools.count(1)
+        # (device id, $rid) -> tracker of the request: a response resolves only the request it answers
+        self._owners = {}
+
+    def get_twin(self, context: dict):
+        """Returns the (topic, payload) of a twin GET request, tracked until its response."""
+        rid = next(self._request_ids)
+        key = (context["device_id"], str(rid))
+        self.twin_get.sent(key, 0, context)
+        self._owners[key] = self.twin_get
+        return f"$iothub/twin/GET/?$rid={rid}", b""
+
+    def patch_reported(self, context: dict, reported: dict):
+        """Returns the (topic, payload) of a reported properties PATCH, tracked until its response."""
+        rid = next(self._request_ids)
+        payload = json.dumps(reported).encode("utf-8")
+        key = (context["device_id"], str(rid))
+        self.twin_patch.sent(key, len(payload), context)
+        self._owners[key] = self.twin_patch
+        return f"$iothub/twin/PATCH/properties/reported/?$rid={rid}", payload
+
+    def expire(self):
+        self.twin_get.expire()
+        self.twin_patch.expire()
+        for key, tracker in list(self._owners.items()):
+            if key not in tracker:
+                self._owners.pop(key, None)
+
+    def handle(self, topic: str, payload: bytes, context: dict) -> list:
+        """Handles a PUBLISH received by the device, returns the (topic, payload) answers to publish (QoS 0)."""
+        if topic.startswith(TWIN_RESPONSE_PREFIX):
+            status = topic[len(TWIN_RESPONSE_PREFIX):].split("/", 1)[0]
+            key = (context["device_id"], _topic_parameters(topic).get("$rid"))
+            tracker = self._owners.pop(key, None)
+            if tracker is None:
+                # Unknown or already expired request
+                return []
+            if status.startswith("2"):
+                tracker.acked(key)
+            else:
+                tracker.rejected(key, RequestRejectedError(f"status {status}"))
+            return []
+        if topic.startswith(DESIRED_PATCH_PREFIX):
+            self._downstream(DESIRED_NAME, payload, context)
+            # Acknowledge the configuration, as a device applying it would
+            try:
+                desired = json.loads(payload)
+            except ValueError:
+                desired = {}
+            return [self.patch_reported(context, {
+                "lastConfigurationApplied": desired.get("lastConfigurationChanged"),
+                "desiredVersion": desired.get("$version"),
+            })]
+        if topic.startswith(METHOD_PREFIX):
+            self._downstream(METHOD_NAME, payload, context)
+            rid = _topic_parameters(topic).get("$rid")
+            return [(f"$iothub/methods/res/200/?$rid={rid}", b'{"result": "ok"}')]
+        if "/messages/devicebound/" in topic:
+            self._downstream(C2D_NAME, payload, context)
+        return []
+
+    def _downstream(self, name: str, payload: bytes, context: dict):
+        stamp = parse_stamp(payload)
+        if stamp is None:
+            # Not sent by service_driver.py: no send time to measure the latency from
+            return
+        self.reporter.success(DOWNSTREAM, name, max(0.0, time.time() * 1000 - stamp[1]), len(payload), context)
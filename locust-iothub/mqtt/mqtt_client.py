@@ -1,54 +1,212 @@
 import paho.mqtt.client as mqtt
-import ssl
+import socket
+import threading
+import time
+import weakref
+
+from mqtt import traffic_trace
+from mqtt.device_bound import DeviceBoundHandler, subscriptions
+from mqtt.reconnect_policy import ReconnectPolicy, ExponentialBackoff
+from mqtt.request_stats import (RequestReporter, PublishTracker, ConnectError,
+                                TLS_HANDSHAKE, CONNECT, RECONNECT, HANDSHAKE_NAME, RESUMED_HANDSHAKE_NAME,
+                                CONNACK_NAME, RECONNECT_ATTEMPT_NAME, DOWNTIME_NAME)
+from mqtt.tls_session import get_client_context
+
+# Every MqttClient of the process, for the resource sampler
+_clients = weakref.WeakSet()
+
+
+def publish_backlog() -> dict:
+    """Publishes waiting for their PUBACK over all the clients of the process, and the clients still referenced."""
+    clients = list(_clients)
+    return {
+        "in_flight": sum(len(client.publish_tracker) for client in clients),
+        "clients": len(clients),
+    }
+
 
 class MqttClient:
-    def __init__(self, client_id: str, mqtt_server: str, username: str, password: str, ca_certs: str):
+    def __init__(self, client_id: str, mqtt_server: str, username: str, password: str, ca_certs: str,
+                 request_event=None, publish_timeout: float = 30, reconnect_policy: ReconnectPolicy = None,
+                 device_bound: bool = False, trace: traffic_trace.TraceRecorder = None):
         self.client_id = client_id
         self.mqtt_server = mqtt_server
         self.username = username
         self.password = password
         self.ca_certs = ca_certs
         self.connected = False
+        self.reporter = RequestReporter(request_event, {"device_id": client_id})
+        self.publish_tracker = PublishTracker(self.reporter, timeout=publish_timeout)
+        # C2D messages, twin and direct methods; without it only telemetry flows
+        self.device_bound = DeviceBoundHandler(self.reporter, publish_timeout) if device_bound else None
+        # Connect, publish and disconnect events recorded for a later replay
+        self.trace = trace
+        self._connect_started = None
+        self.reconnect_policy = reconnect_policy or ExponentialBackoff()
+        self._reconnect_delay = 0.0
+        self._disconnected_at = None
+        self._retry_timer = None
 
         self.client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv311)
         self.client.username_pw_set(username=username, password=password)
 
-        if self.ca_certs:
-            self.client.tls_set(ca_certs=ca_certs, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLS_CLIENT)
-        else:
-            self.client.tls_set(cert_reqs=ssl.CERT_NONE)
+        # One SSLContext per process: the CA bundle is parsed once and reconnects resume the TLS session
+        self.ssl_context = get_client_context(ca_certs)
+        self.client.tls_set_context(self.ssl_context)
+        if not self.ca_certs:
             self.client.tls_insecure_set(True)
 
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
-        # self.client.on_publish = self._on_publish
+        self.client.on_publish = self._on_publish
+        self.client.on_connect_fail = self._on_connect_fail
+        if self.device_bound:
+            self.client.on_message = self._on_message
+        _clients.add(self)
 
     def connect(self):
-        self.client.connect(self.mqtt_server, 8883)
+        # paho opens the socket and completes the TLS handshake synchronously,
+        # the CONNACK is then awaited by the network loop.
+        start = time.perf_counter()
+        if self.trace:
+            self.trace.record(traffic_trace.CONNECT, self.client_id)
+        try:
+            self.client.connect(self.mqtt_server, 8883)
+        except Exception as e:
+            self.reporter.failure(TLS_HANDSHAKE, HANDSHAKE_NAME, (time.perf_counter() - start) * 1000, e)
+            if self.trace:
+                self.trace.record(traffic_trace.DISCONNECT, self.client_id)
+            # Retry in the network loop, with the reconnect policy like any other reconnect
+            self._disconnected_at = time.perf_counter()
+            self._reconnect_delay = self._next_reconnect_delay()
+            self._retry_timer = threading.Timer(self._reconnect_delay, self._connect_async)
+            self._retry_timer.daemon = True
+            self._retry_timer.start()
+            return
+        self._connect_started = time.perf_counter()
+        resumed = self.client.socket().session_reused
+        self.reporter.success(TLS_HANDSHAKE, RESUMED_HANDSHAKE_NAME if resumed else HANDSHAKE_NAME,
+                              (self._connect_started - start) * 1000)
+        self.client.loop_start()
+
+    def _connect_async(self):
+        self.client.connect_async(self.mqtt_server, 8883)
         self.client.loop_start()
 
     def disconnect(self):
+        if self._retry_timer:
+            self._retry_timer.cancel()
         self.client.loop_stop()
         self.client.disconnect()
+        if self.trace:
+            self.trace.record(traffic_trace.DISCONNECT, self.client_id)
+
+    def drop_connection(self):
+        """Closes the socket under paho, as a proxy outage would: the device reconnects with its policy."""
+        sock = self.client.socket()
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _next_reconnect_delay(self) -> float:
+        # paho doubles the delay from min to max: with min == max it waits exactly this delay
+        delay = self.reconnect_policy.next_delay()
+        self.client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+        return delay
+
+    def update_password(self, password: str):
+        """
+        Applies a renewed SAS token, reconnecting now rather than when the old one expires. Called from the
+        renewal thread: the socket is closed rather than calling reconnect(), so the network loop stays the only
+        thread driving the connection and reconnects with the new credentials through _on_connect.
+        """
+        self.password = password
+        self.client.username_pw_set(username=self.username, password=password)
+        if self.connected:
+            self.drop_connection()
 
     def is_connected(self):
         return self.connected
 
     def publish(self, topic: str, payload: str):
-        if self.connected:
-            self.client.publish(topic, payload, qos=1)
+        self.publish_tracker.expire()
+        if self.device_bound:
+            self.device_bound.expire()
+        if not self.connected:
+            self.publish_tracker.dropped(len(payload))
+            return
+        # The tracker lock is not held across the paho call (paho calls on_publish under its message lock):
+        # a PUBACK handled before sent() is kept by the tracker and matched by sent()
+        start = time.perf_counter()
+        info = self.client.publish(topic, payload, qos=1)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.publish_tracker.sent(info.mid, len(payload), start=start)
+            if self.trace:
+                self.trace.record(traffic_trace.PUBLISH, self.client_id, len(payload))
+        else:
+            self.publish_tracker.failed(len(payload), ConnectError(mqtt.error_string(info.rc)))
 
     # Callbacks
     def _on_connect(self, client, userdata, flags, rc):
         self.connected = (rc == 0)
+        sock = client.socket()
+        if sock is not None:
+            # The TLS 1.3 session ticket has arrived along with the CONNACK
+            self.ssl_context.record(sock)
+        if self._connect_started is not None:
+            response_time = (time.perf_counter() - self._connect_started) * 1000
+            if rc == 0:
+                self.reporter.success(CONNECT, CONNACK_NAME, response_time)
+            else:
+                self.reporter.failure(CONNECT, CONNACK_NAME, response_time, ConnectError(mqtt.connack_string(rc)))
+            self._connect_started = None
+        if self._disconnected_at is not None:
+            if rc == 0:
+                # paho reconnects on its own: the connect of the trace is the CONNACK
+                if self.trace:
+                    self.trace.record(traffic_trace.CONNECT, self.client_id)
+                self.reporter.success(RECONNECT, RECONNECT_ATTEMPT_NAME, self._reconnect_delay * 1000)
+                self.reporter.success(RECONNECT, DOWNTIME_NAME, (time.perf_counter() - self._disconnected_at) * 1000)
+                self._disconnected_at = None
+            else:
+                self.reporter.failure(RECONNECT, RECONNECT_ATTEMPT_NAME, self._reconnect_delay * 1000,
+                                      ConnectError(mqtt.connack_string(rc)))
         if rc == 0:
+            self.reconnect_policy.reset()
+            if self.device_bound:
+                # Subscriptions do not survive the session (clean session): renewed on every connect
+                client.subscribe([(topic_filter, 1) for topic_filter in subscriptions(self.client_id)])
+                self._send_answer(self.device_bound.get_twin(self.reporter.context))
             print(f"[{self.client_id}] ➡️ Connected, rc={rc}")
         else:
             print(f"[{self.client_id}] ❌ Connection failed, rc={rc}")
 
     def _on_disconnect(self, client, userdata, rc):
         self.connected = False
+        if rc != 0:
+            if self.trace:
+                self.trace.record(traffic_trace.DISCONNECT, self.client_id)
+            # Unexpected: the network loop reconnects after the delay chosen by the policy
+            if self._disconnected_at is None:
+                self._disconnected_at = time.perf_counter()
+            self._reconnect_delay = self._next_reconnect_delay()
         print(f"[{self.client_id}] 🔌 Disconnected rc={rc}")
 
+    def _on_connect_fail(self, client, userdata):
+        self.reporter.failure(RECONNECT, RECONNECT_ATTEMPT_NAME, self._reconnect_delay * 1000,
+                              ConnectError("connection failed"))
+        self._reconnect_delay = self._next_reconnect_delay()
+
     def _on_publish(self, client, userdata, mid):
-        print(f"[{self.client_id}] 📤 Message {mid} published")
+        self.publish_tracker.acked(mid)
+
+    def _on_message(self, client, userdata, message):
+        for answer in self.device_bound.handle(message.topic, message.payload, self.reporter.context):
+            self._send_answer(answer)
+
+    def _send_answer(self, answer: tuple):
+        # Twin requests and method responses go at QoS 0: the twin response is the acknowledgement
+        topic, payload = answer
+        self.client.publish(topic, payload, qos=0)
@@ -0,0 +1,150 @@
+import asyncio
+import struct
+
+# MQTT 3.1.1 control packet types (high nibble of the fixed header)
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+PINGREQ_PACKET = b"\xc0\x00"
+PINGRESP_PACKET = b"\xd0\x00"
+DISCONNECT_PACKET = b"\xe0\x00"
+
+
+def _encode_remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        if length > 0:
+            digit |= 0x80
+        encoded.append(digit)
+        if length == 0:
+            return bytes(encoded)
+
+
+def _encode_string(value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return struct.pack("!H", len(value)) + value
+
+
+def encode_connect(client_id: str, username: str = None, password: str = None, keepalive: int = 60,
+                   clean_session: bool = True) -> bytes:
+    flags = 0x02 if clean_session else 0x00
+    payload = _encode_string(client_id)
+    if username is not None:
+        flags |= 0x80
+        payload += _encode_string(username)
+    if password is not None:
+        flags |= 0x40
+        payload += _encode_string(password)
+    variable_header = _encode_string("MQTT") + struct.pack("!BBH", 4, flags, keepalive)
+    body = variable_header + payload
+    return bytes([CONNECT]) + _encode_remaining_length(len(body)) + body
+
+
+def encode_connack(return_code: int, session_present: bool = False) -> bytes:
+    return bytes([CONNACK, 2, 1 if session_present else 0, return_code])
+
+
+def encode_publish(topic, payload: bytes, packet_id: int = 0, qos: int = 1) -> bytes:
+    body = _encode_string(topic)
+    if qos > 0:
+        body += struct.pack("!H", packet_id)
+    body += payload
+    return bytes([PUBLISH | (qos << 1)]) + _encode_remaining_length(len(body)) + body
+
+
+def encode_puback(packet_id: int) -> bytes:
+    return struct.pack("!BBH", PUBACK, 2, packet_id)
+
+
+def encode_subscribe(packet_id: int, topic_filters: list, qos: int = 1) -> bytes:
+    body = struct.pack("!H", packet_id)
+    for topic_filter in topic_filters:
+        body += _encode_string(topic_filter) + bytes([qos])
+    return bytes([SUBSCRIBE | 0x02]) + _encode_remaining_length(len(body)) + body
+
+
+def encode_suback(packet_id: int, granted_qos: list) -> bytes:
+    body = struct.pack("!H", packet_id) + bytes(granted_qos)
+    return bytes([SUBACK]) + _encode_remaining_length(len(body)) + body
+
+
+async def read_packet(reader: asyncio.StreamReader):
+    """Reads one control packet and returns (packet_type, flags, body)."""
+    header = await reader.readexactly(1)
+    multiplier = 1
+    length = 0
+    while True:
+        digit = (await reader.readexactly(1))[0]
+        length += (digit & 0x7F) * multiplier
+        if not digit & 0x80:
+            break
+        multiplier *= 128
+        if multiplier > 128 ** 3:
+            raise ValueError("Malformed remaining length")
+    body = await reader.readexactly(length) if length else b""
+    return header[0] & 0xF0, header[0] & 0x0F, body
+
+
+def decode_publish(flags: int, body: bytes):
+    """Returns (topic, packet_id, payload) from the body of a PUBLISH packet."""
+    (topic_length,) = struct.unpack_from("!H", body, 0)
+    topic = body[2:2 + topic_length].decode("utf-8")
+    offset = 2 + topic_length
+    packet_id = 0
+    if (flags >> 1) & 0x03:
+        (packet_id,) = struct.unpack_from("!H", body, offset)
+        offset += 2
+    return topic, packet_id, body[offset:]
+
+
+def decode_connect(body: bytes):
+    """Returns (client_id, username, password, keepalive) from the body of a CONNECT packet."""
+    offset = 0
+
+    def read_field():
+        nonlocal offset
+        (field_length,) = struct.unpack_from("!H", body, offset)
+        value = body[offset + 2:offset + 2 + field_length]
+        offset += 2 + field_length
+        return value
+
+    protocol_name = read_field()
+    if protocol_name != b"MQTT":
+        raise ValueError(f"Unsupported protocol {protocol_name!r}")
+    _, flags, keepalive = struct.unpack_from("!BBH", body, offset)
+    offset += 4
+    client_id = read_field().decode("utf-8")
+    if flags & 0x04:
+        read_field()  # will topic
+        read_field()  # will message
+    username = read_field().decode("utf-8") if flags & 0x80 else None
+    password = read_field().decode("utf-8") if flags & 0x40 else None
+    return client_id, username, password, keepalive
+
+
+def decode_subscribe(body: bytes):
+    """Returns (packet_id, [(topic_filter, qos), ...]) from the body of a SUBSCRIBE packet."""
+    (packet_id,) = struct.unpack_from("!H", body, 0)
+    offset = 2
+    topic_filters = []
+    while offset < len(body):
+        (filter_length,) = struct.unpack_from("!H", body, offset)
+        topic_filter = body[offset + 2:offset + 2 + filter_length].decode("utf-8")
+        offset += 2 + filter_length
+        topic_filters.append((topic_filter, body[offset]))
+        offset += 1
+    return packet_id, topic_filters
+
+
+def decode_packet_id(body: bytes) -> int:
+    return struct.unpack_from("!H", body, 0)[0]
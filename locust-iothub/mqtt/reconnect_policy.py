@@ -0,0 +1,74 @@
+import abc
+import random
+
+
+class ReconnectPolicy(abc.ABC):
+    """Delay before each reconnect attempt of a device. One instance per device, it keeps the attempt state."""
+
+    @abc.abstractmethod
+    def next_delay(self) -> float:
+        """Seconds to wait before the next attempt."""
+
+    def reset(self):
+        """Called once the device is connected again."""
+
+
+class FixedDelay(ReconnectPolicy):
+    """Same delay before every attempt: the whole fleet retries in lockstep."""
+
+    def __init__(self, delay: float = 5):
+        self.delay = delay
+
+    def next_delay(self) -> float:
+        return self.delay
+
+
+class ExponentialBackoff(ReconnectPolicy):
+    """
+    base * factor^attempt capped at max_delay. With jitter > 0 a random fraction of the
+    delay (up to jitter, 1 = "full jitter") is removed, so devices that dropped together spread out.
+    """
+
+    def __init__(self, base_delay: float = 1, max_delay: float = 120, factor: float = 2, jitter: float = 0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.max_delay, self.base_delay * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * (1 - random.uniform(0, self.jitter))
+
+    def reset(self):
+        self.attempt = 0
+
+
+class DecorrelatedJitter(ReconnectPolicy):
+    """Each delay is random between base_delay and 3x the previous one, capped at max_delay."""
+
+    def __init__(self, base_delay: float = 1, max_delay: float = 120):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = base_delay
+
+    def next_delay(self) -> float:
+        self.delay = min(self.max_delay, random.uniform(self.base_delay, self.delay * 3))
+        return self.delay
+
+    def reset(self):
+        self.delay = self.base_delay
+
+
+def create_reconnect_policy(name: str, base_delay: float, max_delay: float) -> ReconnectPolicy:
+    """Builds a policy by name: fixed|exponential|exponential-jitter|decorrelated."""
+    if name == "fixed":
+        return FixedDelay(base_delay)
+    if name == "exponential":
+        return ExponentialBackoff(base_delay, max_delay)
+    if name == "exponential-jitter":
+        return ExponentialBackoff(base_delay, max_delay, jitter=1)
+    if name == "decorrelated":
+        return DecorrelatedJitter(base_delay, max_delay)
+    raise ValueError(f"Unknown reconnect policy {name!r}")
@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Request types reported to Locust
+TLS_HANDSHAKE = "TLS"
+CONNECT = "CONNECT"
+PUBLISH = "PUBLISH"
+RECONNECT = "RECONNECT"
+TWIN = "TWIN"                           # device requests on the twin, from the publish to the response
+DOWNSTREAM = "DOWNSTREAM"               # cloud-to-device traffic, from the service send time to the device
+
+# Request names: fleet-wide aggregates, never one row per device
+HANDSHAKE_NAME = "handshake"
+RESUMED_HANDSHAKE_NAME = "handshake (resumed)"
+CONNACK_NAME = "connack"
+TELEMETRY_NAME = "messages/events"
+RECONNECT_ATTEMPT_NAME = "attempt"      # response time: backoff delay before the attempt
+DOWNTIME_NAME = "downtime"              # response time: from the disconnect to the next CONNACK
+RECOVERY_NAME = "full recovery"         # response time: from an outage to every device connected again
+TWIN_GET_NAME = "get"
+TWIN_PATCH_NAME = "patch reported"
+C2D_NAME = "c2d message"
+DESIRED_NAME = "desired properties"
+METHOD_NAME = "direct method"
+
+
+class PublishDroppedError(Exception):
+    """The publish was not sent because the client was not connected."""
+
+
+class PublishTimeoutError(Exception):
+    """No PUBACK was received within the publish timeout."""
+
+
+class ConnectError(Exception):
+    """The broker refused the connection or the handshake failed."""
+
+
+class RequestRejectedError(Exception):
+    """The hub answered a twin request with an error status."""
+
+
+class RequestReporter:
+    """
+    Forwards MQTT timings to Locust's request event. Without an event it is a no-op.
+    The context (e.g. {"device_id": ...}) reaches the request listeners, not the statistics rows.
+    """
+
+    def __init__(self, request_event=None, context: dict = None):
+        self.request_event = request_event
+        self.context = context or {}
+
+    def success(self, request_type: str, name: str, response_time: float, response_length: int = 0,
+                context: dict = None):
+        if self.request_event is not None:
+            self.request_event.fire(request_type=request_type, name=name, response_time=response_time,
+                                    response_length=response_length, exception=None,
+                                    context=context or self.context)
+
+    def failure(self, request_type: str, name: str, response_time: float, exception: Exception,
+                response_length: int = 0, context: dict = None):
+        if self.request_event is not None:
+            self.request_event.fire(request_type=request_type, name=name, response_time=response_time,
+                                    response_length=response_length, exception=exception,
+                                    context=context or self.context)
+
+
+class PublishTracker:
+    """
+    Tracks QoS 1 publishes from send to PUBACK by message id (or requests from send to
+    response by request id, with another request type).
+
+    Entries are kept in send order, so expiring timed out publishes only looks at
+    the oldest ones. An ack may be handled before its send is recorded (paho's network
+    thread can receive the PUBACK before publish() returns the mid): it is kept with its
+    time and resolved by sent().
+    """
+
+    def __init__(self, reporter: RequestReporter, timeout: float = 30, name: str = TELEMETRY_NAME,
+                 request_type: str = PUBLISH):
+        self.reporter = reporter
+        self.timeout = timeout
+        self.name = name
+        self.request_type = request_type
+        self.lock = threading.Lock()
+        self._in_flight = OrderedDict()
+        self._early_acks = OrderedDict()
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def __contains__(self, mid):
+        return mid in self._in_flight
+
+    def sent(self, mid, length: int, context: dict = None, start: float = None):
+        """Records a send; start is the perf_counter() time before the send, now by default."""
+        if start is None:
+            start = time.perf_counter()
+        with self.lock:
+            acked_at = self._early_acks.pop(mid, None)
+            if acked_at is None:
+                self._in_flight[mid] = (start, length, context)
+                return
+        self.reporter.success(self.request_type, self.name, (acked_at - start) * 1000, length, context)
+
+    def acked(self, mid):
+        now = time.perf_counter()
+        with self.lock:
+            entry = self._in_flight.pop(mid, None)
+            if entry is None:
+                self._early_acks[mid] = now
+                return
+        start, length, context = entry
+        self.reporter.success(self.request_type, self.name, (now - start) * 1000, length, context)
+
+    def rejected(self, mid, exception: Exception):
+        """Reports a tracked entry as failed when the answer is an error."""
+        with self.lock:
+            entry = self._in_flight.pop(mid, None)
+        if entry is None:
+            return
+        start, length, context = entry
+        self.reporter.failure(self.request_type, self.name, (time.perf_counter() - start) * 1000, exception,
+                              length, context)
+
+    def dropped(self, length: int, reason: str = "client not connected", context: dict = None):
+        self.reporter.failure(self.request_type, self.name, 0, PublishDroppedError(reason), length, context)
+
+    def failed(self, length: int, exception: Exception, context: dict = None):
+        self.reporter.failure(self.request_type, self.name, 0, exception, length, context)
+
+    def expire(self):
+        """Reports as failed every publish still waiting for its PUBACK after the timeout."""
+        now = time.perf_counter()
+        expired = []
+        with self.lock:
+            while self._in_flight:
+                mid, (start, length, context) = next(iter(self._in_flight.items()))
+                if now - start < self.timeout:
+                    break
+                del self._in_flight[mid]
+                expired.append((start, length, context))
+            # Acks never matched by a send: late PUBACKs of expired publishes, responses of another tracker
+            while self._early_acks:
+                mid, acked_at = next(iter(self._early_acks.items()))
+                if now - acked_at < self.timeout:
+                    break
+                del self._early_acks[mid]
+        answer = "PUBACK" if self.request_type == PUBLISH else "response"
+        for start, length, context in expired:
+            self.reporter.failure(self.request_type, self.name, (now - start) * 1000,
+                                  PublishTimeoutError(f"No {answer} after {self.timeout}s"), length, context)
@@ -0,0 +1,74 @@
+import ssl
+import threading
+
+_contexts = {}
+_lock = threading.Lock()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    Client SSLContext that offers the last TLS session received from a server on every
+    new connection to it, so reconnects resume instead of doing a full handshake.
+    It also counts how many handshakes were resumed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._sessions = {}
+        self._stats_lock = threading.Lock()
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self._sessions.get(server_hostname)
+        return super().wrap_socket(sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect,
+                                   suppress_ragged_eofs=suppress_ragged_eofs, server_hostname=server_hostname,
+                                   session=session)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self._sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side=server_side, server_hostname=server_hostname,
+                                session=session)
+
+    def record(self, ssl_object) -> bool:
+        """
+        Counts the handshake and keeps the session for the next connection. Call it once the
+        server has sent application data: TLS 1.3 tickets arrive after the handshake.
+        Returns True if the handshake was resumed.
+        """
+        resumed = ssl_object.session_reused
+        with self._stats_lock:
+            if resumed:
+                self.resumed_handshakes += 1
+            else:
+                self.full_handshakes += 1
+        session = ssl_object.session
+        if session is not None and ssl_object.server_hostname:
+            self._sessions[ssl_object.server_hostname] = session
+        return resumed
+
+    def handshake_counts(self) -> tuple:
+        """Returns (full, resumed) handshakes since the context was created."""
+        with self._stats_lock:
+            return self.full_handshakes, self.resumed_handshakes
+
+    def forget_sessions(self):
+        self._sessions.clear()
+
+
+def get_client_context(ca_certs: str = None) -> ResumingSSLContext:
+    """Returns the process-wide client context for the CA bundle (no verification without one)."""
+    with _lock:
+        context = _contexts.get(ca_certs)
+        if context is None:
+            context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            if ca_certs:
+                context.load_verify_locations(cafile=ca_certs)
+            else:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _contexts[ca_certs] = context
+        return context
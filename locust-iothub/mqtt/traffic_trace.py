@@ -0,0 +1,133 @@
+import atexit
+import glob
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Trace file: header, fixed-size event records in time order, device id table, footer.
+# Records only hold the index of the device, the ids are written once in the table on close.
+HEADER = struct.Struct("!4sHxxd")       # magic, version, start time (epoch seconds)
+RECORD = struct.Struct("!QBII")         # microseconds since the start, event, device index, payload size
+FOOTER = struct.Struct("!QQI4s")        # records, table offset, table length, magic
+MAGIC = b"LTT1"
+FOOTER_MAGIC = b"LTTE"
+VERSION = 1
+
+# Events
+CONNECT = 1
+PUBLISH = 2
+DISCONNECT = 3
+EVENT_NAMES = {CONNECT: "connect", PUBLISH: "publish", DISCONNECT: "disconnect"}
+
+
+class TraceRecorder:
+    """
+    Appends the connect, publish and disconnect events of the devices of a process to a trace file,
+    with their time and payload size (never the payload). Safe to call from any thread; events are
+    stamped under the lock, so the records are in time order.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.start = time.time()
+        self._start_counter = time.perf_counter()
+        self._file = open(path, "wb", buffering=1 << 20)
+        self._file.write(HEADER.pack(MAGIC, VERSION, self.start))
+        self._devices = {}
+        self._records = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def record(self, event: int, device_id: str, size: int = 0):
+        with self._lock:
+            if self._file.closed:
+                return
+            index = self._devices.get(device_id)
+            if index is None:
+                index = self._devices[device_id] = len(self._devices)
+            offset = int((time.perf_counter() - self._start_counter) * 1_000_000)
+            self._file.write(RECORD.pack(offset, event, index, size))
+            self._records += 1
+
+    def close(self):
+        """Writes the device id table and the footer; a trace without them cannot be replayed."""
+        with self._lock:
+            if self._file.closed:
+                return
+            table = "\n".join(self._devices).encode("utf-8")
+            table_offset = self._file.tell()
+            self._file.write(table)
+            self._file.write(FOOTER.pack(self._records, table_offset, len(table), FOOTER_MAGIC))
+            self._file.close()
+
+
+class TraceReader:
+    """
+    Reads a trace memory-mapped: the records are decoded one by one while iterating, so a trace of a
+    whole day is streamed without being loaded in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size + FOOTER.size:
+            raise ValueError(f"{path} is not a traffic trace")
+        magic, version, self.start = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a traffic trace (version {VERSION})")
+        self.records, table_offset, table_length, footer_magic = FOOTER.unpack_from(self._map, len(self._map) - FOOTER.size)
+        if footer_magic != FOOTER_MAGIC:
+            raise ValueError(f"{path} is truncated: the recording process did not close it")
+        table = self._map[table_offset:table_offset + table_length].decode("utf-8")
+        self.device_ids = table.split("\n") if table else []
+
+    def __len__(self):
+        return self.records
+
+    def duration(self) -> float:
+        """Seconds from the start of the recording to its last event."""
+        if not self.records:
+            return 0.0
+        return RECORD.unpack_from(self._map, HEADER.size + (self.records - 1) * RECORD.size)[0] / 1_000_000
+
+    def events(self, devices: set = None):
+        """Yields (time, event, device_id, size) in time order, time in epoch seconds; only the given devices when set."""
+        device_ids = self.device_ids
+        wanted = None if devices is None else {index for index, device_id in enumerate(device_ids) if device_id in devices}
+        start = self.start
+        unpack_from = RECORD.unpack_from
+        mapped = self._map
+        for position in range(HEADER.size, HEADER.size + self.records * RECORD.size, RECORD.size):
+            offset, event, index, size = unpack_from(mapped, position)
+            if wanted is None or index in wanted:
+                yield start + offset / 1_000_000, event, device_ids[index], size
+
+    def close(self):
+        self._map.close()
+
+
+def open_traces(pattern: str) -> list:
+    """Readers of the trace files matching the glob pattern (one file per recording process)."""
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError(f"No trace matches {pattern}")
+    return [TraceReader(path) for path in paths]
+
+
+def merge_events(readers: list, devices: set = None):
+    """Events of several traces (e.g. the workers of a run) merged in time order."""
+    return heapq.merge(*(reader.events(devices) for reader in readers), key=lambda item: item[0])
+
+
+def sized_payload(seq: int, size: int) -> bytes:
+    """JSON body of the given size, stamped with the send time and sequence number like the telemetry bodies."""
+    body = b'{"ts": %d, "seq": %d' % (int(time.time() * 1000), seq)
+    padding = size - len(body) - len(b', "pad": ""}')
+    return body + (b', "pad": "%s"}' % (b"x" * padding) if padding > 0 else b"}")
@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from mqtt import mqtt_packets
+from iothub_standin import create_self_signed_certificate
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "templates", "nginx.conf.template")
+ROUTING_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "02-stream-routing.sh")
+RENDER_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "03-render-nginx-conf.sh")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# Client connections per loopback source address, below the ephemeral port range
+CONNECTIONS_PER_SOURCE_ADDRESS = 25000
+# Source port chosen on connect, per destination: a bind() port would be taken from nginx's upstream connections
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, "IP_BIND_ADDRESS_NO_PORT", 24)
+
+
+# ------------------ nginx config rendering ------------------ #
+def render_template(template: str, env: dict) -> str:
+    """Substitutes ${VAR} like the envsubst step of the nginx image: only the defined variables."""
+    return re.sub(r"\$\{(\w+)\}", lambda m: env.get(m.group(1), m.group(0)), template)
+
+
+def derive_sizing(env: dict, workdir: str) -> dict:
+    """Worker, connection, open files, backlog and buffer values 03-render-nginx-conf.sh derives on this host."""
+    sizing_path = os.path.join(workdir, "sizing.env")
+    subprocess.run(["bash", RENDER_SCRIPT_PATH], env={**os.environ, **env, "NGINX_SIZING_OUTPUT": sizing_path},
+                   check=True, stdout=subprocess.DEVNULL)
+    with open(sizing_path) as f:
+        return dict(line.rstrip("\n").split("=", 1) for line in f if "=" in line)
+
+
+def render_stream_routing(conf: str, env: dict, workdir: str) -> str:
+    """Generates the MQTT routing with 02-stream-routing.sh, like the container start, and inlines it."""
+    routing_path = os.path.join(workdir, "stream-routing.conf")
+    subprocess.run(["bash", ROUTING_SCRIPT_PATH], env={**os.environ, **env, "STREAM_ROUTING_CONF": routing_path},
+                   check=True, stdout=subprocess.DEVNULL)
+    with open(routing_path) as f:
+        routing = f.read()
+    return re.sub(r"(?m)^(\s*)include\s+/etc/nginx/stream-routing.conf;\n",
+                  lambda m: "".join(f"{m.group(1)}{line}\n" if line else "\n" for line in routing.rstrip().splitlines()), conf)
+
+
+def split_variant(variant: dict) -> tuple:
+    """Variant entries in upper case are environment variables of the container, the others nginx directives."""
+    env = {name: value for name, value in variant.items() if name.isupper()}
+    directives = {name: value for name, value in variant.items() if not name.isupper()}
+    return env, directives
+
+
+def apply_variant(conf: str, directives: dict) -> str:
+    """Overrides the value of the given directives (and of the listen backlog) in the rendered config."""
+    for name, value in directives.items():
+        if name == "backlog":
+            conf = re.sub(r"backlog=\d+", f"backlog={value}", conf)
+        else:
+            conf = re.sub(rf"(?m)^(\s*){name}\s+[^;]*;", rf"\g<1>{name} {value};", conf)
+    return conf
+
+
+def localize(conf: str, workdir: str, certfile: str, keyfile: str, ports: dict, upstream_port: int) -> str:
+    """Rewrites paths and ports so the config runs unprivileged from a work directory."""
+    ticket_key = os.path.join(workdir, "ssl_ticket.key")
+    with open(ticket_key, "wb") as f:
+        f.write(os.urandom(80))
+    replacements = {
+        "/etc/nginx/ssl_ticket.key": ticket_key,
+        "/etc/ssl/certs/nginx-cert.crt": certfile,
+        "/etc/ssl/private/nginx-cert.key": keyfile,
+        "/var/run/nginx.pid": os.path.join(workdir, "nginx.pid"),
+        "/var/log/nginx/": workdir + "/",
+        "/dev/stdout": os.path.join(workdir, "stream.log"),
+    }
+    for old, new in replacements.items():
+        conf = conf.replace(old, new)
+    conf = re.sub(r"(?m)^\s*include\s+/etc/nginx/mime.types;\n", "", conf)
+    conf = re.sub(r"(server\s+)[^;\s]+:8883;", rf"\g<1>127.0.0.1:{upstream_port};", conf)
+    # Upstream connections leave from the client source address (all of 127.0.0.0/8 is local): from 127.0.0.1
+    # alone nginx would run out of ephemeral ports to the stand-in around 28k connections
+    conf = re.sub(r"(?m)^(\s*)(proxy_pass\s+[^;]+;)$", r"\g<1>\g<2>\n\g<1>proxy_bind $remote_addr;", conf)
+    for port, local_port in ports.items():
+        conf = re.sub(rf"listen {port}\b", f"listen {local_port}", conf)
+    return conf
+
+
+# ------------------ Process metrics ------------------ #
+def _process_tree(pid: int) -> list:
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def process_usage(pid: int) -> dict:
+    """RSS, CPU time and open file descriptors of a process and its children (nginx master + workers)."""
+    usage = {"rss_bytes": 0, "cpu_seconds": 0.0, "fds": 0, "processes": 0}
+    for child in _process_tree(pid):
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{child}/statm") as f:
+                rss_pages = int(f.read().split()[1])
+            fds = len(os.listdir(f"/proc/{child}/fd"))
+        except OSError:
+            continue
+        usage["cpu_seconds"] += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        usage["rss_bytes"] += rss_pages * PAGE_SIZE
+        usage["fds"] += fds
+        usage["processes"] += 1
+    return usage
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+# ------------------ Load generator ------------------ #
+class BenchmarkClient:
+    """Opens MQTT-over-TLS connections through the proxy and keeps them idle."""
+
+    def __init__(self, ports: list, server_hostnames: list = None, max_concurrent_connects: int = 500):
+        # Connections are spread round-robin over the listen ports and SNI names (sharding variants)
+        self.ports = ports
+        self.server_hostnames = server_hostnames
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.connections = []
+        self.failures = 0
+        self._connect_limit = asyncio.Semaphore(max_concurrent_connects)
+
+    async def _open(self, index: int):
+        source_address = f"127.0.0.{2 + index // CONNECTIONS_PER_SOURCE_ADDRESS}"
+        port = self.ports[index % len(self.ports)]
+        server_hostname = self.server_hostnames[index % len(self.server_hostnames)] if self.server_hostnames else None
+        async with self._connect_limit:
+            start = time.perf_counter()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+            sock.setblocking(False)
+            writer = None
+            try:
+                sock.bind((source_address, 0))
+                await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port)), 30)
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(sock=sock, ssl=self.ssl_context,
+                                            server_hostname=server_hostname or "127.0.0.1"), 30)
+                handshake = time.perf_counter() - start
+                device_id = f"bench-{index:06d}"
+                writer.write(mqtt_packets.encode_connect(device_id, f"localhost/{device_id}/?api-version=2021-04-12",
+                                                         "", keepalive=0))
+                packet_type, _, body = await asyncio.wait_for(mqtt_packets.read_packet(reader), 30)
+                if packet_type != mqtt_packets.CONNACK or body[1] != 0:
+                    raise ConnectionError(f"CONNACK {body!r}")
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                (writer or sock).close()
+                self.failures += 1
+                return None
+            self.connections.append((device_id, reader, writer))
+            return handshake, time.perf_counter() - start
+
+    async def ramp_to(self, target: int) -> dict:
+        start_index = len(self.connections) + self.failures
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self._open(i) for i in range(start_index, start_index + target - len(self.connections))))
+        elapsed = time.perf_counter() - started
+        timings = [r for r in results if r]
+        handshakes = sorted(t[0] * 1000 for t in timings)
+        connects = sorted(t[1] * 1000 for t in timings)
+        return {
+            "handshakes_per_second": round(len(timings) / elapsed, 1) if elapsed else 0,
+            "handshake_ms": {p: round(percentile(handshakes, p), 2) for p in (50, 95, 99)},
+            "connect_ms": {p: round(percentile(connects, p), 2) for p in (50, 95, 99)},
+        }
+
+    async def publish_round(self, payload: bytes) -> int:
+        """Publishes one QoS 1 message per connection and waits for every PUBACK."""
+        async def publish(device_id, reader, writer):
+            try:
+                writer.write(mqtt_packets.encode_publish(f"devices/{device_id}/messages/events", payload, 1))
+                packet_type, _, _ = await asyncio.wait_for(mqtt_packets.read_packet(reader), 30)
+                return packet_type == mqtt_packets.PUBACK
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return False
+        results = await asyncio.gather(*(publish(*connection) for connection in self.connections))
+        return sum(results)
+
+    def close(self):
+        for _, _, writer in self.connections:
+            writer.close()
+        self.connections = []
+
+
+# ------------------ Benchmark ------------------ #
+def _wait_for_port(port: int, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+async def _run_steps(proxy_ports: list, server_hostnames: list, nginx_pid: int, steps: list, payload_size: int) -> list:
+    client = BenchmarkClient(proxy_ports, server_hostnames)
+    baseline = process_usage(nginx_pid)
+    results = []
+    try:
+        for target in steps:
+            ramp = await client.ramp_to(target)
+            await asyncio.sleep(2)
+            idle = process_usage(nginx_pid)
+            acked = await client.publish_round(os.urandom(payload_size))
+            after = process_usage(nginx_pid)
+            connections = len(client.connections)
+            step = {
+                "target_connections": target,
+                "connections": connections,
+                "failed_connections": client.failures,
+                **ramp,
+                "rss_mb": round(idle["rss_bytes"] / 2 ** 20, 1),
+                "rss_kb_per_idle_connection": round((idle["rss_bytes"] - baseline["rss_bytes"]) / 1024 / connections, 2)
+                if connections else None,
+                "fds": idle["fds"],
+                "messages_acked": acked,
+                "cpu_us_per_message": round((after["cpu_seconds"] - idle["cpu_seconds"]) * 1e6 / acked, 2)
+                if acked else None,
+            }
+            logging.info(f"📊 {json.dumps(step)}")
+            results.append(step)
+            if client.failures > target * 0.1:
+                logging.warning("More than 10% of the connections failed, stopping the ramp")
+                break
+    finally:
+        client.close()
+    return results
+
+
+def run_variant(name: str, variant: dict, template: str, nginx: str, steps: list, payload_size: int,
+                base_port: int) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"nginx-bench-{name}-")
+    certfile, keyfile = create_self_signed_certificate("localhost")
+    env, directives = split_variant(variant)
+    env = {"IOTHUB_HOSTNAME": "127.0.0.1", **env}
+    ports = {8883: base_port, 443: base_port + 1, 80: base_port + 2}
+    upstream_port = base_port + 3
+
+    # Every hub of a sharding variant is served by the same stand-in, the benchmark measures the routing
+    hubs = env.get("IOTHUB_HOSTNAMES", "").replace(",", " ").split()
+    server_hostnames = None
+    if hubs and env.get("IOTHUB_SHARD_BY", "sni") == "port":
+        shard_base_port = int(env.get("IOTHUB_SHARD_BASE_PORT", 8883))
+        ports.update({shard_base_port + i: base_port + 10 + i for i in range(len(hubs))})
+        proxy_ports = [ports[shard_base_port + i] for i in range(len(hubs))]
+    else:
+        proxy_ports = [ports[8883]]
+        server_hostnames = hubs or None
+
+    env = {**derive_sizing(env, workdir), **env}
+    conf = render_stream_routing(render_template(template, env), env, workdir)
+    conf = localize(apply_variant(conf, directives), workdir, certfile, keyfile, ports, upstream_port)
+    conf_path = os.path.join(workdir, "nginx.conf")
+    with open(conf_path, "w") as f:
+        f.write(conf)
+
+    standin = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "iothub_standin.py"),
+                                "--no-auth", "--host", "127.0.0.1", "--port", str(upstream_port),
+                                "--certfile", certfile, "--keyfile", keyfile],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    nginx_process = subprocess.Popen([nginx, "-p", workdir, "-c", conf_path, "-g", "daemon off;"],
+                                     stderr=subprocess.PIPE)
+    try:
+        _wait_for_port(upstream_port)
+        for port in proxy_ports:
+            _wait_for_port(port)
+        logging.info(f"🚀 Variant {name}: {variant or 'template defaults'}")
+        results = asyncio.run(_run_steps(proxy_ports, server_hostnames, nginx_process.pid, steps, payload_size))
+    finally:
+        nginx_process.terminate()
+        standin.terminate()
+        nginx_process.wait(timeout=30)
+        standin.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+        shutil.rmtree(os.path.dirname(certfile), ignore_errors=True)
+    return {"directives": variant, "steps": results}
+
+
+# ------------------ Comparison ------------------ #
+# Metric -> True when higher is better
+CHECKED_METRICS = {
+    "handshakes_per_second": True,
+    "rss_kb_per_idle_connection": False,
+    "cpu_us_per_message": False,
+}
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    """Returns the regressions of the report against a baseline report, step by step."""
+    regressions = []
+    for variant, result in report["variants"].items():
+        baseline_variant = baseline.get("variants", {}).get(variant)
+        if not baseline_variant:
+            continue
+        baseline_steps = {s["target_connections"]: s for s in baseline_variant["steps"]}
+        for step in result["steps"]:
+            baseline_step = baseline_steps.get(step["target_connections"])
+            if not baseline_step:
+                continue
+            for metric, higher_is_better in CHECKED_METRICS.items():
+                value, reference = step.get(metric), baseline_step.get(metric)
+                if not value or not reference:
+                    continue
+                change = (value - reference) / reference * 100
+                if (-change if higher_is_better else change) > max_regression:
+                    regressions.append(f"{variant} @ {step['target_connections']} connections: "
+                                       f"{metric} {reference} -> {value} ({change:+.1f}%)")
+    return regressions
+
+
+def _raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resource profiling of the nginx proxy across config variants.")
+    parser.add_argument("--template", default=TEMPLATE_PATH)
+    parser.add_argument("--variants", default="nginx_benchmark_variants.json")
+    parser.add_argument("--only", nargs="*", help="Run only these variants")
+    parser.add_argument("--steps", default="1000,5000,10000,25000,50000,100000",
+                        help="Comma separated connection counts of the ramp")
+    parser.add_argument("--payload-size", type=int, default=256)
+    parser.add_argument("--nginx", default=shutil.which("nginx") or "nginx")
+    parser.add_argument("--base-port", type=int, default=18883)
+    parser.add_argument("--output", default="nginx_benchmark_report.json")
+    parser.add_argument("--baseline", help="Previous report to check against")
+    parser.add_argument("--max-regression", type=float, default=10, help="Allowed regression in percent")
+    args = parser.parse_args()
+
+    _raise_open_files_limit()
+    with open(args.template) as f:
+        template = f.read()
+    with open(args.variants) as f:
+        variants = json.load(f)
+    steps = [int(s) for s in args.steps.split(",")]
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "steps": steps,
+              "payload_size": args.payload_size, "variants": {}}
+    for name, directives in variants.items():
+        if args.only and name not in args.only:
+            continue
+        report["variants"][name] = run_variant(name, directives, template, args.nginx, steps,
+                                               args.payload_size, args.base_port)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            logging.error(f"❌ {regression}")
+        if regressions:
+            sys.exit(1)
+        logging.info("✅ No regression against the baseline")
@@ -0,0 +1,246 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+from utils.device_ids import split_device_id_range
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# A gevent worker runs on one core: above this CPU share it cannot generate more load
+SATURATED_CPU_PERCENT = 90
+
+
+def raise_open_files_limit(target: int) -> int:
+    """Raises the soft (and, when permitted, hard) open files limit, inherited by the Locust processes."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, target), max(hard, target)))
+    except (ValueError, OSError):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(max(soft, target), hard), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def read_process_usage(pid: int):
+    """CPU seconds, RSS, threads and open file descriptors of a process, or None when it is gone."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        return None
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        "rss_mb": int(fields[21]) * PAGE_SIZE / 2 ** 20,
+        "threads": int(fields[17]),
+        "fds": fds,
+    }
+
+
+class LocustProcess:
+    """One Locust process (master or worker) pinned to a core, restarted by the launcher when it dies."""
+
+    def __init__(self, name: str, args: list, cpu: int, env: dict):
+        self.name = name
+        self.args = args
+        self.cpu = cpu
+        self.env = env
+        self.process = None
+        self.restarts = 0
+        self.given_up = False
+        self.started = None
+        self._last_sample = None
+
+    def start(self):
+        cpu = self.cpu
+        self.process = subprocess.Popen(self.args, env=self.env,
+                                        preexec_fn=(lambda: os.sched_setaffinity(0, {cpu})) if cpu is not None else None)
+        self.started = time.monotonic()
+        self._last_sample = None
+        logging.info(f"🔹 {self.name} started (pid {self.process.pid}, cpu {cpu}, "
+                     f"devices {self.env.get('DEVICE_ID_RANGE', '-')})")
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def sample(self) -> dict:
+        """Usage since the previous sample: CPU percent of one core, RSS, threads, fds."""
+        usage = read_process_usage(self.process.pid)
+        if usage is None:
+            return None
+        now = time.monotonic()
+        if self._last_sample:
+            last_time, last_cpu = self._last_sample
+            usage["cpu_percent"] = (usage["cpu_seconds"] - last_cpu) * 100 / max(now - last_time, 1e-6)
+        else:
+            usage["cpu_percent"] = None
+        self._last_sample = (now, usage["cpu_seconds"])
+        return usage
+
+    def stop(self, timeout: float):
+        if not self.alive():
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Launcher:
+    """
+    Starts a Locust master and one worker per core, each pinned to its core and owning a disjoint
+    range of device ids. Crashed workers (non-zero exit code) are restarted with the same core and range
+    while the master runs, and the CPU, memory, threads and fds of every worker are sampled so a saturated
+    generator shows up.
+    """
+
+    def __init__(self, args, locust_args: list):
+        self.args = args
+        cpus = sorted(os.sched_getaffinity(0))
+        # The master gets the first core, the workers the others (round-robin when there are more workers)
+        self.master_cpu = cpus[0]
+        worker_cpus = cpus[1:] or cpus
+        workers = args.workers or max(1, len(cpus) - 1)
+        ranges = split_device_id_range(args.first_device, args.devices, workers) if args.devices else [None] * workers
+
+        env = dict(os.environ)
+        env.setdefault("RUN_ID", time.strftime("%Y%m%d-%H%M%S"))
+        command = [sys.executable, "-m", "locust", "-f", args.locustfile]
+        self.master = LocustProcess("master", command + ["--master", "--web-port", str(args.web_port),
+                                                         "--expect-workers", str(workers)] + locust_args,
+                                    self.master_cpu, env)
+        self.workers = []
+        for index in range(workers):
+            worker_env = dict(env)
+            worker_env["WORKER_INDEX"] = str(index)
+            worker_env["WORKER_COUNT"] = str(workers)
+            if ranges[index]:
+                worker_env["DEVICE_ID_RANGE"] = ranges[index]
+            self.workers.append(LocustProcess(f"worker {index + 1}",
+                                              command + ["--worker", "--master-host", "127.0.0.1"],
+                                              worker_cpus[index % len(worker_cpus)], worker_env))
+        self.stats_file = open(args.stats_file, "w", newline="") if args.stats_file else None
+        self.stats_writer = csv.writer(self.stats_file) if self.stats_file else None
+        if self.stats_writer:
+            self.stats_writer.writerow(["time", "worker", "pid", "cpu", "devices", "cpu_percent", "rss_mb",
+                                        "threads", "fds", "restarts"])
+        self.stopping = False
+
+    def start(self):
+        self.master.start()
+        time.sleep(self.args.master_delay)
+        for worker in self.workers:
+            worker.start()
+
+    def watch(self):
+        while not self.stopping:
+            time.sleep(self.args.interval)
+            if not self.master.alive():
+                logging.info(f"🛑 Master exited with code {self.master.process.returncode}")
+                return
+            self._check_workers()
+
+    def _check_workers(self):
+        saturated = []
+        rows = []
+        for worker in self.workers:
+            if worker.given_up:
+                continue
+            if not worker.alive():
+                if worker.process.returncode == 0:
+                    # Quit on its own (the master ended the test), not a crash
+                    logging.info(f"🔹 {worker.name} exited normally, not restarted")
+                    worker.given_up = True
+                elif not self.stopping and self.master.alive():
+                    self._restart(worker)
+                continue
+            usage = worker.sample()
+            if usage is None or usage["cpu_percent"] is None:
+                continue
+            rows.append({"worker": worker.name, "pid": worker.process.pid, "cpu": worker.cpu,
+                         "devices": worker.env.get("DEVICE_ID_RANGE", ""), "cpu_percent": round(usage["cpu_percent"], 1),
+                         "rss_mb": round(usage["rss_mb"], 1), "threads": usage["threads"], "fds": usage["fds"],
+                         "restarts": worker.restarts})
+            if usage["cpu_percent"] >= SATURATED_CPU_PERCENT:
+                saturated.append(worker.name)
+        if rows:
+            logging.info(f"📊 Workers: {json.dumps(rows)}")
+            if self.stats_writer:
+                now = time.strftime("%Y-%m-%dT%H:%M:%S")
+                for row in rows:
+                    self.stats_writer.writerow([now] + list(row.values()))
+                self.stats_file.flush()
+        if saturated:
+            logging.warning(f"⚠️ {', '.join(saturated)} above {SATURATED_CPU_PERCENT}% of their core: "
+                            f"the load generator is saturated, add workers or agents")
+
+    def _restart(self, worker: LocustProcess):
+        if worker.restarts >= self.args.max_restarts:
+            logging.error(f"❌ {worker.name} exited {worker.restarts + 1} times, not restarted anymore")
+            worker.given_up = True
+            return
+        # A worker that dies right after its start is retried after a pause, not in a tight loop
+        if time.monotonic() - worker.started < self.args.interval * 2:
+            time.sleep(self.args.interval)
+        worker.restarts += 1
+        logging.warning(f"⚠️ {worker.name} exited with code {worker.process.returncode}, restart {worker.restarts}")
+        worker.start()
+
+    def stop(self):
+        self.stopping = True
+        logging.info("🛑 Stopping, terminating all Locust processes...")
+        for worker in self.workers:
+            worker.stop(self.args.stop_timeout)
+        self.master.stop(self.args.stop_timeout)
+        if self.stats_file:
+            self.stats_file.close()
+        logging.info("✅ All Locust processes terminated.")
+
+
+def _stop_on_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs a Locust master and CPU-pinned workers with disjoint device id ranges (Linux).",
+        epilog="Arguments after -- are passed to the master, e.g. -- --headless -u 100 -r 10 -t 30m")
+    parser.add_argument("-f", "--locustfile", default="locustfile.py")
+    parser.add_argument("--workers", type=int, default=0, help="Default: one per available core but the master's")
+    parser.add_argument("--devices", type=int, default=0,
+                        help="Device ids split across the workers (DEVICE_ID_RANGE), 0: lease them from the queue")
+    parser.add_argument("--first-device", type=int, default=1, help="Number of the first device id")
+    parser.add_argument("--web-port", type=int, default=8089)
+    parser.add_argument("--nofile", type=int, default=1048576, help="Open files limit of the Locust processes")
+    parser.add_argument("--interval", type=float, default=10, help="Seconds between two health checks and samples")
+    parser.add_argument("--max-restarts", type=int, default=5, help="Restarts of a worker before giving up on it")
+    parser.add_argument("--master-delay", type=float, default=5, help="Seconds between the master and the workers start")
+    parser.add_argument("--stop-timeout", type=float, default=60, help="Seconds for a process to stop on SIGINT")
+    parser.add_argument("--stats-file", default="workers_stats.csv", help="Per-worker samples (CSV), empty to disable")
+    argv = sys.argv[1:]
+    locust_args = []
+    if "--" in argv:
+        locust_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+
+    logging.info(f"🔹 Open files limit: {raise_open_files_limit(args.nofile)}")
+    launcher = Launcher(args, locust_args)
+    signal.signal(signal.SIGTERM, _stop_on_sigterm)
+    try:
+        launcher.start()
+        logging.info(f"✅ Ready! Open http://localhost:{args.web_port}")
+        launcher.watch()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        launcher.stop()
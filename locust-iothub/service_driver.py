@@ -0,0 +1,163 @@
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from services.iothub_service import IoTHubService, is_throttled
+from services.keyvault_service import KeyVaultService
+from utils import config
+from utils.device_ids import dec_to_12_pairs, parse_device_id_range
+from utils.latency_histogram import LatencyHistogram
+from utils.rate_limiter import RateLimiter
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
+
+OPERATIONS = ("c2d", "desired", "method")
+METHOD_NAME = "configure"
+# IoT Hub limits a twin string value to 4 KB: the padding of a desired patch is split in values of this size
+DESIRED_VALUE_SIZE = 4000
+
+
+class ServiceDriver:
+    """
+    Service side of the cloud-to-device traffic: every fan-out sends each device a C2D message, a
+    desired properties patch and/or a direct method call, at SERVICE_DRIVER_RATE operations per second
+    (halved when IoT Hub throttles). Everything sent is stamped with its send time (ts, epoch ms) and a
+    sequence number, so the devices report the downstream delivery latency to Locust (DOWNSTREAM).
+
+    The driver reports the service calls: C2D send and twin update as acknowledged by IoT Hub, method
+    calls from the request to the device answer (down through the proxy and back).
+    """
+
+    def __init__(self, iothub_service: IoTHubService, operations: list, rate: float, concurrency: int,
+                 payload_bytes: int = 0, method_timeout: int = 30):
+        self.iothub_service = iothub_service
+        self.operations = operations
+        self.rate_limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.payload_bytes = payload_bytes
+        self.method_timeout = method_timeout
+        self.stats = {operation: {"count": 0, "failures": 0, "throttled": 0, "latency": LatencyHistogram()}
+                      for operation in operations}
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        # The C2D messages share the AMQP connection of the registry manager, one send at a time
+        self._c2d_lock = threading.Lock()
+
+    def _stamp(self) -> dict:
+        return {"ts": int(time.time() * 1000), "seq": next(self._sequence)}
+
+    def _send_c2d(self, device_id: str):
+        with self._c2d_lock:
+            body = self._stamp()
+            if self.payload_bytes:
+                body["pad"] = "x" * self.payload_bytes
+            self.iothub_service.send_c2d_message(device_id, json.dumps(body), {"type": "config"})
+
+    def _update_desired(self, device_id: str):
+        desired = {"lastConfigurationChanged": datetime.datetime.now(datetime.timezone.utc).isoformat(), **self._stamp()}
+        if self.payload_bytes:
+            padding = "x" * self.payload_bytes
+            desired["config"] = {f"part{index}": padding[offset:offset + DESIRED_VALUE_SIZE]
+                                 for index, offset in enumerate(range(0, len(padding), DESIRED_VALUE_SIZE))}
+        self.iothub_service.update_desired_properties(device_id, desired)
+
+    def _invoke_method(self, device_id: str):
+        payload = self._stamp()
+        if self.payload_bytes:
+            payload["pad"] = "x" * self.payload_bytes
+        result = self.iothub_service.invoke_method(device_id, METHOD_NAME, payload, self.method_timeout)
+        if result.status != 200:
+            raise RuntimeError(f"method answered with status {result.status}")
+
+    def _run(self, operation: str, device_id: str):
+        self.rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            {"c2d": self._send_c2d, "desired": self._update_desired, "method": self._invoke_method}[operation](device_id)
+        except Exception as ex:
+            throttled = is_throttled(ex)
+            if throttled:
+                self.rate_limiter.throttled()
+            with self._lock:
+                stats = self.stats[operation]
+                stats["failures"] += 1
+                stats["throttled"] += throttled
+            logging.debug(f"{operation} to {device_id} failed: {ex}")
+            return
+        with self._lock:
+            stats = self.stats[operation]
+            stats["count"] += 1
+            stats["latency"].record((time.perf_counter() - start) * 1000)
+
+    def fan_out(self, device_ids: list):
+        """Sends every operation to every device, device after device, and waits for all of them."""
+        started = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            for device_id in device_ids:
+                for operation in self.operations:
+                    executor.submit(self._run, operation, device_id)
+            executor.shutdown(wait=True)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        elapsed = time.monotonic() - started
+        operations = len(device_ids) * len(self.operations)
+        logging.info(f"📡 Fan-out of {operations} operations to {len(device_ids)} devices in {elapsed:.1f}s "
+                     f"({operations / elapsed:.0f} operations/s, rate now {self.rate_limiter.rate:.1f}/s)")
+        self.report()
+
+    def report(self):
+        with self._lock:
+            for operation, stats in self.stats.items():
+                logging.info(f"📊 {operation}: {stats['count']} ok, {stats['failures']} failed "
+                             f"({stats['throttled']} throttled), latency ms {stats['latency'].summary()}")
+                stats["latency"].reset()
+
+
+def read_iothub_connection_string(params_from_key_vault: bool) -> str:
+    if params_from_key_vault:
+        return KeyVaultService(config.KEY_VAULT_NAME).get_secret(config.IOTHUB_CONNECTION_STRING_SECRET_NAME)
+    return config.IOTHUB_CONNECTION_STRING_SECRET_VALUE
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fans out C2D messages, desired property updates and direct "
+                                                 "method calls to the simulated devices at a controlled rate.")
+    parser.add_argument("--devices", default=f"1-{config.MAX_DEVICE_IDS}",
+                        help="Range of device numbers (as created by test_init.py), e.g. 1-7000")
+    parser.add_argument("--operations", default=config.SERVICE_DRIVER_OPERATIONS,
+                        help=f"Comma separated, among {', '.join(OPERATIONS)}")
+    parser.add_argument("--rate", type=float, default=config.SERVICE_DRIVER_RATE, help="Operations per second")
+    parser.add_argument("--concurrency", type=int, default=config.SERVICE_DRIVER_CONCURRENCY)
+    parser.add_argument("--interval", type=float, default=config.SERVICE_DRIVER_INTERVAL,
+                        help="Seconds between two fan-outs")
+    parser.add_argument("--payload-bytes", type=int, default=config.SERVICE_DRIVER_PAYLOAD_BYTES)
+    parser.add_argument("--fan-outs", type=int, default=0, help="Number of fan-outs, 0: until interrupted")
+    args = parser.parse_args()
+
+    operations = [operation.strip() for operation in args.operations.split(",") if operation.strip()]
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"Unknown operations {', '.join(sorted(unknown))}")
+    first, last = parse_device_id_range(args.devices)
+    device_ids = [dec_to_12_pairs(i) for i in range(first, last + 1)]
+
+    driver = ServiceDriver(IoTHubService(read_iothub_connection_string(config.PARAMS_SOURCE == "keyvault")),
+                           operations, args.rate, args.concurrency, args.payload_bytes, config.METHOD_RESPONSE_TIMEOUT)
+    try:
+        for fan_out in itertools.count(1):
+            started = time.monotonic()
+            logging.info(f"📡 Fan-out {fan_out}: {', '.join(operations)} to {len(device_ids)} devices")
+            driver.fan_out(device_ids)
+            if args.fan_outs and fan_out >= args.fan_outs:
+                break
+            time.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        pass
+    logging.info("DONE.")
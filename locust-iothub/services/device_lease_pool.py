@@ -0,0 +1,128 @@
+import logging
+import threading
+from collections import deque
+from services.queue_service import QueueService, MAX_MESSAGES_PER_RECEIVE
+from utils import config
+from utils.device_ids import dec_to_12_pairs, get_device_id_range
+
+
+class DeviceLeasePool:
+    """
+    Process-local pool of device ids leased from the Azure Queue.
+
+    Ids are received and deleted in batches, handed out locally without any network
+    call and sent back to the queue in bulk when the pool is closed.
+    """
+
+    def __init__(self, queue_service: QueueService, batch_size: int = MAX_MESSAGES_PER_RECEIVE):
+        self.queue_service = queue_service
+        self.batch_size = batch_size
+        self._available = deque()
+        self._leased = set()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> str:
+        with self._lock:
+            if not self._available:
+                self._refill()
+            device_id = self._available.popleft()
+            self._leased.add(device_id)
+            return device_id
+
+    def release(self, device_id: str):
+        """Gives the device id back to the local pool, it returns to the queue on close()."""
+        with self._lock:
+            if device_id in self._leased:
+                self._leased.remove(device_id)
+                self._available.append(device_id)
+
+    def close(self):
+        """Sends every device id owned by this process back to the queue."""
+        with self._lock:
+            device_ids = list(self._available) + list(self._leased)
+            self._available.clear()
+            self._leased.clear()
+        if device_ids:
+            failed = self.queue_service.send_messages(device_ids)
+            logging.info(f"🔄 Released {len(device_ids) - failed} devices to the queue")
+
+    def _refill(self):
+        known = self._leased.union(self._available)
+        # A batch of duplicates only adds nothing: receive the next one
+        while not self._available:
+            messages = self.queue_service.receive_messages(self.batch_size)
+            if not messages:
+                raise LookupError("No free device ids left in the queue")
+            self.queue_service.delete_messages(messages)
+            for message in messages:
+                if message.content in known:
+                    logging.warning(f"Duplicate device id {message.content} received from the queue, skipped")
+                    continue
+                known.add(message.content)
+                self._available.append(message.content)
+
+
+class DeviceRangePool:
+    """
+    Device ids of a range owned by this process alone (one range per worker, see run_locust_workers.py):
+    same interface as DeviceLeasePool without any queue, so acquiring an id needs no coordination.
+    """
+
+    def __init__(self, first: int, last: int):
+        self.first = first
+        self.last = last
+        self._next = first
+        self._available = deque()
+        self._leased = set()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> str:
+        with self._lock:
+            if self._available:
+                device_id = self._available.popleft()
+            elif self._next <= self.last:
+                device_id = dec_to_12_pairs(self._next)
+                self._next += 1
+            else:
+                raise LookupError(f"No free device ids left in the range {self.first}-{self.last}")
+            self._leased.add(device_id)
+            return device_id
+
+    def release(self, device_id: str):
+        with self._lock:
+            if device_id in self._leased:
+                self._leased.remove(device_id)
+                self._available.append(device_id)
+
+    def close(self):
+        with self._lock:
+            self._available.clear()
+            self._leased.clear()
+            self._next = self.first
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_lease_pool(storage_connection_string: str, queue_name: str) -> DeviceLeasePool:
+    """Returns the lease pool of this process for the given queue, or of its device id range when it has one."""
+    with _pools_lock:
+        pool = _pools.get(queue_name)
+        if pool is None:
+            device_id_range = get_device_id_range(config.DEVICE_ID_RANGE)
+            if device_id_range:
+                pool = DeviceRangePool(*device_id_range)
+                logging.info(f"🔹 Device ids {device_id_range[0]}-{device_id_range[1]} owned by this process")
+            else:
+                pool = DeviceLeasePool(QueueService(storage_connection_string, queue_name))
+            _pools[queue_name] = pool
+        return pool
+
+
+def close_lease_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -1,5 +1,24 @@
+import base64
+import logging
+import secrets
+import time
 from azure.iot.hub import IoTHubRegistryManager
-from azure.iot.hub.models import Twin
+from azure.iot.hub.models import Twin, TwinProperties, CloudToDeviceMethod
+from azure.iot.hub.protocol.models import ExportImportDevice, AuthenticationMechanism, SymmetricKey, PropertyContainer
+from utils.rate_limiter import RateLimiter
+
+# Maximum number of devices accepted by a single registry bulk operation
+BULK_BATCH_SIZE = 100
+
+
+def generate_device_key() -> str:
+    return base64.b64encode(secrets.token_bytes(32)).decode("utf-8")
+
+
+def is_throttled(ex: Exception) -> bool:
+    response = getattr(ex, "response", None)
+    return getattr(response, "status_code", None) == 429
+
 
 class IoTHubService:
     def __init__(self, connection_string: str):
@@ -25,4 +44,80 @@ class IoTHubService:
         return self.registry_manager.get_twin(device_id)
 
     def update_twin(self, device_id: str, twin_patch: Twin):
-        self.registry_manager.update_twin(device_id, twin_patch, twin_patch.etag)
\ No newline at end of file
+        self.registry_manager.update_twin(device_id, twin_patch, twin_patch.etag)
+
+    def update_desired_properties(self, device_id: str, desired: dict):
+        """Patches the desired properties whatever the twin version, the device gets them as one PATCH."""
+        self.registry_manager.update_twin(device_id, Twin(properties=TwinProperties(desired=desired)), "*")
+
+    def send_c2d_message(self, device_id: str, payload: str, properties: dict = None):
+        self.registry_manager.send_c2d_message(device_id, payload, properties=properties or {})
+
+    def invoke_method(self, device_id: str, method_name: str, payload, timeout: int = 30):
+        """Calls a direct method and returns its result (status and payload of the device answer)."""
+        method = CloudToDeviceMethod(method_name=method_name, payload=payload, response_timeout_in_seconds=timeout)
+        return self.registry_manager.invoke_device_method(device_id, method)
+
+    def bulk_provision_devices(self, device_keys: dict, tags: dict = None, desired: dict = None,
+                               batches_per_second: float = 1.0) -> dict:
+        """
+        Creates (or updates) the devices with the given primary keys, twin tags and desired
+        properties in batches of BULK_BATCH_SIZE. Returns the keys of the provisioned devices.
+        """
+        devices = [
+            ExportImportDevice(
+                id=device_id,
+                import_mode="createOrUpdate",
+                status="enabled",
+                authentication=AuthenticationMechanism(
+                    type="sas",
+                    symmetric_key=SymmetricKey(primary_key=device_key, secondary_key=generate_device_key())
+                ),
+                tags=tags,
+                properties=PropertyContainer(desired=desired) if desired else None
+            )
+            for device_id, device_key in device_keys.items()
+        ]
+        failed = self._bulk_import(devices, "Provisioned", batches_per_second)
+        return {device_id: key for device_id, key in device_keys.items() if device_id not in failed}
+
+    def bulk_delete_devices(self, device_ids: list, batches_per_second: float = 1.0) -> list:
+        """Deletes the devices in batches of BULK_BATCH_SIZE. Returns the ids of the deleted devices."""
+        devices = [ExportImportDevice(id=device_id, import_mode="delete") for device_id in device_ids]
+        failed = self._bulk_import(devices, "Deleted", batches_per_second)
+        return [device_id for device_id in device_ids if device_id not in failed]
+
+    def _bulk_import(self, devices: list, action: str, batches_per_second: float,
+                     max_retries: int = 5) -> set:
+        """Runs the bulk operation batch by batch, backing off on throttling. Returns the failed ids."""
+        rate_limiter = RateLimiter(batches_per_second, burst=1)
+        failed = set()
+        done = 0
+        started = time.monotonic()
+        for i in range(0, len(devices), BULK_BATCH_SIZE):
+            batch = devices[i:i + BULK_BATCH_SIZE]
+            for attempt in range(1, max_retries + 1):
+                rate_limiter.acquire()
+                try:
+                    result = self.registry_manager.bulk_create_or_update_devices(batch)
+                    for error in result.errors or []:
+                        # A device already gone is not a failure for a delete
+                        if action == "Deleted" and error.error_code == "DeviceNotFound":
+                            continue
+                        failed.add(error.device_id)
+                        logging.error(f"{action} device {error.device_id} failed: {error.error_status}")
+                    break
+                except Exception as ex:
+                    if is_throttled(ex):
+                        rate_limiter.throttled()
+                        logging.warning(f"Registry throttled, slowing down to {rate_limiter.rate:.2f} batches/s")
+                    else:
+                        logging.error(f"Bulk operation failed ({attempt} of {max_retries}): {ex}")
+                    if attempt == max_retries:
+                        failed.update(device.id for device in batch)
+                    else:
+                        time.sleep(2 ** attempt)
+            done += len(batch)
+            elapsed = time.monotonic() - started
+            logging.info(f"{action} {done} of {len(devices)} devices ({done / elapsed:.0f} devices/s, {len(failed)} failed)")
+        return failed
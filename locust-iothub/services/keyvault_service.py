@@ -1,5 +1,9 @@
+import atexit
 import base64
+import os
 import tempfile
+import threading
+import time
 from azure.identity import ManagedIdentityCredential
 from azure.identity import AzureCliCredential
 from azure.keyvault.secrets import SecretClient
@@ -7,26 +11,93 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.serialization.pkcs12 import load_key_and_certificates
 
+# Process-wide state shared by every KeyVaultService instance
+_clients = {}
+_secrets = {}
+_certificate_paths = {}
+_fetch_locks = {}
+_certificate_writes = 0
+_lock = threading.Lock()
+
+
+def _fetch_lock(key) -> threading.Lock:
+    with _lock:
+        return _fetch_locks.setdefault(key, threading.Lock())
+
+
+@atexit.register
+def _remove_certificate_files():
+    with _lock:
+        paths = list(_certificate_paths.values())
+        _certificate_paths.clear()
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def certificate_file_stats() -> dict:
+    """CA bundle files of the process and files written so far: writes growing over a run mean leaked temp files."""
+    with _lock:
+        return {"files": len(_certificate_paths), "writes": _certificate_writes}
+
+
 class KeyVaultService:
+    """
+    Key Vault access shared by the whole process: one SecretClient per vault, a TTL cache
+    of secret values (concurrent callers wait on a single fetch) and one CA bundle file
+    per certificate, removed when the process exits.
+    """
 
-    def __init__(self, key_vault_name: str, managed_identity_client_id: str = None):
-        if not managed_identity_client_id:
-            credential = AzureCliCredential()
-        else:
-            credential = ManagedIdentityCredential(client_id=managed_identity_client_id)
+    def __init__(self, key_vault_name: str, managed_identity_client_id: str = None, secret_ttl: float = 300):
+        self.key_vault_name = key_vault_name
+        self.secret_ttl = secret_ttl
 
-        self.client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
+        client_key = (key_vault_name, managed_identity_client_id)
+        with _lock:
+            client = _clients.get(client_key)
+            if client is None:
+                if not managed_identity_client_id:
+                    credential = AzureCliCredential()
+                else:
+                    credential = ManagedIdentityCredential(client_id=managed_identity_client_id)
+                client = SecretClient(vault_url=f"https://{key_vault_name}.vault.azure.net/", credential=credential)
+                _clients[client_key] = client
+        self.client = client
 
     def get_secret(self, name: str) -> str:
-        return self.client.get_secret(name).value
+        key = (self.key_vault_name, name)
+        cached = _secrets.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        with _fetch_lock(key):
+            # Another caller may have fetched it while we were waiting
+            cached = _secrets.get(key)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+            value = self.client.get_secret(name).value
+            _secrets[key] = (value, time.monotonic() + self.secret_ttl)
+            return value
 
     def set_secret(self, name: str, value: str):
         self.client.set_secret(name, value)
+        _secrets.pop((self.key_vault_name, name), None)
 
     def get_certificate_path(self, name: str) -> str:
-        certificate = self.client.get_secret(name)
-        cert_bytes = base64.b64decode(certificate.value)
+        global _certificate_writes
+        key = (self.key_vault_name, name)
+        with _fetch_lock(("certificate",) + key):
+            ca_path = _certificate_paths.get(key)
+            if ca_path is None or not os.path.exists(ca_path):
+                ca_path = self._write_certificate(base64.b64decode(self.get_secret(name)))
+                with _lock:
+                    _certificate_paths[key] = ca_path
+                    _certificate_writes += 1
+            return ca_path
 
+    @staticmethod
+    def _write_certificate(cert_bytes: bytes) -> str:
         # Write to a temporary file. If it's a PFX: convert to PEM
         try:
             private_key, cert, additional_certs = load_key_and_certificates(cert_bytes, password=None, backend=default_backend())
@@ -43,4 +114,4 @@ class KeyVaultService:
                 f.write(cert_bytes)
                 ca_path = f.name
 
-        return ca_path
\ No newline at end of file
+        return ca_path
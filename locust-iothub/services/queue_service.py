@@ -1,5 +1,10 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from azure.storage.queue import QueueClient
 
+# Maximum number of messages returned by a single receive call
+MAX_MESSAGES_PER_RECEIVE = 32
+
 class QueueService:
     def __init__(self, connection_string: str, queue_name: str):
         self.queue = QueueClient.from_connection_string(connection_string, queue_name)
@@ -13,8 +18,32 @@ class QueueService:
     def send_message(self, message: str):
         self.queue.send_message(message)
 
+    def send_messages(self, messages: list, max_workers: int = 32, progress_every: int = 0):
+        """Sends the messages concurrently. Returns the number of failed sends."""
+        failed = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.queue.send_message, message) for message in messages]
+            for i, future in enumerate(futures, start=1):
+                try:
+                    future.result()
+                except Exception as ex:
+                    failed += 1
+                    logging.error(f"Sending message failed: {ex}")
+                if progress_every and i % progress_every == 0:
+                    logging.info(f"Sent {i} of {len(messages)} messages")
+        return failed
+
     def receive_message(self):
         return self.queue.receive_message()
 
-    def delete_message(self):
-        return self.queue.delete_message()
\ No newline at end of file
+    def receive_messages(self, max_messages: int = MAX_MESSAGES_PER_RECEIVE, visibility_timeout: int = None):
+        return list(self.queue.receive_messages(messages_per_page=max_messages,
+                                                max_messages=max_messages,
+                                                visibility_timeout=visibility_timeout))
+
+    def delete_message(self, message):
+        return self.queue.delete_message(message)
+
+    def delete_messages(self, messages: list, max_workers: int = 32):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.queue.delete_message, messages))
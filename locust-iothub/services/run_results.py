@@ -0,0 +1,101 @@
+import logging
+import os
+import re
+import threading
+import time
+from services.storage_service import StorageService
+
+# Fallback run id of this process, when neither config.RUN_ID nor the RUN_ID environment variable is set
+_process_run_id = time.strftime("%Y%m%d-%H%M%S")
+
+
+def get_run_id(configured: str = "") -> str:
+    return configured or os.environ.get("RUN_ID") or _process_run_id
+
+
+def metric_name(request_type: str, name: str) -> str:
+    """Table property prefix of a request row, e.g. ("TLS", "handshake (resumed)") -> tls_handshake_resumed."""
+    return re.sub(r"\W+", "_", f"{request_type}_{name}").strip("_").lower()
+
+
+class RunResultsRecorder:
+    """
+    Aggregates the Locust requests per device (device_id from the request context) and saves them,
+    with the run statistics, to Azure Tables. Every run is one partition, so the rows are written
+    in 100-entity transactions and a run is read back with a single partition query.
+    """
+
+    def __init__(self, run_id: str, device_table: str, summary_table: str):
+        self.run_id = run_id
+        self.device_table = device_table
+        self.summary_table = summary_table
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def on_request(self, request_type, name, response_time, response_length, exception=None, context=None, **kwargs):
+        device_id = (context or {}).get("device_id")
+        if device_id is None:
+            return
+        metric = metric_name(request_type, name)
+        with self._lock:
+            metrics = self._devices.setdefault(device_id, {})
+            # count, failures, total response time, max response time
+            values = metrics.get(metric)
+            if values is None:
+                values = metrics[metric] = [0, 0, 0.0, 0.0]
+            values[0] += 1
+            if exception is not None:
+                values[1] += 1
+            values[2] += response_time
+            values[3] = max(values[3], response_time)
+
+    def device_entities(self):
+        with self._lock:
+            devices = {device_id: {metric: list(values) for metric, values in metrics.items()}
+                       for device_id, metrics in self._devices.items()}
+        for device_id, metrics in devices.items():
+            entity = {"PartitionKey": self.run_id, "RowKey": device_id}
+            for metric, (count, failures, total, maximum) in metrics.items():
+                entity[f"{metric}_count"] = count
+                entity[f"{metric}_failures"] = failures
+                entity[f"{metric}_avg_ms"] = round(total / count, 2)
+                entity[f"{metric}_max_ms"] = round(maximum, 2)
+            yield entity
+
+    def summary_entities(self, stats, user_count: int):
+        """One row per Locust statistics entry, plus the "Aggregated" row."""
+        for entry in list(stats.entries.values()) + [stats.total]:
+            if not entry.num_requests:
+                continue
+            yield {
+                "PartitionKey": self.run_id,
+                "RowKey": metric_name(entry.method or "", entry.name),
+                "RequestType": entry.method or "",
+                "Name": entry.name,
+                "Users": user_count,
+                "Requests": entry.num_requests,
+                "Failures": entry.num_failures,
+                "AvgMs": round(entry.avg_response_time, 2),
+                "P50Ms": entry.get_response_time_percentile(0.5),
+                "P95Ms": entry.get_response_time_percentile(0.95),
+                "P99Ms": entry.get_response_time_percentile(0.99),
+                "MaxMs": entry.max_response_time,
+                "Rps": round(entry.total_rps, 2),
+            }
+
+    def save_devices(self, storage: StorageService) -> int:
+        written = storage.upsert_table_entities(self.device_table, self.device_entities())
+        logging.info(f"💾 Saved the results of {written} devices for run {self.run_id}")
+        return written
+
+    def save_summary(self, storage: StorageService, stats, user_count: int) -> int:
+        written = storage.upsert_table_entities(self.summary_table, self.summary_entities(stats, user_count))
+        logging.info(f"💾 Saved {written} statistics rows for run {self.run_id}")
+        return written
+
+
+def load_run_summary(storage: StorageService, summary_table: str, run_id: str) -> dict:
+    """Returns the statistics rows of a run by RowKey."""
+    safe_run_id = run_id.replace("'", "''")
+    return {entity["RowKey"]: entity
+            for entity in storage.get_table_entities(summary_table, f"PartitionKey eq '{safe_run_id}'")}
@@ -3,6 +3,15 @@ import urllib.parse
 import hmac
 import base64
 import hashlib
+import logging
+import random
+import threading
+import re
+
+# Device ids made only of these characters are unchanged by quote_plus
+_SAFE_DEVICE_ID = re.compile(r"[A-Za-z0-9_.\-~]+")
+# quote_plus of the base64 alphabet
+_QUOTE_BASE64 = str.maketrans({"+": "%2B", "/": "%2F", "=": "%3D"})
 
 
 class SasTokenService:
@@ -20,3 +29,140 @@ class SasTokenService:
             f"&sig={urllib.parse.quote_plus(signature)}&se={ttl}"
         )
         return token
+
+    @staticmethod
+    def generate_sas_tokens(iothub_hostname: str, device_keys: dict, expiry_hours: int = 24, ttl: int = None) -> dict:
+        """
+        Signs the tokens of many devices at once, same format as generate_sas_token.
+        The expiry and the quoted hub prefix are computed once for the whole batch and
+        each signature is a single one-shot HMAC call.
+        """
+        if ttl is None:
+            ttl = int(time.time()) + expiry_hours * 60 * 60
+        prefix = urllib.parse.quote_plus(f"{iothub_hostname}/devices/")
+        suffix = f"\n{ttl}".encode("utf-8")
+        se = f"&se={ttl}"
+        digest = hmac.digest
+        b64encode = base64.b64encode
+        b64decode = base64.b64decode
+        quote_plus = urllib.parse.quote_plus
+        is_safe = _SAFE_DEVICE_ID.fullmatch
+        tokens = {}
+        for device_id, device_key in device_keys.items():
+            sr = prefix + (device_id if is_safe(device_id) else quote_plus(device_id))
+            signature = b64encode(digest(b64decode(device_key), sr.encode("utf-8") + suffix, "sha256"))
+            tokens[device_id] = f"SharedAccessSignature sr={sr}&sig={signature.decode('utf-8').translate(_QUOTE_BASE64)}{se}"
+        return tokens
+
+    @staticmethod
+    def derive_device_key(group_key: str, device_id: str) -> str:
+        """Derives the device key from a group key (HMAC-SHA256 of the device id), as DPS group enrollments do."""
+        return base64.b64encode(
+            hmac.digest(base64.b64decode(group_key), device_id.encode("utf-8"), "sha256")
+        ).decode("utf-8")
+
+
+def parse_sas_token(token: str) -> dict:
+    """Returns the fields (sr, sig, se, skn) of a SharedAccessSignature token, still URL-encoded."""
+    if not token or not token.startswith("SharedAccessSignature "):
+        raise ValueError("Not a SharedAccessSignature token")
+    fields = {}
+    for field in token[len("SharedAccessSignature "):].split("&"):
+        name, _, value = field.partition("=")
+        fields[name] = value
+    if not {"sr", "sig", "se"} <= fields.keys():
+        raise ValueError("SharedAccessSignature token without sr, sig or se")
+    return fields
+
+
+def verify_sas_token(token: str, device_key: str, now: float = None) -> bool:
+    """Checks the signature and the expiry of a token signed as SasTokenService does."""
+    fields = parse_sas_token(token)
+    if int(fields["se"]) < (now if now is not None else time.time()):
+        return False
+    to_sign = f"{fields['sr']}\n{fields['se']}".encode("utf-8")
+    expected = base64.b64encode(hmac.digest(base64.b64decode(device_key), to_sign, "sha256")).decode("utf-8")
+    return hmac.compare_digest(urllib.parse.unquote_plus(fields["sig"]), expected)
+
+
+class SasTokenManager:
+    """
+    Caches the SAS token of every device and renews it in the background before it expires.
+
+    Each token is renewed between renew_before and renew_before + jitter seconds ahead of
+    its expiry, so tokens issued together are not renewed (and devices do not reconnect)
+    all at the same moment. on_renewed(device_id, token) is called for every renewed token.
+    """
+
+    def __init__(self, iothub_hostname: str, expiry_hours: int = 24, renew_before: int = 3600,
+                 jitter: int = 3600, on_renewed=None, check_interval: int = 30):
+        self.iothub_hostname = iothub_hostname
+        self.expiry_hours = expiry_hours
+        self.renew_before = renew_before
+        self.jitter = jitter
+        self.on_renewed = on_renewed
+        self.check_interval = check_interval
+        self._keys = {}
+        self._tokens = {}
+        self._renew_at = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def add_devices(self, device_keys: dict) -> dict:
+        """Registers the devices and returns their tokens, signing only the ones not cached yet."""
+        with self._lock:
+            self._keys.update(device_keys)
+            missing = {device_id: key for device_id, key in device_keys.items() if device_id not in self._tokens}
+        if missing:
+            self._issue(missing)
+        self.start()
+        with self._lock:
+            return {device_id: self._tokens[device_id] for device_id in device_keys}
+
+    def get_token(self, device_id: str, device_key: str = None) -> str:
+        if device_key is not None or device_id not in self._tokens:
+            return self.add_devices({device_id: device_key or self._keys[device_id]})[device_id]
+        return self._tokens[device_id]
+
+    def remove_device(self, device_id: str):
+        with self._lock:
+            self._keys.pop(device_id, None)
+            self._tokens.pop(device_id, None)
+            self._renew_at.pop(device_id, None)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._renewal_loop, name="sas-renewal", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _issue(self, device_keys: dict):
+        ttl = int(time.time()) + self.expiry_hours * 60 * 60
+        tokens = SasTokenService.generate_sas_tokens(self.iothub_hostname, device_keys, ttl=ttl)
+        with self._lock:
+            for device_id, token in tokens.items():
+                if device_id not in self._keys:
+                    continue
+                self._tokens[device_id] = token
+                self._renew_at[device_id] = ttl - self.renew_before - random.uniform(0, self.jitter)
+        return tokens
+
+    def _renewal_loop(self):
+        while not self._stopped.wait(self.check_interval):
+            now = time.time()
+            with self._lock:
+                due = {device_id: self._keys[device_id]
+                       for device_id, renew_at in self._renew_at.items() if renew_at <= now}
+            if not due:
+                continue
+            tokens = self._issue(due)
+            logging.info(f"🔑 Renewed {len(tokens)} SAS tokens")
+            if self.on_renewed:
+                for device_id, token in tokens.items():
+                    try:
+                        self.on_renewed(device_id, token)
+                    except Exception as e:
+                        logging.error(f"[{device_id}] Error applying renewed SAS token: {e}")
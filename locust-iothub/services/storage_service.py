@@ -1,42 +1,151 @@
+import logging
+import threading
+from collections import OrderedDict
 from azure.core import MatchConditions
-from azure.data.tables import TableServiceClient, UpdateMode
+from azure.core.exceptions import ResourceNotFoundError
+from azure.data.tables import TableServiceClient, TableTransactionError, UpdateMode
+
+# Maximum number of operations in an entity group transaction
+MAX_TRANSACTION_OPERATIONS = 100
+
+
+class TableBatchWriter:
+    """
+    Buffered sink for a table: upserts and deletes are grouped by PartitionKey and sent as
+    transactions of up to 100 operations. A partition is sent as soon as it has 100 pending
+    operations, the rest on flush() (or when leaving the with block).
+    Operations on the same row in the buffer are merged, the last one wins.
+    """
+
+    def __init__(self, table, upsert_mode: UpdateMode = UpdateMode.MERGE):
+        self.table = table
+        self.upsert_mode = upsert_mode
+        self.written = 0
+        self.deleted = 0
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def upsert(self, entity: dict):
+        self._add(entity["PartitionKey"], entity["RowKey"], ("upsert", entity, {"mode": self.upsert_mode}))
+
+    def delete(self, partition_key: str, row_key: str):
+        self._add(partition_key, row_key, ("delete", {"PartitionKey": partition_key, "RowKey": row_key}))
+
+    def _add(self, partition_key: str, row_key: str, operation: tuple):
+        with self._lock:
+            operations = self._partitions.setdefault(partition_key, OrderedDict())
+            operations.pop(row_key, None)
+            operations[row_key] = operation
+            if len(operations) < MAX_TRANSACTION_OPERATIONS:
+                return
+            batch = list(self._partitions.pop(partition_key).values())
+        self._submit(batch)
+
+    def flush(self):
+        with self._lock:
+            partitions = list(self._partitions.values())
+            self._partitions = {}
+        for operations in partitions:
+            operations = list(operations.values())
+            for i in range(0, len(operations), MAX_TRANSACTION_OPERATIONS):
+                self._submit(operations[i:i + MAX_TRANSACTION_OPERATIONS])
+
+    def _submit(self, batch: list):
+        try:
+            self.table.submit_transaction(batch)
+        except TableTransactionError as e:
+            # The whole transaction is rolled back (e.g. a delete of a missing entity): apply one by one
+            logging.warning(f"Transaction of {len(batch)} operations failed ({e.error_code}), retrying one by one")
+            for operation in batch:
+                self._apply(operation)
+        else:
+            self._count(batch)
+
+    def _apply(self, operation: tuple):
+        kind, entity = operation[0], operation[1]
+        try:
+            if kind == "delete":
+                self.table.delete_entity(partition_key=entity["PartitionKey"], row_key=entity["RowKey"])
+            else:
+                self.table.upsert_entity(entity=entity, mode=self.upsert_mode)
+        except ResourceNotFoundError:
+            pass
+        self._count([operation])
+
+    def _count(self, batch: list):
+        for operation in batch:
+            if operation[0] == "delete":
+                self.deleted += 1
+            else:
+                self.written += 1
 
 
 class StorageService:
     def __init__(self, connection_string: str):
         self.service = TableServiceClient.from_connection_string(connection_string)
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _table(self, table_name: str):
+        """TableClient of the table, created on first use only (not on every call)."""
+        table = self._tables.get(table_name)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(table_name)
+                if table is None:
+                    table = self.service.create_table_if_not_exists(table_name)
+                    self._tables[table_name] = table
+        return table
 
     def create_table(self, table_name: str):
         self.service.create_table(table_name)
 
     def delete_table(self, table_name: str):
         self.service.delete_table(table_name)
+        self._tables.pop(table_name, None)
 
     def create_table_entity(self, table_name: str, entity: dict):
-        table = self.service.create_table_if_not_exists(table_name)
-        table.create_entity(entity=entity)
+        self._table(table_name).create_entity(entity=entity)
 
     def get_table_entity(self, table_name: str, partition_key: str, row_key: str):
-        table = self.service.create_table_if_not_exists(table_name)
-        return table.get_entity(partition_key=partition_key, row_key=row_key)
+        return self._table(table_name).get_entity(partition_key=partition_key, row_key=row_key)
 
-    def get_table_entities(self, table_name: str, filter: str = None):
-        table = self.service.create_table_if_not_exists(table_name)
+    def get_table_entities(self, table_name: str, filter: str = None, select: list = None):
+        table = self._table(table_name)
         if filter is None:
-            return table.list_entities()
+            return table.list_entities(select=select)
         else:
-            return table.query_entities(filter=filter)
+            return table.query_entities(query_filter=filter, select=select)
 
     def update_table_entity(self, table_name: str, entity: dict):
-        table = self.service.create_table_if_not_exists(table_name)
-        table.update_entity(
+        self._table(table_name).update_entity(
             entity=entity,
             mode=UpdateMode.MERGE,
             match_condition=MatchConditions.IfNotModified
         )
 
+    def batch_writer(self, table_name: str, upsert_mode: UpdateMode = UpdateMode.MERGE) -> TableBatchWriter:
+        return TableBatchWriter(self._table(table_name), upsert_mode)
+
+    def upsert_table_entities(self, table_name: str, entities) -> int:
+        """Upserts the entities in 100-operation transactions per partition."""
+        with self.batch_writer(table_name) as writer:
+            for entity in entities:
+                writer.upsert(entity)
+        return writer.written
+
+    def delete_table_entities(self, table_name: str, filter: str = None) -> int:
+        """Deletes the matching entities (all of them without a filter) in 100-operation transactions per partition."""
+        with self.batch_writer(table_name) as writer:
+            for entity in self.get_table_entities(table_name, filter, select=["PartitionKey", "RowKey"]):
+                writer.delete(entity["PartitionKey"], entity["RowKey"])
+        return writer.deleted
+
     def delete_all_table_entities(self, table_name: str):
-        table = self.service.create_table_if_not_exists(table_name)
-        entities = table.list_entities()
-        for entity in entities:
-            table.delete_entity(partition_key=entity["PartitionKey"], row_key=entity["RowKey"])
\ No newline at end of file
+        self.delete_table_entities(table_name)
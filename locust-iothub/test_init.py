@@ -1,9 +1,12 @@
+import argparse
 import time
 import logging
-from services.iothub_service import IoTHubService
+from services.iothub_service import IoTHubService, generate_device_key
+from services.sastoken_service import SasTokenService
 from services.keyvault_service import KeyVaultService
 from services.queue_service import QueueService
-from utils import config
+from utils import config, device_key_store, device_twin
+from utils.device_ids import dec_to_12_pairs
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
@@ -45,53 +48,47 @@ def allocate_devices_in_queue(storage_conn_string: str, queue_name: str, numb_of
                 logging.error(f"Creating queue failed {max_retries} times.")
 
     logging.info("Populating queue")
-    for i in range(1, numb_of_devices + 1):
-        device_id = _dec_to_12_pairs(i)
-        queue_service.send_message(device_id)
-        if i % 20 == 0:
-            logging.info(f"Added {i} device ids")
+    device_ids = [dec_to_12_pairs(i) for i in range(1, numb_of_devices + 1)]
+    failed = queue_service.send_messages(device_ids, progress_every=500)
+    logging.info(f"Added {numb_of_devices - failed} device ids ({failed} failed)")
 
 
-def deprovision_devices_in_iothub(iothub_conn_string: str, numb_of_devices: int):
-    iothub_service = IoTHubService(iothub_conn_string)
-
-    for i in range(1, numb_of_devices + 1):
-        device_id = _dec_to_12_pairs(i)
-        try:
-            logging.info(f"Device {i} of {numb_of_devices} deleted")
-            iothub_service.delete_device(device_id)
-        except Exception:
-            continue
-
-
-def _dec_to_12_pairs(n: int) -> str:
+def provision_devices_in_iothub(iothub_conn_string: str, numb_of_devices: int, key_store_path: str,
+                                group_key: str = None):
     """
-    Convert a decimal number into exactly 12 pairs (24 hex digits) joined by '-'.
-    Pads with leading zeros if needed.
-
-    Parameters
-    ----------
-    n : int
-        Decimal number to convert.
-
-    Returns
-    -------
-    str
-        Hex string in format '00-00-00-00-00-00-00-00-00-00-00-01'
+    Creates all the devices with their twin tags through the registry bulk API and exports their keys.
+    With a group key the device keys are derived from it, so workers don't need the key store.
     """
-    if not isinstance(n, int) or n < 0:
-        raise ValueError("Input must be a non-negative integer")
+    iothub_service = IoTHubService(iothub_conn_string)
+
+    device_ids = [dec_to_12_pairs(i) for i in range(1, numb_of_devices + 1)]
+    if group_key:
+        device_keys = {device_id: SasTokenService.derive_device_key(group_key, device_id) for device_id in device_ids}
+    else:
+        device_keys = {device_id: generate_device_key() for device_id in device_ids}
+    provisioned = iothub_service.bulk_provision_devices(device_keys,
+                                                        tags=device_twin.DEVICE_TAGS,
+                                                        desired=device_twin.desired_properties(),
+                                                        batches_per_second=config.BULK_BATCHES_PER_SECOND)
+    device_key_store.save(key_store_path, provisioned)
+    logging.info(f"Exported {len(provisioned)} device keys to {key_store_path}")
 
-    # Convert to hex string without '0x', in lowercase
-    hex_str = f"{n:024x}"  # 24 cifre esadecimali → 12 coppie
 
-    # Split pairs
-    pairs = [hex_str[i:i+2] for i in range(0, 24, 2)]
+def deprovision_devices_in_iothub(iothub_conn_string: str, numb_of_devices: int, key_store_path: str = None):
+    """Deletes all the devices through the registry bulk API."""
+    iothub_service = IoTHubService(iothub_conn_string)
 
-    return "-".join(pairs)
+    device_ids = [dec_to_12_pairs(i) for i in range(1, numb_of_devices + 1)]
+    deleted = iothub_service.bulk_delete_devices(device_ids, batches_per_second=config.BULK_BATCHES_PER_SECOND)
+    if key_store_path:
+        device_key_store.remove(key_store_path, deleted)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Initializes (or tears down) the devices used by the Locust test.")
+    parser.add_argument("--teardown", action="store_true", help="Delete the bulk provisioned devices and exit")
+    args = parser.parse_args()
+
     logging.info(f"START.")
 
     params_from_key_vault = config.PARAMS_SOURCE == "keyvault"
@@ -101,13 +98,21 @@ if __name__ == "__main__":
         kv_service = KeyVaultService(key_vault_name=config.KEY_VAULT_NAME)
         storage_connection_string = kv_service.get_secret(config.STORAGE_CONNECTION_STRING_SECRET_NAME)
         iothub_connection_string = kv_service.get_secret(config.IOTHUB_CONNECTION_STRING_SECRET_NAME)
+        device_group_key = kv_service.get_secret(config.DEVICE_GROUP_KEY_SECRET_NAME) if config.DEVICE_GROUP_KEY_SECRET_NAME else ""
     else:
         # Read secret from config file
         storage_connection_string = config.STORAGE_CONNECTION_STRING_SECRET_VALUE
         iothub_connection_string = config.IOTHUB_CONNECTION_STRING_SECRET_VALUE
+        device_group_key = config.DEVICE_GROUP_KEY_SECRET_VALUE
 
     number_of_devices = config.MAX_DEVICE_IDS
 
+    if args.teardown:
+        logging.info(f"Deleting iothub devices")
+        deprovision_devices_in_iothub(iothub_connection_string, number_of_devices, config.DEVICE_KEY_STORE)
+        logging.info(f"DONE.")
+        raise SystemExit(0)
+
     # Init queue devices
     logging.info(f"Allocating device ids in queue")
     allocate_devices_in_queue(storage_connection_string, config.STORAGE_QUEUE_NAME, number_of_devices)
@@ -116,4 +121,9 @@ if __name__ == "__main__":
     logging.info(f"Cleaning iothub devices")
     # deprovision_devices_in_iothub(iothub_connection_string, number_of_devices)
 
+    if config.PROVISIONING_MODE == "bulk":
+        logging.info(f"Provisioning iothub devices")
+        provision_devices_in_iothub(iothub_connection_string, number_of_devices, config.DEVICE_KEY_STORE,
+                                    device_group_key)
+
     logging.info(f"DONE.")
\ No newline at end of file
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("cryptography")
+
+from iothub_standin import IoTHubStandIn
+from mqtt.async_mqtt_engine import AsyncMqttEngine, DeviceSession
+from mqtt.request_stats import PUBLISH, CONNECT
+
+PUBLISH_INTERVAL = 0.2
+
+
+class RequestEvent:
+    def __init__(self):
+        self.requests = []
+
+    def fire(self, **kwargs):
+        self.requests.append(kwargs)
+
+    def count(self, request_type: str) -> int:
+        return sum(1 for r in list(self.requests) if r["request_type"] == request_type and r["exception"] is None)
+
+
+def wait_until(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def standin_port():
+    """Stand-in broker on a free port, served from its own event loop thread."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    broker = IoTHubStandIn(host="127.0.0.1", port=0, authenticate=False)
+    asyncio.run_coroutine_threadsafe(broker.start(), loop).result(10)
+    yield broker._server.sockets[0].getsockname()[1]
+
+    async def shutdown():
+        await broker.close()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(10)
+
+
+def test_reconnect_keeps_one_publish_schedule(standin_port):
+    event = RequestEvent()
+    engine = AsyncMqttEngine("127.0.0.1", port=standin_port, publish_interval=(PUBLISH_INTERVAL, PUBLISH_INTERVAL),
+                             request_event=event)
+    engine.start()
+    try:
+        engine.add_device(DeviceSession("d1", "localhost/d1/?api-version=2021-04-12", "token"))
+        wait_until(lambda: event.count(CONNECT) == 1)
+        # Token renewals reconnect the device within one publish interval
+        for connects in range(2, 5):
+            engine.update_password("d1", f"token-{connects}")
+            wait_until(lambda: event.count(CONNECT) == connects)
+        # The scheduler checks for new entries at least every second
+        time.sleep(1.2)
+        published = event.count(PUBLISH)
+        time.sleep(10 * PUBLISH_INTERVAL)
+        # One publish per interval: an extra schedule per reconnect would publish 4 times as often
+        assert 7 <= event.count(PUBLISH) - published <= 12
+    finally:
+        engine.stop()
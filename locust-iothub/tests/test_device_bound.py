@@ -0,0 +1,47 @@
+import time
+
+from mqtt.device_bound import DeviceBoundHandler
+from mqtt.request_stats import RequestReporter, RequestRejectedError, TWIN, TWIN_GET_NAME, TWIN_PATCH_NAME
+
+
+class RequestEvent:
+    def __init__(self):
+        self.requests = []
+
+    def fire(self, **kwargs):
+        self.requests.append(kwargs)
+
+
+def handler(timeout: float = 30):
+    event = RequestEvent()
+    return DeviceBoundHandler(RequestReporter(event), timeout), event.requests
+
+
+def test_twin_response_resolves_only_its_request():
+    device_bound, requests = handler()
+    context = {"device_id": "d1"}
+    get_topic, _ = device_bound.get_twin(context)
+    patch_topic, _ = device_bound.patch_reported(context, {"a": 1})
+    patch_rid = patch_topic.rpartition("=")[2]
+    get_rid = get_topic.rpartition("=")[2]
+
+    device_bound.handle(f"$iothub/twin/res/204/?$rid={patch_rid}&$version=2", b"", context)
+    device_bound.handle(f"$iothub/twin/res/500/?$rid={get_rid}", b"", context)
+    assert [(r["request_type"], r["name"], type(r["exception"])) for r in requests] == \
+        [(TWIN, TWIN_PATCH_NAME, type(None)), (TWIN, TWIN_GET_NAME, RequestRejectedError)]
+    # No early ack left behind in the tracker the response did not belong to
+    assert not device_bound.twin_get._early_acks and not device_bound.twin_patch._early_acks
+    assert len(device_bound.twin_get) == 0 and len(device_bound.twin_patch) == 0
+
+
+def test_expired_request_is_forgotten():
+    device_bound, requests = handler(timeout=0.01)
+    context = {"device_id": "d1"}
+    topic, _ = device_bound.get_twin(context)
+    time.sleep(0.02)
+    device_bound.expire()
+    assert len(requests) == 1 and requests[0]["exception"] is not None
+    # A late response is ignored rather than kept as an early ack
+    device_bound.handle(f"$iothub/twin/res/200/?$rid={topic.rpartition('=')[2]}", b"", context)
+    assert len(requests) == 1
+    assert not device_bound.twin_get._early_acks and not device_bound._owners
@@ -0,0 +1,47 @@
+import pytest
+
+from utils.device_ids import dec_to_12_pairs, parse_device_id_range, get_device_id_range, split_device_id_range
+
+
+def test_dec_to_12_pairs():
+    assert dec_to_12_pairs(1) == "00-00-00-00-00-00-00-00-00-00-00-01"
+    assert dec_to_12_pairs(7000) == "00-00-00-00-00-00-00-00-00-00-1b-58"
+    with pytest.raises(ValueError):
+        dec_to_12_pairs(-1)
+
+
+def test_parse_device_id_range():
+    assert parse_device_id_range("1-5000") == (1, 5000)
+    assert parse_device_id_range("7-7") == (7, 7)
+
+
+@pytest.mark.parametrize("value", ["", "5000", "a-b", "10-1", "1-", "-5"])
+def test_parse_invalid_device_id_range(value):
+    with pytest.raises(ValueError):
+        parse_device_id_range(value)
+
+
+@pytest.mark.parametrize("first, count, parts", [(1, 7000, 7), (1, 10, 3), (100, 5, 5), (1, 1001, 8)])
+def test_split_device_id_range(first, count, parts):
+    ranges = [parse_device_id_range(value) for value in split_device_id_range(first, count, parts)]
+    assert len(ranges) == parts
+    # Contiguous, disjoint, covering all the devices, sizes differing by one at most
+    assert ranges[0][0] == first
+    assert ranges[-1][1] == first + count - 1
+    for (_, last), (next_first, _) in zip(ranges, ranges[1:]):
+        assert next_first == last + 1
+    sizes = [last - start + 1 for start, last in ranges]
+    assert max(sizes) - min(sizes) <= 1
+
+
+def test_split_more_parts_than_devices():
+    with pytest.raises(ValueError):
+        split_device_id_range(1, 3, 4)
+
+
+def test_device_id_range_environment_wins(monkeypatch):
+    monkeypatch.delenv("DEVICE_ID_RANGE", raising=False)
+    assert get_device_id_range("") is None
+    assert get_device_id_range("1-10") == (1, 10)
+    monkeypatch.setenv("DEVICE_ID_RANGE", "11-20")
+    assert get_device_id_range("1-10") == (11, 20)
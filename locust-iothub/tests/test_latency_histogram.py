@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from utils.latency_histogram import LatencyHistogram
+
+
+def test_empty():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(99) == 0.0
+    assert histogram.summary() == {"count": 0}
+
+
+def test_small_values_are_exact():
+    histogram = LatencyHistogram()
+    for value_us in range(1, 101):
+        histogram.record(value_us / 1000)
+    assert histogram.percentile(50) == 0.05
+    assert histogram.percentile(100) == 0.1
+    assert histogram.summary()["min"] == 0.001
+
+
+@pytest.mark.parametrize("percent", [50, 90, 99, 99.9])
+def test_percentiles_within_precision(percent):
+    values = [random.uniform(0.5, 20000) for _ in range(20000)]
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    expected = sorted(values)[max(1, round(len(values) * percent / 100)) - 1]
+    # 7 precision bits: relative error below 1/128
+    assert histogram.percentile(percent) == pytest.approx(expected, rel=1 / 128)
+
+
+def test_max_is_never_exceeded():
+    histogram = LatencyHistogram()
+    histogram.record(1234.567)
+    assert histogram.percentile(100) == 1234.567
+
+
+def test_merge_equals_recording_everything():
+    first, second, everything = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+    for index in range(1000):
+        value = random.expovariate(1 / 50)
+        (first if index % 2 else second).record(value)
+        everything.record(value)
+    first.merge(second)
+    assert first.summary() == everything.summary()
+
+
+def test_negative_and_overflow():
+    histogram = LatencyHistogram(max_value_ms=1000)
+    histogram.record(-5)
+    histogram.record(5000)
+    summary = histogram.summary()
+    assert summary["negative"] == 1
+    assert summary["min"] == 0
+    assert summary["max"] == 1000
+
+
+def test_reset():
+    histogram = LatencyHistogram()
+    histogram.record(10)
+    histogram.reset()
+    assert histogram.total == 0
+    assert histogram.summary() == {"count": 0}
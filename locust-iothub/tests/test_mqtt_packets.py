@@ -0,0 +1,94 @@
+import asyncio
+import struct
+
+import pytest
+
+from mqtt import mqtt_packets
+
+
+def read(data: bytes):
+    """Feeds the bytes to a StreamReader and reads one packet back."""
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await mqtt_packets.read_packet(reader)
+    return asyncio.run(main())
+
+
+def test_connect_round_trip():
+    packet_type, _, body = read(mqtt_packets.encode_connect("device-1", "hub/device-1/?api-version=2021-04-12",
+                                                            "SharedAccessSignature sr=x", keepalive=120))
+    assert packet_type == mqtt_packets.CONNECT
+    assert mqtt_packets.decode_connect(body) == ("device-1", "hub/device-1/?api-version=2021-04-12",
+                                                 "SharedAccessSignature sr=x", 120)
+
+
+def test_connect_without_credentials():
+    _, _, body = read(mqtt_packets.encode_connect("device-1"))
+    assert mqtt_packets.decode_connect(body) == ("device-1", None, None, 60)
+
+
+def test_connack():
+    packet_type, _, body = read(mqtt_packets.encode_connack(5, session_present=True))
+    assert packet_type == mqtt_packets.CONNACK
+    assert body == b"\x01\x05"
+
+
+@pytest.mark.parametrize("qos, packet_id", [(0, 0), (1, 1), (1, 65535)])
+def test_publish_round_trip(qos, packet_id):
+    payload = b'{"Temperature": 21.5}'
+    packet_type, flags, body = read(mqtt_packets.encode_publish("devices/d1/messages/events/", payload, packet_id, qos))
+    assert packet_type == mqtt_packets.PUBLISH
+    assert mqtt_packets.decode_publish(flags, body) == ("devices/d1/messages/events/", packet_id, payload)
+
+
+@pytest.mark.parametrize("size", [0, 127, 128, 16383, 16384, 2097151, 2097152])
+def test_remaining_length_boundaries(size):
+    payload = b"x" * size
+    _, flags, body = read(mqtt_packets.encode_publish("t", payload, 0, qos=0))
+    assert mqtt_packets.decode_publish(flags, body)[2] == payload
+
+
+def test_puback_and_subscribe_round_trip():
+    packet_type, _, body = read(mqtt_packets.encode_puback(4242))
+    assert packet_type == mqtt_packets.PUBACK
+    assert mqtt_packets.decode_packet_id(body) == 4242
+
+    filters = ["devices/d1/messages/devicebound/#", "$iothub/twin/res/#"]
+    packet_type, flags, body = read(mqtt_packets.encode_subscribe(7, filters))
+    assert (packet_type, flags) == (mqtt_packets.SUBSCRIBE, 0x02)
+    assert mqtt_packets.decode_subscribe(body) == (7, [(topic_filter, 1) for topic_filter in filters])
+
+    packet_type, _, body = read(mqtt_packets.encode_suback(7, [1, 0x80]))
+    assert packet_type == mqtt_packets.SUBACK
+    assert body == b"\x00\x07\x01\x80"
+
+
+def test_malformed_remaining_length():
+    with pytest.raises(ValueError):
+        read(b"\x30\xff\xff\xff\xff\x01")
+
+
+def test_truncated_stream():
+    with pytest.raises(asyncio.IncompleteReadError):
+        read(mqtt_packets.encode_publish("t", b"payload", 1)[:-1])
+
+
+def test_truncated_publish_body():
+    with pytest.raises(struct.error):
+        mqtt_packets.decode_publish(0x02, b"\x00")
+    with pytest.raises(struct.error):
+        # QoS 1 without its packet id
+        mqtt_packets.decode_publish(0x02, b"\x00\x01t")
+
+
+def test_publish_topic_not_utf8():
+    with pytest.raises(UnicodeDecodeError):
+        mqtt_packets.decode_publish(0, b"\x00\x02\xff\xfe")
+
+
+def test_connect_unsupported_protocol():
+    body = b"\x00\x06MQIsdp\x03\x02\x00\x3c\x00\x01d"
+    with pytest.raises(ValueError):
+        mqtt_packets.decode_connect(body)
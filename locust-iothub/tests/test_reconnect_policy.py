@@ -0,0 +1,50 @@
+import pytest
+
+from mqtt.reconnect_policy import (ReconnectPolicy, FixedDelay, ExponentialBackoff, DecorrelatedJitter,
+                                   create_reconnect_policy)
+
+
+def test_policy_without_next_delay_cannot_be_created():
+    with pytest.raises(TypeError):
+        ReconnectPolicy()
+
+
+def test_fixed_delay():
+    policy = FixedDelay(3)
+    assert [policy.next_delay() for _ in range(3)] == [3, 3, 3]
+
+
+def test_exponential_backoff_capped_and_reset():
+    policy = ExponentialBackoff(base_delay=1, max_delay=10)
+    assert [policy.next_delay() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+    policy.reset()
+    assert policy.next_delay() == 1
+
+
+def test_exponential_full_jitter_bounds():
+    policy = ExponentialBackoff(base_delay=1, max_delay=10, jitter=1)
+    for attempt in range(8):
+        assert 0 <= policy.next_delay() <= min(10, 2 ** attempt)
+
+
+def test_decorrelated_jitter_bounds():
+    policy = DecorrelatedJitter(base_delay=1, max_delay=30)
+    previous = 1
+    for _ in range(50):
+        delay = policy.next_delay()
+        assert 1 <= delay <= min(30, previous * 3)
+        previous = delay
+    policy.reset()
+    assert policy.next_delay() <= 3
+
+
+@pytest.mark.parametrize("name, policy_class", [("fixed", FixedDelay), ("exponential", ExponentialBackoff),
+                                                 ("exponential-jitter", ExponentialBackoff),
+                                                 ("decorrelated", DecorrelatedJitter)])
+def test_create_reconnect_policy(name, policy_class):
+    assert isinstance(create_reconnect_policy(name, 1, 60), policy_class)
+
+
+def test_unknown_reconnect_policy():
+    with pytest.raises(ValueError):
+        create_reconnect_policy("linear", 1, 60)
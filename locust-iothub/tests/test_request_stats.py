@@ -0,0 +1,50 @@
+import time
+
+from mqtt.request_stats import PublishTracker, RequestReporter, PublishTimeoutError, PUBLISH, TELEMETRY_NAME
+
+
+class RequestEvent:
+    def __init__(self):
+        self.requests = []
+
+    def fire(self, **kwargs):
+        self.requests.append(kwargs)
+
+
+def tracker(timeout: float = 30):
+    event = RequestEvent()
+    return PublishTracker(RequestReporter(event), timeout), event.requests
+
+
+def test_ack_after_send():
+    publish_tracker, requests = tracker()
+    publish_tracker.sent(1, 10, {"device_id": "d1"})
+    publish_tracker.acked(1)
+    assert len(publish_tracker) == 0
+    assert [(r["request_type"], r["name"], r["response_length"], r["exception"], r["context"]) for r in requests] == \
+        [(PUBLISH, TELEMETRY_NAME, 10, None, {"device_id": "d1"})]
+
+
+def test_ack_before_send_is_matched_by_sent():
+    publish_tracker, requests = tracker()
+    start = time.perf_counter()
+    publish_tracker.acked(7)
+    assert requests == []
+    publish_tracker.sent(7, 10, start=start - 0.05)
+    assert len(publish_tracker) == 0
+    assert len(requests) == 1
+    assert requests[0]["exception"] is None
+    assert 50 <= requests[0]["response_time"] < 1000
+
+
+def test_expire():
+    publish_tracker, requests = tracker(timeout=0.01)
+    publish_tracker.sent(1, 10)
+    publish_tracker.acked(99)   # never sent: dropped once expired
+    time.sleep(0.02)
+    publish_tracker.expire()
+    assert len(requests) == 1
+    assert isinstance(requests[0]["exception"], PublishTimeoutError)
+    publish_tracker.sent(99, 10)
+    assert len(requests) == 1
+    assert len(publish_tracker) == 1
@@ -0,0 +1,35 @@
+import base64
+import time
+
+from services import sastoken_service
+from services.sastoken_service import SasTokenService, parse_sas_token, verify_sas_token
+
+DEVICE_KEY = base64.b64encode(b"0123456789abcdef0123456789abcdef").decode("utf-8")
+HOSTNAME = "myhub.azure-devices.net"
+
+
+def test_batch_tokens_match_single_tokens(monkeypatch):
+    now = 1_700_000_000
+    monkeypatch.setattr(sastoken_service.time, "time", lambda: now)
+    device_keys = {"00-00-00-00-00-00-00-00-00-00-00-01": DEVICE_KEY,
+                   "device with spaces/#": DEVICE_KEY,
+                   "d2": SasTokenService.derive_device_key(DEVICE_KEY, "d2")}
+    tokens = SasTokenService.generate_sas_tokens(HOSTNAME, device_keys, expiry_hours=2)
+    for device_id, device_key in device_keys.items():
+        assert tokens[device_id] == SasTokenService.generate_sas_token(HOSTNAME, device_id, device_key, 2)
+
+
+def test_verify_sas_token():
+    token = SasTokenService.generate_sas_tokens(HOSTNAME, {"d1": DEVICE_KEY})["d1"]
+    fields = parse_sas_token(token)
+    assert fields["sr"] == "myhub.azure-devices.net%2Fdevices%2Fd1"
+    assert verify_sas_token(token, DEVICE_KEY)
+    assert not verify_sas_token(token, SasTokenService.derive_device_key(DEVICE_KEY, "other"))
+    assert not verify_sas_token(token, DEVICE_KEY, now=time.time() + 25 * 3600)
+
+
+def test_derive_device_key_is_stable_per_device():
+    first = SasTokenService.derive_device_key(DEVICE_KEY, "d1")
+    assert first == SasTokenService.derive_device_key(DEVICE_KEY, "d1")
+    assert first != SasTokenService.derive_device_key(DEVICE_KEY, "d2")
+    assert len(base64.b64decode(first)) == 32
@@ -0,0 +1,59 @@
+from utils import stream_stats
+from utils.stream_stats import DeviceStream, FleetStreamStats
+
+
+def test_in_order_stream_starting_mid_way():
+    stream = DeviceStream()
+    assert [stream.receive(seq) for seq in (41, 42, 43)] == ["in-order"] * 3
+    assert stream.missing == set()
+
+
+def test_gap_filled_late():
+    stream = DeviceStream()
+    assert [stream.receive(seq) for seq in (1, 2, 5)] == ["in-order", "in-order", "gap"]
+    assert stream.missing == {3, 4}
+    assert stream.receive(4) == "late"
+    assert stream.missing == {3}
+
+
+def test_duplicate():
+    stream = DeviceStream()
+    stream.receive(1)
+    stream.receive(2)
+    assert stream.receive(2) == "duplicate"
+
+
+def test_restart_loses_open_gaps():
+    stream = DeviceStream()
+    for seq in (1, 2, 6):
+        stream.receive(seq)
+    assert stream.receive(1) == "restart"
+    assert stream.lost == 3
+    assert stream.missing == set()
+    assert stream.highest == 1
+
+
+def test_missing_capped(monkeypatch):
+    monkeypatch.setattr(stream_stats, "MAX_MISSING_PER_DEVICE", 10)
+    stream = DeviceStream()
+    stream.receive(1)
+    stream.receive(30)
+    assert len(stream.missing) == 10
+    assert stream.lost == 18
+
+
+def test_fleet_summary():
+    stats = FleetStreamStats()
+    for seq in (1, 2, 4, 4, 3):
+        stats.record("d1", seq, sent_ms=1000, enqueued_ms=1010, received_ms=1050)
+    stats.record("d2", 7, sent_ms=1000, enqueued_ms=None, received_ms=1020)
+    stats.record_unstamped()
+    summary = stats.summary(interval_seconds=2)
+    assert summary["devices"] == 2
+    assert summary["messages"] == 6
+    assert summary["messages_per_second"] == 3.0
+    assert (summary["missing"], summary["duplicates"], summary["reordered"], summary["unstamped"]) == (0, 1, 1, 1)
+    assert summary["end_to_end_ms"]["max"] == 50
+    assert summary["ingestion_ms"]["count"] == 5
+    assert stats.summary(interval_seconds=1)["end_to_end_ms"] == {"count": 0}
+    assert stats.totals()["end_to_end_ms"]["count"] == 6
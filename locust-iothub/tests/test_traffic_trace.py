@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from mqtt import traffic_trace
+from mqtt.traffic_trace import TraceRecorder, TraceReader, open_traces, merge_events, sized_payload
+
+
+def record(path, events):
+    recorder = TraceRecorder(str(path))
+    for event, device_id, size in events:
+        recorder.record(event, device_id, size)
+    recorder.close()
+    return recorder
+
+
+def test_round_trip(tmp_path):
+    events = [(traffic_trace.CONNECT, "d1", 0), (traffic_trace.PUBLISH, "d1", 120),
+              (traffic_trace.CONNECT, "d2", 0), (traffic_trace.PUBLISH, "d2", 4096),
+              (traffic_trace.DISCONNECT, "d1", 0)]
+    recorder = record(tmp_path / "a.trace", events)
+    reader = TraceReader(str(tmp_path / "a.trace"))
+    assert len(reader) == 5
+    assert reader.device_ids == ["d1", "d2"]
+    assert reader.start == recorder.start
+    read = list(reader.events())
+    assert [(event, device_id, size) for _, event, device_id, size in read] == events
+    times = [timestamp for timestamp, _, _, _ in read]
+    assert times == sorted(times)
+    assert reader.duration() == pytest.approx(times[-1] - reader.start, abs=1e-6)
+    reader.close()
+
+
+def test_device_filter(tmp_path):
+    record(tmp_path / "a.trace", [(traffic_trace.PUBLISH, f"d{index % 3}", index) for index in range(9)])
+    reader = TraceReader(str(tmp_path / "a.trace"))
+    assert [size for _, _, _, size in reader.events({"d1"})] == [1, 4, 7]
+    reader.close()
+
+
+def test_record_after_close_is_ignored(tmp_path):
+    recorder = record(tmp_path / "a.trace", [(traffic_trace.CONNECT, "d1", 0)])
+    recorder.record(traffic_trace.PUBLISH, "d1", 10)
+    recorder.close()
+    assert len(TraceReader(str(tmp_path / "a.trace"))) == 1
+
+
+def test_merge_in_time_order(tmp_path):
+    first = TraceRecorder(str(tmp_path / "w1.trace"))
+    second = TraceRecorder(str(tmp_path / "w2.trace"))
+    for index in range(20):
+        (first if index % 3 else second).record(traffic_trace.PUBLISH, f"d{index}", index)
+    first.close()
+    second.close()
+    readers = open_traces(str(tmp_path / "*.trace"))
+    merged = list(merge_events(readers))
+    assert [size for _, _, _, size in merged] == list(range(20))
+    assert [size for _, _, _, size in merge_events(readers, {"d3", "d4"})] == [3, 4]
+    for reader in readers:
+        reader.close()
+
+
+def test_unclosed_trace_is_rejected(tmp_path):
+    recorder = TraceRecorder(str(tmp_path / "a.trace"))
+    recorder.record(traffic_trace.CONNECT, "d1")
+    recorder._file.flush()
+    with pytest.raises(ValueError):
+        TraceReader(str(tmp_path / "a.trace"))
+    recorder.close()
+
+
+def test_not_a_trace(tmp_path):
+    (tmp_path / "a.trace").write_bytes(b"x" * 100)
+    with pytest.raises(ValueError):
+        TraceReader(str(tmp_path / "a.trace"))
+    with pytest.raises(FileNotFoundError):
+        open_traces(str(tmp_path / "*.missing"))
+
+
+@pytest.mark.parametrize("size", [0, 10, 40, 256, 10000])
+def test_sized_payload(size):
+    payload = sized_payload(42, size)
+    body = json.loads(payload)
+    assert body["seq"] == 42
+    assert "ts" in body
+    if size > 40:
+        assert len(payload) == size
@@ -0,0 +1,32 @@
+import json
+import os
+import re
+
+
+class FileCheckpointStore:
+    """
+    Local Event Hub checkpoints for offline runs: one JSON file per partition, written atomically.
+    Every partition is owned by a single consumer process, so processes never write the same file.
+    """
+
+    def __init__(self, directory: str, eventhub_name: str, consumer_group: str):
+        self.directory = os.path.join(directory, re.sub(r"[^\w.-]", "_", f"{eventhub_name}-{consumer_group}"))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, partition_id: str) -> str:
+        return os.path.join(self.directory, f"{partition_id}.json")
+
+    def load(self, partition_id: str) -> dict:
+        """Returns {"sequence_number", "offset"} of the last checkpoint of the partition, or None."""
+        try:
+            with open(self._path(partition_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, partition_id: str, sequence_number: int, offset: str):
+        path = self._path(partition_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"sequence_number": sequence_number, "offset": offset}, f)
+        os.replace(tmp_path, path)
@@ -7,12 +7,65 @@ KEY_VAULT_NAME = "<keyvaultname>"
 MANAGED_IDENTITY_CLIENT_ID = "<clientid>"
 STORAGE_QUEUE_NAME = "devices"
 MAX_DEVICE_IDS = 7000
+DEVICE_ID_RANGE = ""        # "first-last" device numbers owned by the process, no queue; the DEVICE_ID_RANGE environment variable (per worker) wins; empty: lease from the queue
+# --- Device provisioning ---
+PROVISIONING_MODE = "per-user"  # per-user (each user provisions its device)|bulk (test_init.py provisions all devices)
+DEVICE_KEY_STORE = "device_keys.json"
+BULK_BATCHES_PER_SECOND = 1.0   # registry bulk operations per second (100 devices each)
+# --- SAS tokens ---
+SAS_TOKEN_EXPIRY_HOURS = 24
+SAS_TOKEN_RENEW_BEFORE = 3600   # seconds before the expiry when a token is renewed at the latest...
+SAS_TOKEN_RENEW_JITTER = 3600   # ...plus a random delay up to this, so renewals don't line up
+# --- MQTT engine ---
+MQTT_ENGINE = "paho"        # paho (one client per user)|asyncio (one event loop per process)
+DEVICES_PER_USER = 100      # devices owned by each IoTDeviceFleetUser (asyncio engine only)
+MQTT_KEEPALIVE = 60
+MAX_CONCURRENT_CONNECTS = 200
+PUBLISH_TIMEOUT = 30        # seconds without PUBACK before a publish is counted as failed
+MESSAGE_PROFILE = "temperature"     # temperature|small-json|mixed-json|large-json|binary-4k (utils/message_profiles.py)
+DEVICE_BOUND_ENABLED = True # devices subscribe to C2D, twin and methods, GET their twin on connect and answer (mqtt/device_bound.py)
+# --- Reconnect ---
+RECONNECT_POLICY = "decorrelated"   # fixed|exponential|exponential-jitter|decorrelated
+RECONNECT_BASE_DELAY = 1    # seconds, delay of the fixed policy
+RECONNECT_MAX_DELAY = 120   # seconds
+# --- Reconnect storm (locustfile_reconnect_storm.py) ---
+STORM_INTERVAL = 300        # seconds between two storms, counted from the recovery of the previous one
+STORM_RECOVERY_TIMEOUT = 300  # seconds to get back to full connectivity before the storm counts as failed
+# --- Proxy outages (locustfile_proxy_outage.py) ---
+OUTAGE_USERS = 1000
+OUTAGE_SPAWN_RATE = 50
+OUTAGE_INTERVAL = 300       # seconds between two outages, the first one after the ramp-up
+OUTAGE_COUNT = 3            # the test stops one interval after the last outage
+OUTAGE_COMMAND = ""         # run by the master, e.g. "docker restart nginx-proxy"; empty: every device drops its connection
+OUTAGE_RECOVERY_TIMEOUT = 600   # seconds to get back to full connectivity before the recovery counts as failed
+# --- Run results (Azure Tables in the storage account of the device queue) ---
+RUN_RESULTS_ENABLED = False
+RUN_ID = ""                 # empty: the RUN_ID environment variable, or the start time of the process
+RUN_RESULTS_DEVICE_TABLE = "runDevices"     # per-device connect/publish statistics, one partition per run
+RUN_RESULTS_SUMMARY_TABLE = "runSummary"    # Locust statistics rows, one partition per run
+# --- Traffic traces (mqtt/traffic_trace.py, locustfile_replay.py) ---
+TRACE_RECORD_FILE = ""      # connect/publish/disconnect events of each process, e.g. "traces/day1-{pid}.trace"; empty: not recorded
+REPLAY_TRACE_FILES = "traces/day1-*.trace"  # traces replayed by locustfile_replay.py (glob), merged in time order
+REPLAY_SPEED = 1.0          # 1: as recorded, N: N times faster
+# --- Service side of the C2D traffic (service_driver.py) ---
+SERVICE_DRIVER_OPERATIONS = "c2d,desired,method"   # sent to every device on each fan-out
+SERVICE_DRIVER_RATE = 50        # service operations per second, halved when IoT Hub throttles
+SERVICE_DRIVER_CONCURRENCY = 32 # operations in flight: a method call waits for the device answer
+SERVICE_DRIVER_INTERVAL = 300   # seconds between two fan-outs, counted from the start of the previous one
+SERVICE_DRIVER_PAYLOAD_BYTES = 0    # padding of the C2D bodies, desired patches and method payloads (config pushes)
+METHOD_RESPONSE_TIMEOUT = 30    # seconds IoT Hub waits for the device to answer a direct method
+# --- Load generator resources (utils/resource_sampler.py) ---
+RESOURCE_SAMPLE_INTERVAL = 10   # seconds between two samples of CPU, RSS, threads, fds, loop lag and publish backlog, 0 disables
+RESOURCE_SAMPLES_FILE = "resource_samples.csv"  # timeseries of every process, written by the master (or the single process); empty: log only
+RESOURCE_CPU_THRESHOLD = 90     # CPU percent of one core above which the generator is saturated...
+RESOURCE_LAG_THRESHOLD_MS = 100 # ...or loop lag p99 above this
 # --- Secret names in Key Vault ---
 IOTHUB_CONNECTION_STRING_SECRET_NAME = "iothub-connection-string"
 IOTHUB_HOSTNAME_SECRET_NAME = "iothub-hostname"
 IOTHUB_PROXYNAME_SECRET_NAME = "iothub-proxy"
 PROXY_CERTIFICATE_SECRET_NAME = "certificate-name"
 STORAGE_CONNECTION_STRING_SECRET_NAME = "storage-connection-string"
+DEVICE_GROUP_KEY_SECRET_NAME = ""   # optional, device keys derived from this key (bulk provisioning only)
 # --- Secret values (bad approach) ---
 IOTHUB_CONNECTION_STRING_SECRET_VALUE = ""
 IOTHUB_HOSTNAME_SECRET_VALUE = ""
@@ -20,11 +73,20 @@ IOTHUB_PROXYNAME_SECRET_VALUE = ""
 #PROXY_CERTIFICATE_SECRET_VALUE = "certificate.pem"
 PROXY_CERTIFICATE_SECRET_VALUE = ""
 STORAGE_CONNECTION_STRING_SECRET_VALUE = ""
+DEVICE_GROUP_KEY_SECRET_VALUE = ""
 
 # ----------------------------------------------------------------------------------------
 # --- CONSUMER PARAMETERS ----------------------------------------------------------------
 # ----------------------------------------------------------------------------------------
 EVENTHUB_CONSUMER_GROUP = "dev-forlani"
+CONSUMER_SUMMARY_INTERVAL = 10  # seconds between two latency/loss summaries
+CONSUMER_MODE = "batch"         # event (one callback per event)|batch (receive_batch)
+CONSUMER_BATCH_SIZE = 300
+CONSUMER_BATCH_MAX_WAIT = 5     # seconds to wait for a full batch
+CONSUMER_PROCESSES = 1          # partitions spread across this many processes
+CHECKPOINT_EVERY_EVENTS = 10000 # checkpoint a partition after this many events...
+CHECKPOINT_INTERVAL = 30        # ...or after this many seconds
+CHECKPOINT_DIR = "checkpoints"  # local checkpoint store, empty: no checkpoints (always start from the latest event)
 # --- Secret names in Key Vault ---
 EVENTHUB_CONNECTION_STRING_SECRET_NAME = "iothub-builtin-endpoint-connection-string"
 EVENTHUB_NAME_SECRET_NAME = "iothub-builtin-endpoint-name"
@@ -0,0 +1,59 @@
+import os
+
+
+def dec_to_12_pairs(n: int) -> str:
+    """
+    Convert a decimal number into exactly 12 pairs (24 hex digits) joined by '-'.
+    Pads with leading zeros if needed.
+
+    Parameters
+    ----------
+    n : int
+        Decimal number to convert.
+
+    Returns
+    -------
+    str
+        Hex string in format '00-00-00-00-00-00-00-00-00-00-00-01'
+    """
+    if not isinstance(n, int) or n < 0:
+        raise ValueError("Input must be a non-negative integer")
+
+    # Convert to hex string without '0x', in lowercase
+    hex_str = f"{n:024x}"  # 24 cifre esadecimali → 12 coppie
+
+    # Split pairs
+    pairs = [hex_str[i:i+2] for i in range(0, 24, 2)]
+
+    return "-".join(pairs)
+
+
+def parse_device_id_range(value: str) -> tuple:
+    """Parses "first-last" (numbers of dec_to_12_pairs, both included) into (first, last)."""
+    first, separator, last = value.partition("-")
+    if not separator or not first.strip().isdigit() or not last.strip().isdigit() or int(first) > int(last):
+        raise ValueError(f"Invalid device id range {value!r}, expected first-last, e.g. 1-5000")
+    return int(first), int(last)
+
+
+def get_device_id_range(configured: str = ""):
+    """
+    Range of device numbers owned by this process, from the DEVICE_ID_RANGE environment variable (set per
+    worker by run_locust_workers.py) or else config.DEVICE_ID_RANGE, or None to lease ids from the queue.
+    The environment wins: config.py is shared by every worker, which would all lease the same ids.
+    """
+    value = os.environ.get("DEVICE_ID_RANGE") or configured
+    return parse_device_id_range(value) if value else None
+
+
+def split_device_id_range(first: int, count: int, parts: int) -> list:
+    """Splits count device numbers starting at first into parts disjoint "first-last" ranges."""
+    if count < parts:
+        raise ValueError(f"Cannot split {count} devices across {parts} workers")
+    ranges = []
+    start = first
+    for index in range(parts):
+        size = count // parts + (1 if index < count % parts else 0)
+        ranges.append(f"{start}-{start + size - 1}")
+        start += size
+    return ranges
@@ -0,0 +1,44 @@
+import json
+import logging
+import os
+
+_keys = None
+
+
+def save(path: str, device_keys: dict):
+    """Writes the device keys atomically, merging them with the ones already in the store."""
+    keys = load(path, use_cache=False)
+    keys.update(device_keys)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(keys, f)
+    os.replace(tmp_path, path)
+
+
+def remove(path: str, device_ids: list):
+    keys = load(path, use_cache=False)
+    for device_id in device_ids:
+        keys.pop(device_id, None)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(keys, f)
+    os.replace(tmp_path, path)
+
+
+def load(path: str, use_cache: bool = True) -> dict:
+    """Loads the device keys once per process. A missing store is an empty store."""
+    global _keys
+    if use_cache and _keys is not None:
+        return _keys
+    keys = {}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            keys = json.load(f)
+    if use_cache:
+        _keys = keys
+        logging.info(f"🔑 Loaded {len(keys)} device keys from {path}")
+    return keys
+
+
+def get(path: str, device_id: str) -> str:
+    return load(path).get(device_id)
@@ -0,0 +1,17 @@
+import datetime
+
+# Twin tags and desired properties applied to every simulated device
+DEVICE_TAGS = {"deviceType": "mydevicetype"}
+
+
+def desired_properties() -> dict:
+    return {
+        "env": "",
+        "eventhub": {
+            "name": "myeventhub",
+            "namespace": "myeventhubnamespace",
+            "policy": "device"
+        },
+        "lastConfigurationChanged": datetime.datetime.now().isoformat() + "Z",
+        "ring": ""
+    }
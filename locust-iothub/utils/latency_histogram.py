@@ -0,0 +1,86 @@
+class LatencyHistogram:
+    """
+    Log-linear histogram (HDR-style) of latencies in milliseconds, stored as microseconds.
+
+    Values below 2^precision_bits us are exact; above, every power of two is split in
+    2^precision_bits buckets, so the relative error stays below 1/2^precision_bits with a
+    fixed number of counters (~3.3k for the defaults, whatever the number of samples).
+    """
+
+    def __init__(self, precision_bits: int = 7, max_value_ms: float = 3600 * 1000):
+        self.precision_bits = precision_bits
+        self.sub_bucket_count = 1 << precision_bits
+        self.max_value = int(max_value_ms * 1000)
+        self.counts = [0] * (self._index(self.max_value) + 1)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.negative = 0   # latencies below zero (clock skew), recorded as 0
+
+    def _index(self, value: int) -> int:
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.precision_bits - 1
+        return self.sub_bucket_count * shift + (value >> shift)
+
+    def _value_at(self, index: int) -> int:
+        """Upper bound of the bucket, in us."""
+        if index < 2 * self.sub_bucket_count:
+            return index
+        shift = index // self.sub_bucket_count - 1
+        return ((index - self.sub_bucket_count * shift + 1) << shift) - 1
+
+    def record(self, value_ms: float):
+        value = int(value_ms * 1000)
+        if value < 0:
+            self.negative += 1
+            value = 0
+        value = min(value, self.max_value)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "LatencyHistogram"):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.negative += other.negative
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.negative = 0
+
+    def percentile(self, percent: float) -> float:
+        """Value in ms at the given percentile (0-100)."""
+        if not self.total:
+            return 0.0
+        rank = max(1, round(self.total * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value_at(index), self.max) / 1000
+        return self.max / 1000
+
+    def summary(self, percents=(50, 90, 99, 99.9)) -> dict:
+        if not self.total:
+            return {"count": 0}
+        result = {"count": self.total, "min": self.min / 1000, "mean": round(self.sum / self.total / 1000, 3)}
+        for percent in percents:
+            result[f"p{percent:g}"] = self.percentile(percent)
+        result["max"] = self.max / 1000
+        if self.negative:
+            result["negative"] = self.negative
+        return result
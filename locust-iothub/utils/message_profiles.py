@@ -0,0 +1,135 @@
+import itertools
+import json
+import random
+import struct
+import threading
+import time
+import urllib.parse
+
+# Binary bodies start with this header: magic, send time (epoch ms), per-device sequence number
+BINARY_HEADER = struct.Struct("!4sQQ")
+BINARY_MAGIC = b"LTB1"
+
+# Width of the stamped fields in the JSON bodies: 13 digits of epoch ms hold until the year 2286,
+# the sequence number is right-aligned with spaces (valid JSON whitespace)
+TS_WIDTH = 13
+SEQ_WIDTH = 12
+
+
+class MessageProfile:
+    """
+    Shape of the telemetry messages: body size distribution as [(size in bytes, weight), ...],
+    JSON or binary body, and application properties sent in the topic property bag
+    (with the content type and encoding system properties for JSON bodies, unless system_properties is False).
+    """
+
+    def __init__(self, name: str, body: str = "json", sizes: list = None, properties: dict = None,
+                 pool_size: int = 256, system_properties: bool = True):
+        if body not in ("json", "binary"):
+            raise ValueError(f"Unknown body type {body!r}")
+        self.name = name
+        self.body = body
+        self.sizes = sizes or [(0, 1)]
+        self.properties = properties or {}
+        self.pool_size = pool_size
+        self.system_properties = system_properties
+
+    def property_bag(self) -> str:
+        properties = dict(self.properties)
+        if self.body == "json" and self.system_properties:
+            # System properties: IoT Hub routing queries can then filter on the body
+            properties.setdefault("$.ct", "application/json")
+            properties.setdefault("$.ce", "utf-8")
+        return urllib.parse.urlencode(properties, quote_via=urllib.parse.quote, safe="$")
+
+
+PROFILES = {profile.name: profile for profile in (
+    # Same body as the original send_message (plus ts/seq), no property bag
+    MessageProfile("temperature", "json", [(0, 1)], pool_size=64, system_properties=False),
+    MessageProfile("small-json", "json", [(256, 1)], {"type": "telemetry"}),
+    MessageProfile("mixed-json", "json", [(256, 70), (1024, 25), (16384, 5)], {"type": "telemetry", "tier": "mixed"}),
+    MessageProfile("large-json", "json", [(32768, 50), (131072, 40), (250000, 10)], {"type": "bulk"}, pool_size=64),
+    MessageProfile("binary-4k", "binary", [(4096, 1)], {"type": "binary"}),
+)}
+
+
+class MessagePool:
+    """
+    Pre-encoded bodies of a profile, built once and reused by every device of the process:
+    a publish only copies a body and writes the send time and sequence number at fixed offsets.
+    Topics (with the URL-encoded property bag) are computed once per device.
+    """
+
+    def __init__(self, profile: MessageProfile, seed: int = None):
+        self.profile = profile
+        self._topic_suffix = profile.property_bag()
+        self._topics = {}
+        rnd = random.Random(seed)
+        sizes, weights = zip(*profile.sizes)
+        self._entries = [self._build(rnd, size) for size in rnd.choices(sizes, weights, k=profile.pool_size)]
+        self._next = itertools.count()
+
+    def _build(self, rnd: random.Random, size: int):
+        if self.profile.body == "binary":
+            body = bytearray(BINARY_HEADER.size + max(0, size - BINARY_HEADER.size))
+            body[BINARY_HEADER.size:] = rnd.randbytes(len(body) - BINARY_HEADER.size)
+            return body, None, None
+        prefix = f'{{"Temperature": {round(rnd.uniform(20, 25), 1)}, "ts": '
+        middle = ', "seq": '
+        body = f'{prefix}{"0" * TS_WIDTH}{middle}{" " * SEQ_WIDTH}'
+        padding = size - len(body) - len(', "pad": ""}')
+        body += f', "pad": "{"x" * padding}"}}' if padding > 0 else "}"
+        ts_offset = len(prefix)
+        return bytearray(body.encode("utf-8")), ts_offset, ts_offset + TS_WIDTH + len(middle)
+
+    def topic(self, device_id: str) -> str:
+        topic = self._topics.get(device_id)
+        if topic is None:
+            topic = f"devices/{device_id}/messages/events"
+            if self._topic_suffix:
+                topic += f"/{self._topic_suffix}"
+            self._topics[device_id] = topic
+        return topic
+
+    def payload(self, seq: int, ts_ms: int = None) -> bytes:
+        template, ts_offset, seq_offset = self._entries[next(self._next) % len(self._entries)]
+        ts_ms = int(time.time() * 1000) if ts_ms is None else ts_ms
+        body = bytearray(template)
+        if ts_offset is None:
+            BINARY_HEADER.pack_into(body, 0, BINARY_MAGIC, ts_ms, seq)
+        else:
+            body[ts_offset:ts_offset + TS_WIDTH] = b"%013d" % ts_ms
+            body[seq_offset:seq_offset + SEQ_WIDTH] = b"%*d" % (SEQ_WIDTH, seq)
+        return bytes(body)
+
+    def payload_factory(self, session):
+        """Payload factory of the AsyncMqttEngine."""
+        session.sequence += 1
+        return self.topic(session.client_id), self.payload(session.sequence)
+
+
+def parse_stamp(body: bytes):
+    """Returns (seq, ts_ms) of a message built by a MessagePool (or a JSON body with ts/seq), or None."""
+    if body[:4] == BINARY_MAGIC and len(body) >= BINARY_HEADER.size:
+        _, ts_ms, seq = BINARY_HEADER.unpack_from(body)
+        return seq, ts_ms
+    try:
+        payload = json.loads(body)
+        return int(payload["seq"]), float(payload["ts"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def get_pool(profile_name: str) -> MessagePool:
+    """Returns the process-wide pool of the profile."""
+    with _lock:
+        pool = _pools.get(profile_name)
+        if pool is None:
+            if profile_name not in PROFILES:
+                raise ValueError(f"Unknown message profile {profile_name!r}, available: {', '.join(PROFILES)}")
+            pool = _pools[profile_name] = MessagePool(PROFILES[profile_name])
+        return pool
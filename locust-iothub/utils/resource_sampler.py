@@ -0,0 +1,212 @@
+import csv
+import logging
+import os
+import threading
+import time
+
+from utils.latency_histogram import LatencyHistogram
+
+# Request type of the generator metrics in the Locust statistics
+GENERATOR = "GENERATOR"
+LOOP_LAG_NAME = "loop lag"
+
+# Lag probe period: the lag is how late the probe wakes up
+PROBE_INTERVAL = 0.1
+# Publish latency above this many times its lowest interval p95 counts as an increase
+LATENCY_INCREASE_FACTOR = 2
+# Publishes an interval needs before its p95 is compared
+MIN_PUBLISHES = 20
+
+
+def read_process_resources() -> dict:
+    """CPU seconds, RSS, threads and open file descriptors of this process (None where /proc is missing)."""
+    times = os.times()
+    usage = {"cpu_seconds": times.user + times.system, "rss_mb": None,
+             "threads": threading.active_count(), "fds": None}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("Threads:"):
+                    # OS threads: paho network loops are real threads even when gevent patched threading
+                    usage["threads"] = int(line.split()[1])
+        usage["fds"] = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        pass
+    return usage
+
+
+class LagProbe:
+    """
+    Wakes up every PROBE_INTERVAL and records how late it is. Under gevent the thread is a greenlet,
+    so the lag is the time the hub was held by other greenlets, blocking calls or the GIL.
+    """
+
+    def __init__(self, interval: float = PROBE_INTERVAL):
+        self.interval = interval
+        self.histogram = LatencyHistogram()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="lag-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def take(self) -> LatencyHistogram:
+        """Returns the lag recorded since the previous call."""
+        histogram, self.histogram = self.histogram, LatencyHistogram()
+        return histogram
+
+    def _run(self):
+        while not self._stopped.is_set():
+            start = time.perf_counter()
+            time.sleep(self.interval)
+            self.histogram.record((time.perf_counter() - start - self.interval) * 1000)
+
+
+class ResourceSampler:
+    """
+    Samples the load generator process every interval: CPU, RSS, threads, open fds, loop lag and
+    the gauges added by the locustfile (publish backlog, certificate files...). The lag is also
+    reported to Locust (GENERATOR loop lag, p99 of the interval), every sample is passed to on_sample.
+
+    When the publish latency of an interval rises above LATENCY_INCREASE_FACTOR times its lowest
+    p95, the sample tells whether the generator was saturated (CPU or lag above the thresholds),
+    so a slower proxy is not blamed for a load generator running out of CPU.
+    """
+
+    def __init__(self, interval: float = 10, request_event=None, on_sample=None,
+                 cpu_threshold: float = 90, lag_threshold_ms: float = 100):
+        self.interval = interval
+        self.request_event = request_event
+        self.on_sample = on_sample
+        self.cpu_threshold = cpu_threshold
+        self.lag_threshold_ms = lag_threshold_ms
+        self.gauges = {}
+        self.lag_sources = {}
+        self.probe = LagProbe()
+        self.add_lag_source(LOOP_LAG_NAME, self.probe.take)
+        self._publish_latency = LatencyHistogram()
+        self._baseline_p95 = None
+        self._last = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_gauge(self, name: str, read):
+        """read() returns the current value, or a dict of values prefixed with the gauge name."""
+        self.gauges[name] = read
+
+    def add_lag_source(self, name: str, take):
+        """take() returns the LatencyHistogram of the lag since its previous call."""
+        self.lag_sources[name] = take
+
+    def on_request(self, request_type, name, response_time, exception=None, **kwargs):
+        """Request listener: the publish latency the saturation check compares."""
+        if request_type == "PUBLISH" and exception is None:
+            self._publish_latency.record(response_time)
+
+    def start(self):
+        self.probe.start()
+        self._last = (time.monotonic(), read_process_resources()["cpu_seconds"])
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.probe.stop()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                sample = self.sample()
+            except Exception as e:
+                logging.error(f"Error sampling the process resources: {e}")
+                continue
+            if self.on_sample:
+                self.on_sample(sample)
+
+    def sample(self) -> dict:
+        now = time.monotonic()
+        usage = read_process_resources()
+        last_time, last_cpu = self._last
+        self._last = (now, usage["cpu_seconds"])
+        sample = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "cpu_percent": round((usage["cpu_seconds"] - last_cpu) * 100 / max(now - last_time, 1e-6), 1),
+            "rss_mb": round(usage["rss_mb"], 1) if usage["rss_mb"] is not None else None,
+            "threads": usage["threads"],
+            "fds": usage["fds"],
+        }
+        lag_p99 = 0.0
+        for name, take in self.lag_sources.items():
+            # A source not started yet (e.g. the MQTT engine before the first user) returns None
+            histogram = take() or LatencyHistogram()
+            p99 = histogram.percentile(99)
+            sample[f"{name.replace(' ', '_')}_p99_ms"] = p99
+            sample[f"{name.replace(' ', '_')}_max_ms"] = histogram.max / 1000 if histogram.total else 0.0
+            lag_p99 = max(lag_p99, p99)
+            if self.request_event is not None and histogram.total:
+                self.request_event.fire(request_type=GENERATOR, name=name, response_time=p99, response_length=0,
+                                        exception=None, context={})
+        for name, read in self.gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                logging.debug(f"Gauge {name} failed: {e}")
+                value = None
+            if isinstance(value, dict):
+                sample.update({f"{name}_{key}": item for key, item in value.items()})
+            else:
+                sample[name] = value
+
+        sample["saturated"] = sample["cpu_percent"] >= self.cpu_threshold or lag_p99 >= self.lag_threshold_ms
+        self._check_latency(sample, lag_p99)
+        return sample
+
+    def _check_latency(self, sample: dict, lag_p99: float):
+        latency, self._publish_latency = self._publish_latency, LatencyHistogram()
+        if latency.total < MIN_PUBLISHES:
+            sample["publish_p95_ms"] = None
+            return
+        p95 = latency.percentile(95)
+        sample["publish_p95_ms"] = p95
+        if self._baseline_p95 is None or p95 < self._baseline_p95:
+            self._baseline_p95 = p95
+            return
+        if p95 < self._baseline_p95 * LATENCY_INCREASE_FACTOR:
+            return
+        increase = f"PUBLISH p95 {p95:.0f} ms, {p95 / max(self._baseline_p95, 1e-3):.1f}x its lowest"
+        if sample["saturated"]:
+            logging.warning(f"⚠️ {increase} while the generator is saturated (CPU {sample['cpu_percent']}%, "
+                            f"loop lag p99 {lag_p99:.0f} ms): the increase comes from the load generator, "
+                            f"add workers or agents before blaming the proxy")
+        else:
+            logging.info(f"📈 {increase}, the generator has headroom (CPU {sample['cpu_percent']}%, "
+                         f"loop lag p99 {lag_p99:.0f} ms): the increase comes from the proxy or the hub")
+
+
+class ResourceTimeseries:
+    """CSV file of the samples of every process, one row per sample, columns set by the first one."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "w", newline="")
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def write(self, process: str, sample: dict):
+        row = {"process": process, **sample}
+        with self._lock:
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._file, fieldnames=list(row), extrasaction="ignore")
+                self._writer.writeheader()
+            self._writer.writerow(row)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
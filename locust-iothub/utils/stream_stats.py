@@ -0,0 +1,100 @@
+from utils.latency_histogram import LatencyHistogram
+
+# Gaps kept per device: messages missing beyond this are counted as lost right away
+MAX_MISSING_PER_DEVICE = 10000
+
+
+class DeviceStream:
+    """Sequence state of one device: highest sequence number seen and the gaps still open."""
+
+    __slots__ = ("highest", "received", "missing", "lost")
+
+    def __init__(self):
+        self.highest = None
+        self.received = 0
+        self.missing = set()
+        self.lost = 0
+
+    def receive(self, seq: int) -> str:
+        """Returns in-order|gap|late|duplicate|restart."""
+        self.received += 1
+        if self.highest is None or seq == self.highest + 1:
+            # The first message seen may be in the middle of the stream (consumer started after the devices)
+            self.highest = seq
+            return "in-order"
+        if seq > self.highest:
+            gap = range(self.highest + 1, seq)
+            room = MAX_MISSING_PER_DEVICE - len(self.missing)
+            self.missing.update(gap[:room])
+            self.lost += max(0, len(gap) - room)
+            self.highest = seq
+            return "gap"
+        if seq in self.missing:
+            self.missing.discard(seq)
+            return "late"
+        if seq == 1 and self.highest > 1:
+            # The device started a new stream (new user or Locust restart): its open gaps are lost
+            self.lost += len(self.missing)
+            self.missing.clear()
+            self.highest = 1
+            return "restart"
+        return "duplicate"
+
+
+class FleetStreamStats:
+    """
+    Streaming loss, duplicate and reordering counters for the whole fleet, plus latency histograms
+    of the interval since the last summary and of the whole run. Memory grows with the number of
+    devices and their open gaps, never with the number of messages.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.counters = dict.fromkeys(("messages", "in-order", "gap", "late", "duplicate", "restart", "unstamped"), 0)
+        self.end_to_end = LatencyHistogram()        # device send -> consumer receive
+        self.ingestion = LatencyHistogram()         # device send -> enqueued in Event Hub
+        self.total_end_to_end = LatencyHistogram()
+        self.total_ingestion = LatencyHistogram()
+        self._interval_messages = 0
+
+    def record(self, device_id: str, seq: int, sent_ms: float, enqueued_ms: float, received_ms: float):
+        stream = self.devices.get(device_id)
+        if stream is None:
+            stream = self.devices[device_id] = DeviceStream()
+        self.counters[stream.receive(seq)] += 1
+        self.counters["messages"] += 1
+        self._interval_messages += 1
+        self.end_to_end.record(received_ms - sent_ms)
+        if enqueued_ms is not None:
+            self.ingestion.record(enqueued_ms - sent_ms)
+
+    def record_unstamped(self):
+        self.counters["unstamped"] += 1
+
+    def summary(self, interval_seconds: float) -> dict:
+        """Summary of the interval since the previous call, then the interval histograms start over."""
+        missing = sum(len(stream.missing) for stream in self.devices.values())
+        lost = sum(stream.lost for stream in self.devices.values())
+        result = {
+            "devices": len(self.devices),
+            "messages_per_second": round(self._interval_messages / interval_seconds, 1) if interval_seconds else 0,
+            "messages": self.counters["messages"],
+            "missing": missing,     # gaps not filled yet, late arrivals may still fill them
+            "lost": lost,           # gaps closed by a stream restart or beyond MAX_MISSING_PER_DEVICE
+            "duplicates": self.counters["duplicate"],
+            "reordered": self.counters["late"],
+            "restarts": self.counters["restart"],
+            "unstamped": self.counters["unstamped"],
+            "end_to_end_ms": self.end_to_end.summary(),
+            "ingestion_ms": self.ingestion.summary(),
+        }
+        self.total_end_to_end.merge(self.end_to_end)
+        self.total_ingestion.merge(self.ingestion)
+        self.end_to_end.reset()
+        self.ingestion.reset()
+        self._interval_messages = 0
+        return result
+
+    def totals(self) -> dict:
+        """Latency over the whole run (up to the last summary)."""
+        return {"end_to_end_ms": self.total_end_to_end.summary(), "ingestion_ms": self.total_ingestion.summary()}
@@ -1,28 +1,142 @@
 #!/bin/bash
 
+CERT_FILE=/etc/ssl/certs/nginx-cert.crt
+KEY_FILE=/etc/ssl/private/nginx-cert.key
+VERSION_FILE=/etc/ssl/private/nginx-cert.version
+# Seconds between two checks of the Key Vault secret version, 0 disables the hot reload
+CERT_POLL_INTERVAL=${CERT_POLL_INTERVAL:-300}
+
+# Value of a string field of a flat JSON document (token and Key Vault responses), without jq
+json_field() {
+    sed -n "s/.*\"$1\" *: *\"\([^\"]*\)\".*/\1/p" | sed 's/\\\//\//g'
+}
+
+get_token() {
+    if [ -n "$TOKEN" ]; then
+        echo "$TOKEN"
+    elif [ -n "$MSI_ENDPOINT" ]; then
+        curl -s -H "X-IDENTITY-HEADER: $IDENTITY_HEADER" "$MSI_ENDPOINT?resource=https%3A%2F%2Fvault.azure.net&client_id=$UMI_CLIENT_ID&api-version=2019-08-01" | json_field access_token
+    else
+        curl -s -H Metadata:true "http://169.254.169.254/metadata/identity/oauth2/token?api-version=2018-02-01&resource=https%3A%2F%2Fvault.azure.net&client_id=$UMI_CLIENT_ID" | json_field access_token
+    fi
+}
+
+# Fetches the secret and, when its version differs from the installed one, converts the PFX next to the
+# live files and moves them in place (a rename is atomic, nginx never reads a half-written file).
+# Returns 0 when a new certificate was installed, 1 when unchanged, 2 on error.
+fetch_certificate() {
+    local token vault_result version
+    token=$(get_token)
+    vault_result=$(curl -s -H "Authorization: Bearer $token" "${KV_SECRET_URL}?api-version=7.2")
+    # The secret id ends with its version: https://kv.vault.azure.net/secrets/cert/<version>
+    version=$(echo "$vault_result" | json_field id | sed 's/.*\///')
+    if [ -z "$version" ]; then
+        echo "Failed to read the certificate from Azure Key Vault: ${vault_result:0:200}"
+        return 2
+    fi
+    if [ "$version" = "$(cat $VERSION_FILE 2>/dev/null)" ]; then
+        return 1
+    fi
+
+    echo "$vault_result" | json_field value | base64 -d > /tmp/certificate.pfx
+    openssl pkcs12 -in /tmp/certificate.pfx -nokeys -clcerts -passin pass: -out $CERT_FILE.new \
+        && openssl pkcs12 -in /tmp/certificate.pfx -nocerts -nodes -passin pass: -out $KEY_FILE.new
+    local converted=$?
+    rm -f /tmp/certificate.pfx
+    if [ $converted -ne 0 ] || [ ! -s $CERT_FILE.new ] || [ ! -s $KEY_FILE.new ]; then
+        echo "Failed to convert the certificate version $version"
+        rm -f $CERT_FILE.new $KEY_FILE.new
+        return 2
+    fi
+    chmod 600 $KEY_FILE.new
+    [ -f $CERT_FILE ] && cp -p $CERT_FILE $CERT_FILE.previous
+    [ -f $KEY_FILE ] && cp -p $KEY_FILE $KEY_FILE.previous
+    mv -f $CERT_FILE.new $CERT_FILE
+    mv -f $KEY_FILE.new $KEY_FILE
+    echo "$version" > $VERSION_FILE
+    echo "Certificate version $version retrieved from Azure Key Vault."
+    return 0
+}
+
+# Next replicas boot from the cache without waiting for Key Vault: only a certificate nginx has accepted is cached
+update_cache() {
+    if [ -n "$CERT_CACHE_DIR" ] && mkdir -p "$CERT_CACHE_DIR"; then
+        cp $CERT_FILE "$CERT_CACHE_DIR/nginx-cert.crt.new" && mv -f "$CERT_CACHE_DIR/nginx-cert.crt.new" "$CERT_CACHE_DIR/nginx-cert.crt"
+        cp $KEY_FILE "$CERT_CACHE_DIR/nginx-cert.key.new" && mv -f "$CERT_CACHE_DIR/nginx-cert.key.new" "$CERT_CACHE_DIR/nginx-cert.key"
+        cp $VERSION_FILE "$CERT_CACHE_DIR/nginx-cert.version"
+    fi
+}
+
+# Graceful reload: new workers load the certificate, the old ones keep serving their open
+# connections until they close (proxy_timeout), so long-lived MQTT sessions are not dropped.
+reload_nginx() {
+    if nginx -t -q && nginx -s reload; then
+        echo "nginx reloaded with the new certificate."
+        update_cache
+    else
+        echo "nginx rejected the new certificate, restoring the previous one."
+        mv -f $CERT_FILE.previous $CERT_FILE
+        mv -f $KEY_FILE.previous $KEY_FILE
+        rm -f $VERSION_FILE
+    fi
+}
+
+# Background agent: runs for the lifetime of the container, nginx is started by the entrypoint meanwhile
+certificate_agent() {
+    # Wait for the nginx master process before the first check
+    while [ ! -s /var/run/nginx.pid ]; do
+        sleep 1
+    done
+    # nginx is up with the installed certificate: cache it when it was fetched at boot
+    if [ -s $VERSION_FILE ] && [ "$(cat $VERSION_FILE)" != "$(cat "$CERT_CACHE_DIR/nginx-cert.version" 2>/dev/null)" ]; then
+        update_cache
+    fi
+    while true; do
+        fetch_certificate && reload_nginx
+        # Without polling, the agent exits after the first check
+        [ "$CERT_POLL_INTERVAL" = "0" ] && return
+        sleep "$CERT_POLL_INTERVAL"
+    done
+}
+
 if [ -d "/certs" ]; then
-    cp -v /certs/*.crt /etc/ssl/certs/nginx-cert.crt
-    cp -v /certs/*.key /etc/ssl/private/nginx-cert.key
+    cp -v /certs/*.crt $CERT_FILE
+    cp -v /certs/*.key $KEY_FILE
     echo "Certificates copied to /etc/ssl/certs and /etc/ssl/private."
 else
-    apt update && apt install -y jq
-    if [ -z "$TOKEN" ]; then
-        if [ -n "$MSI_ENDPOINT" ]; then
-            TOKEN_RESULT=$(curl -s -H "X-IDENTITY-HEADER: $IDENTITY_HEADER" "$MSI_ENDPOINT?resource=https%3A%2F%2Fvault.azure.net&client_id=$UMI_CLIENT_ID&api-version=2019-08-01")
-        else
-            TOKEN_RESULT=$(curl -s -H Metadata:true "http://169.254.169.254/metadata/identity/oauth2/token?api-version=2018-02-01&resource=https%3A%2F%2Fvault.azure.net&client_id=$UMI_CLIENT_ID")
-        fi
-        #echo $TOKEN_RESULT # DEBUG
-        TOKEN=$(echo $TOKEN_RESULT | jq -r '.access_token')
-    fi
-    VAULT_RESULT=$(curl -s -H "Authorization: Bearer $TOKEN" "${KV_SECRET_URL}?api-version=7.2")
-    echo $VAULT_RESULT # DEBUG
-    SECRET=$(echo $VAULT_RESULT | jq -r '.value')
-    echo $SECRET | base64 -d > /tmp/certificate.pfx
-    openssl pkcs12 -in /tmp/certificate.pfx -nokeys -clcerts -passin pass: -out /etc/ssl/certs/nginx-cert.crt
-    openssl pkcs12 -in /tmp/certificate.pfx -nocerts -nodes -passin pass: -out /etc/ssl/private/nginx-cert.key
-    #cat /etc/ssl/certs/nginx-cert.crt # DEBUG
-    #cat /etc/ssl/private/nginx-cert.key # DEBUG
-    rm -f /tmp/certificate.pfx
-    echo "Certificates retrieved from Azure Key Vault and saved to /etc/ssl/certs and /etc/ssl/private."
-fi
\ No newline at end of file
+    # Fast boot: nginx starts with the cached (or pre-baked in the image) certificate and the agent
+    # fetches the current version from Key Vault once nginx is up.
+    if [ -n "$CERT_CACHE_DIR" ] && [ -s "$CERT_CACHE_DIR/nginx-cert.crt" ] && [ -s "$CERT_CACHE_DIR/nginx-cert.key" ]; then
+        cp "$CERT_CACHE_DIR/nginx-cert.crt" $CERT_FILE
+        cp "$CERT_CACHE_DIR/nginx-cert.key" $KEY_FILE
+        cp "$CERT_CACHE_DIR/nginx-cert.version" $VERSION_FILE 2>/dev/null
+        chmod 600 $KEY_FILE
+        echo "Certificate copied from the cache $CERT_CACHE_DIR."
+    fi
+    if [ -s $CERT_FILE ] && [ -s $KEY_FILE ]; then
+        echo "Starting with the installed certificate, Azure Key Vault is checked in the background."
+        STARTED_FROM_CACHE=1
+    else
+        fetch_certificate
+    fi
+
+    if [ -n "$KV_TICKET_KEY_SECRET_URL" ]; then
+        TICKET_KEY_RESULT=$(curl -s -H "Authorization: Bearer $(get_token)" "${KV_TICKET_KEY_SECRET_URL}?api-version=7.2")
+        echo "$TICKET_KEY_RESULT" | json_field value | base64 -d > /etc/nginx/ssl_ticket.key
+    fi
+
+    if [ -n "$STARTED_FROM_CACHE" ] || [ -n "$CERT_CACHE_DIR" ] || [ "$CERT_POLL_INTERVAL" != "0" ]; then
+        certificate_agent </dev/null &
+    fi
+fi
+
+# TLS session ticket key (80 bytes). Shared by all the workers and, when it comes from /certs or Key Vault,
+# by all the replicas and across restarts, so reconnecting devices resume their sessions.
+if [ -f "/certs/ssl_ticket.bin" ]; then
+    cp /certs/ssl_ticket.bin /etc/nginx/ssl_ticket.key
+fi
+if [ "$(stat -c %s /etc/nginx/ssl_ticket.key 2>/dev/null)" != "80" ]; then
+    openssl rand 80 > /etc/nginx/ssl_ticket.key
+    echo "Generated a new TLS session ticket key, sessions do not survive a restart."
+fi
+chmod 600 /etc/nginx/ssl_ticket.key
@@ -0,0 +1,139 @@
+#!/bin/bash
+
+# Generates the MQTT servers of the stream block, included by nginx.conf.
+#   PROXY_MODE        terminate (default): TLS ends on the proxy, a new TLS session is opened to the hub
+#                     passthrough: routed on the SNI with ssl_preread, the device talks TLS with the hub itself
+#   IOTHUB_HOSTNAMES  hubs to shard the devices across (space or comma separated), default IOTHUB_HOSTNAME
+#   IOTHUB_SHARD_BY   sni (default): a device reaches the hub whose hostname or first label starts its SNI,
+#                     e.g. myhub2.proxy.example -> myhub2.azure-devices.net, unknown names go to the first hub
+#                     port: hub N of the list listens on IOTHUB_SHARD_BASE_PORT + N
+#   STREAM_METRICS_LOG  optional file the sessions are also logged to, for the metrics exporter
+PROXY_MODE=${PROXY_MODE:-terminate}
+IOTHUB_HOSTNAMES=${IOTHUB_HOSTNAMES:-$IOTHUB_HOSTNAME}
+IOTHUB_SHARD_BY=${IOTHUB_SHARD_BY:-sni}
+IOTHUB_SHARD_BASE_PORT=${IOTHUB_SHARD_BASE_PORT:-8883}
+STREAM_ROUTING_CONF=${STREAM_ROUTING_CONF:-/etc/nginx/stream-routing.conf}
+# A listen backlog above somaxconn is silently truncated by the kernel
+SOMAXCONN=$(cat /proc/sys/net/core/somaxconn 2>/dev/null || echo 4096)
+NGINX_BACKLOG=${NGINX_BACKLOG:-$(( SOMAXCONN < 65535 ? SOMAXCONN : 65535 ))}
+
+read -r -a HUBS <<< "${IOTHUB_HOSTNAMES//,/ }"
+if [ ${#HUBS[@]} -eq 0 ]; then
+    echo "Neither IOTHUB_HOSTNAMES nor IOTHUB_HOSTNAME is set, no MQTT route generated."
+    exit 1
+fi
+case "$PROXY_MODE" in
+    terminate)
+        SNI_VARIABLE='$ssl_server_name'
+        ;;
+    passthrough)
+        SNI_VARIABLE='$ssl_preread_server_name'
+        ;;
+    *)
+        echo "Unknown PROXY_MODE $PROXY_MODE (terminate or passthrough)"
+        exit 1
+        ;;
+esac
+if [ "$IOTHUB_SHARD_BY" != "sni" ] && [ "$IOTHUB_SHARD_BY" != "port" ]; then
+    echo "Unknown IOTHUB_SHARD_BY $IOTHUB_SHARD_BY (sni or port)"
+    exit 1
+fi
+
+# Settings of a server block, $1 is the proxy_pass target
+server_settings() {
+    if [ "$PROXY_MODE" = "terminate" ]; then
+        cat << EOF
+    # SSL certificate configuration
+    ssl_certificate /etc/ssl/certs/nginx-cert.crt;
+    ssl_certificate_key /etc/ssl/private/nginx-cert.key;
+
+    access_log /dev/stdout basic;${METRICS_ACCESS_LOG}
+
+    # SSL settings
+    ssl_protocols TLSv1.2 TLSv1.3;
+    # Session resumption: reconnecting devices skip the full handshake (~4000 sessions per MB)
+    ssl_session_cache shared:MQTT_SSL:50m;
+    ssl_session_timeout 4h;
+    ssl_session_tickets on;
+    ssl_session_ticket_key /etc/nginx/ssl_ticket.key;
+
+    # Proxy settings
+    proxy_pass $1;
+    proxy_connect_timeout 10s;
+    proxy_timeout 24h;
+
+    # Enable SSL when connecting to upstream
+    proxy_ssl on;
+    proxy_ssl_verify off;  # Set to 'on' if you want to verify the upstream certificate
+    proxy_ssl_protocols TLSv1.2 TLSv1.3;
+EOF
+    else
+        cat << EOF
+    # TLS passthrough: only the ClientHello is read (SNI), the hub certificate is presented to the device
+    ssl_preread on;
+
+    access_log /dev/stdout basic;${METRICS_ACCESS_LOG}
+
+    # Proxy settings
+    proxy_pass $1;
+    proxy_connect_timeout 10s;
+    proxy_timeout 24h;
+EOF
+    fi
+}
+
+generate() {
+    local i
+    echo "# Generated by 02-stream-routing.sh: PROXY_MODE=$PROXY_MODE IOTHUB_SHARD_BY=$IOTHUB_SHARD_BY IOTHUB_HOSTNAMES=${HUBS[*]}"
+    echo ""
+    for i in "${!HUBS[@]}"; do
+        cat << EOF
+upstream azure_iothub_$i {
+    server ${HUBS[$i]}:8883;
+}
+
+EOF
+    done
+
+    if [ "$IOTHUB_SHARD_BY" = "port" ]; then
+        for i in "${!HUBS[@]}"; do
+            echo "server {"
+            echo "    listen $((IOTHUB_SHARD_BASE_PORT + i))${LISTEN_OPTIONS} backlog=$NGINX_BACKLOG;"
+            echo ""
+            server_settings "azure_iothub_$i"
+            echo "}"
+            echo ""
+        done
+    elif [ ${#HUBS[@]} -eq 1 ]; then
+        echo "server {"
+        echo "    listen 8883${LISTEN_OPTIONS} backlog=$NGINX_BACKLOG;"
+        echo ""
+        server_settings "azure_iothub_0"
+        echo "}"
+    else
+        echo "map $SNI_VARIABLE \$iothub_upstream {"
+        echo "    hostnames;"
+        echo "    default azure_iothub_0;"
+        for i in "${!HUBS[@]}"; do
+            echo "    ${HUBS[$i]} azure_iothub_$i;"
+            echo "    ~^${HUBS[$i]%%.*}\\. azure_iothub_$i;"
+        done
+        echo "}"
+        echo ""
+        echo "server {"
+        echo "    listen 8883${LISTEN_OPTIONS} backlog=$NGINX_BACKLOG;"
+        echo ""
+        server_settings '$iothub_upstream'
+        echo "}"
+    fi
+}
+
+if [ "$PROXY_MODE" = "terminate" ]; then
+    LISTEN_OPTIONS=" ssl"
+fi
+if [ -n "$STREAM_METRICS_LOG" ]; then
+    mkdir -p "$(dirname "$STREAM_METRICS_LOG")"
+    METRICS_ACCESS_LOG=$'\n'"    access_log $STREAM_METRICS_LOG metrics buffer=64k flush=1s;"
+fi
+generate > "$STREAM_ROUTING_CONF.new" && mv -f "$STREAM_ROUTING_CONF.new" "$STREAM_ROUTING_CONF"
+echo "MQTT routing generated in $STREAM_ROUTING_CONF: $PROXY_MODE mode, ${#HUBS[@]} hub(s) sharded by $IOTHUB_SHARD_BY."
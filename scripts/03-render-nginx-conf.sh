@@ -0,0 +1,116 @@
+#!/bin/bash
+
+# Renders nginx.conf.template sized for the container: CPU quota and memory limit of the cgroup (v1 or v2)
+# instead of the host cores, listen backlog bounded by somaxconn, open files bounded by the hard limit.
+# Runs after the envsubst step of the nginx image and replaces its output.
+#   NGINX_WORKER_PROCESSES, NGINX_WORKER_CONNECTIONS, NGINX_RLIMIT_NOFILE, NGINX_BACKLOG,
+#   NGINX_PROXY_BUFFER_SIZE   force a value instead of the derived one
+#   NGINX_SESSION_MEMORY_KB   memory of one proxied MQTT session (rss_kb_per_idle_connection of nginx_benchmark.py)
+#   NGINX_MEMORY_PERCENT      share of the memory limit given to the sessions (default 75)
+#   NGINX_SIZING_OUTPUT       only write the derived values to this file (NAME=value lines), nothing is rendered
+NGINX_TEMPLATE=${NGINX_TEMPLATE:-/etc/nginx/templates/nginx.conf.template}
+NGINX_CONF=${NGINX_CONF:-${NGINX_ENVSUBST_OUTPUT_DIR:-/etc/nginx}/nginx.conf}
+NGINX_MEMORY_PERCENT=${NGINX_MEMORY_PERCENT:-75}
+PROXY_MODE=${PROXY_MODE:-terminate}
+MAX_WORKER_CONNECTIONS=65535
+
+# CPUs of the cgroup quota, rounded up, at most the CPUs the process may run on
+cpu_limit() {
+    local cpus quota period
+    cpus=$(nproc)
+    if [ -f /sys/fs/cgroup/cpu.max ]; then
+        read -r quota period < /sys/fs/cgroup/cpu.max
+    elif [ -f /sys/fs/cgroup/cpu/cpu.cfs_quota_us ]; then
+        quota=$(cat /sys/fs/cgroup/cpu/cpu.cfs_quota_us)
+        period=$(cat /sys/fs/cgroup/cpu/cpu.cfs_period_us)
+    fi
+    if [ -n "$quota" ] && [ "$quota" != "max" ] && [ "$quota" -gt 0 ]; then
+        quota=$(( (quota + period - 1) / period ))
+        [ "$quota" -lt "$cpus" ] && cpus=$quota
+    fi
+    echo "$cpus"
+}
+
+# Memory limit of the cgroup in KB, at most the memory of the host
+memory_limit_kb() {
+    local limit total
+    total=$(sed -n 's/^MemTotal: *\([0-9]*\) kB/\1/p' /proc/meminfo)
+    if [ -f /sys/fs/cgroup/memory.max ]; then
+        limit=$(cat /sys/fs/cgroup/memory.max)
+    elif [ -f /sys/fs/cgroup/memory/memory.limit_in_bytes ]; then
+        limit=$(cat /sys/fs/cgroup/memory/memory.limit_in_bytes)
+    fi
+    if [ -n "$limit" ] && [ "$limit" != "max" ] && [ $(( limit / 1024 )) -lt "$total" ]; then
+        echo $(( limit / 1024 ))
+    else
+        echo "$total"
+    fi
+}
+
+# Memory of one session: two connections (device and hub), a proxy buffer per direction and,
+# when TLS is terminated, the state of both TLS sessions
+session_memory_kb() {
+    local proxy_buffer_kb=$1
+    if [ -n "$NGINX_SESSION_MEMORY_KB" ]; then
+        echo "$NGINX_SESSION_MEMORY_KB"
+    elif [ "$PROXY_MODE" = "passthrough" ]; then
+        echo $(( 8 + 2 * proxy_buffer_kb ))
+    else
+        echo $(( 48 + 2 * proxy_buffer_kb ))
+    fi
+}
+
+CPUS=$(cpu_limit)
+MEMORY_KB=$(memory_limit_kb)
+SOMAXCONN=$(cat /proc/sys/net/core/somaxconn 2>/dev/null || echo 4096)
+HARD_NOFILE=$(ulimit -Hn)
+[ "$HARD_NOFILE" = "unlimited" ] && HARD_NOFILE=1048576
+
+export NGINX_WORKER_PROCESSES=${NGINX_WORKER_PROCESSES:-$CPUS}
+# "auto" would be the host cores again, the sizing below counts the CPUs of the quota
+WORKERS=$NGINX_WORKER_PROCESSES
+[[ "$WORKERS" =~ ^[0-9]+$ ]] || WORKERS=$CPUS
+export NGINX_BACKLOG=${NGINX_BACKLOG:-$(( SOMAXCONN < 65535 ? SOMAXCONN : 65535 ))}
+
+# Sessions the memory budget holds with 16k proxy buffers; when that is below what the workers can
+# accept, 4k buffers (MQTT telemetry is small) leave room for more sessions
+SESSION_BUDGET_KB=$(( MEMORY_KB * NGINX_MEMORY_PERCENT / 100 ))
+PROXY_BUFFER_KB=16
+SESSIONS=$(( SESSION_BUDGET_KB / $(session_memory_kb $PROXY_BUFFER_KB) ))
+if [ $(( SESSIONS * 2 )) -lt $(( WORKERS * MAX_WORKER_CONNECTIONS )) ]; then
+    PROXY_BUFFER_KB=4
+    SESSIONS=$(( SESSION_BUDGET_KB / $(session_memory_kb $PROXY_BUFFER_KB) ))
+fi
+export NGINX_PROXY_BUFFER_SIZE=${NGINX_PROXY_BUFFER_SIZE:-${PROXY_BUFFER_KB}k}
+
+# worker_connections counts both connections of a session
+WORKER_CONNECTIONS=$(( SESSIONS * 2 / WORKERS ))
+[ "$WORKER_CONNECTIONS" -gt "$MAX_WORKER_CONNECTIONS" ] && WORKER_CONNECTIONS=$MAX_WORKER_CONNECTIONS
+[ "$WORKER_CONNECTIONS" -lt 1024 ] && WORKER_CONNECTIONS=1024
+# Every connection is a file descriptor, plus log files, listeners and the upstream resolution
+NOFILE=$(( WORKER_CONNECTIONS + 1024 ))
+if [ "$NOFILE" -gt "$HARD_NOFILE" ]; then
+    NOFILE=$HARD_NOFILE
+    WORKER_CONNECTIONS=$(( HARD_NOFILE > 2048 ? HARD_NOFILE - 1024 : HARD_NOFILE / 2 ))
+fi
+export NGINX_WORKER_CONNECTIONS=${NGINX_WORKER_CONNECTIONS:-$WORKER_CONNECTIONS}
+export NGINX_RLIMIT_NOFILE=${NGINX_RLIMIT_NOFILE:-$NOFILE}
+
+if [ -n "$NGINX_SIZING_OUTPUT" ]; then
+    env | grep -E '^NGINX_(WORKER_PROCESSES|WORKER_CONNECTIONS|RLIMIT_NOFILE|BACKLOG|PROXY_BUFFER_SIZE)=' > "$NGINX_SIZING_OUTPUT"
+    exit 0
+fi
+
+# Same substitution as the envsubst step of the nginx image: only the defined variables
+defined_envs=$(printf '${%s} ' $(awk 'END { for (name in ENVIRON) { print name } }' < /dev/null))
+envsubst "$defined_envs" < "$NGINX_TEMPLATE" > "$NGINX_CONF.new" || exit 1
+mv -f "$NGINX_CONF.new" "$NGINX_CONF"
+
+echo "nginx sized for $CPUS CPU(s), $(( MEMORY_KB / 1024 )) MB, somaxconn $SOMAXCONN, open files hard limit $HARD_NOFILE:" \
+     "worker_processes $NGINX_WORKER_PROCESSES, worker_connections $NGINX_WORKER_CONNECTIONS," \
+     "worker_rlimit_nofile $NGINX_RLIMIT_NOFILE, backlog $NGINX_BACKLOG," \
+     "proxy_buffer_size $NGINX_PROXY_BUFFER_SIZE (~$(( WORKERS * NGINX_WORKER_CONNECTIONS / 2 )) MQTT sessions)"
+
+if [ "${NGINX_CONF_TEST:-1}" != "0" ]; then
+    nginx -t -q -c "$NGINX_CONF" || exit 1
+fi